@@ -1,42 +1,89 @@
+#This goes first so the startup times include importing everything else.
+import startup_timing
 import sys
 from kobold_ui import KoboldUI
 from narrative_data import *
 from PySide6.QtWidgets import QInputDialog, QLineEdit
+from PySide6.QtCore import QObject, QThread, QTimer
 import kobold_api
+from endpoint_pool import EndpointPool
+import prompt_builder
+from generation_scheduler import GenerationScheduler, GenerationJob, CANCELLED, DONE, RUNNING
+from typing_worker import TypingWorker
+from story_buffer import replace_utf16, utf16_length
+from save_journal import SaveJournal
+from character_index import CharacterIndex
+from story_search import StorySearch
+import asyncio
 import subprocess
-import time
-import threading
-import time
-from fnmatch import fnmatch
-import json
+startup_timing.mark("Imports")
 
-BASE_TYPING_TIME = 0.2
-TYPING_TIME_MULTIPLIER = 0.9
+#Milliseconds between autosaves. Each one only writes what changed, so it's cheap when nothing has.
+AUTOSAVE_INTERVAL = 5000
+#Milliseconds between checks on whether the snapshot indexing stories for a search is done.
+INDEX_POLL_INTERVAL = 200
 
-class Controller:
+#It's a QObject so signals from the typing thread to its methods get queued onto the GUI thread.
+class Controller(QObject):
     def __init__(self):
+        super().__init__()
         # Create UI
         self.ui = KoboldUI.create_window()
+        startup_timing.mark("Window built")
+        self.endpoints = EndpointPool([kobold_api.DEFAULT_BASE_URL])
         
         # Setup event handlers/listeners for UI elements
         self.setup_ui_handlers()
         
         #self.wordcount = 0
         #self.letter_delay = 0.01
-        #self.generating is the story that's generating, or None if there isn't one. It's not the index, because tabs could be closed mid-generation messing it up. It's the object itself.
+        #self.generating is the story the typing animation is writing to, or None if there isn't one. It's not the index, because tabs could be closed mid-generation messing it up. It's the object itself.
         self.generating = None
-        self.aborting = False
-        self.generated_text = ""
-        self._typing_thread = None
         self.searching_character = False
-        self.wake_thread = threading.Event()
-        self.typing_thread = threading.Thread(target=self._typing_loop, daemon=True)
+        self.character_index = CharacterIndex()
+        #The typing animation runs on its own thread. It only talks to this one through signals, so nothing here ever waits on it.
+        self.typist = TypingWorker()
+        self.typing_thread = QThread()
+        self.typist.moveToThread(self.typing_thread)
+        self.typist.typed.connect(self.add_text)
+        self.typist.released.connect(self._typist_released)
         self.typing_thread.start()
-        self.lock = threading.Lock()
-        self.completing = False         #Tracks if the input stream is finished and it's just typing the rest out.
+        self.ui.app.aboutToQuit.connect(self._stop_typing_thread)
+        self.typing_job = None          #The job whose text goes through the typing animation. It's always for the tab that's showing, if that's generating. Any others write their text straight in.
+        self.releasing = False          #The typing animation is writing out what it has left of typing_job because its tab isn't showing anymore. See _update_typing().
+        self.held_tokens = []           #(token, done) for typing_job that came in while it was releasing, to go straight in after the rest.
+        self.scheduler = GenerationScheduler(self._start_job, self._abort_job, self.endpoints)
+        self.scheduler.queue_changed.connect(self._update_generation_states)
+        #Connected after the scheduler's own handler, so the job's status says whether it's really finished or going back in the queue.
+        self.scheduler.job_done.connect(self._generation_finished)
         
         self.project = None
+        self.journal = SaveJournal()
+        self.story_search = StorySearch(self.journal)
+        self.waiting_for_index = False
         self.load()
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.save)
+        self.autosave_timer.start(AUTOSAVE_INTERVAL)
+        self.endpoints.set_endpoints(Project.endpoints)
+        self.typist.pacer_requested.emit(Project.pacing)
+        #Anything posted now runs after the window's first paint, which was posted when it was shown.
+        QTimer.singleShot(0, self._finish_startup)
+    
+    #The rest of the window gets built, and the other open tabs read, once the story's showing.
+    def _finish_startup(self):
+        startup_timing.mark("First paint")
+        self.ui.setup_deferred_panels()
+        startup_timing.mark("Other panels built")
+        self.journal.preload([project for project in Project.open_projects if project is not self.project], lambda: startup_timing.mark("Other tabs read"))
+        if startup_timing.ENABLED:
+            self._report_startup()
+    
+    def _report_startup(self):
+        if self.journal.preloading.is_alive():
+            QTimer.singleShot(50, self._report_startup)
+        else:
+            print(startup_timing.report())
         
     #TODO: I should probably change all the text stuff to happen on editing finished.
     def setup_ui_handlers(self):
@@ -44,11 +91,9 @@ class Controller:
         self.ui.abort_requested.connect(self.handle_abort)
         self.ui.tab_selected.connect(self.select_tab)
         self.ui.new_tab_requested.connect(self.new_tab)
-        self.ui.memory_area.textChanged.connect(self.update_memory)
-        self.ui.story_area.textChanged.connect(self.update_story)
+        self.ui.documents.edited.connect(self._document_edited)
         self.ui.tab_renamed.connect(self.rename_tab)
         self.ui.tab_closed.connect(self.close_tab)
-        self.ui.char_detail.textChanged.connect(self.update_character_data)
         self.ui.char_name.editingFinished.connect(self.update_character_name)
         self.ui.character_selected.connect(self.handle_character_selected)
         self.ui.character_search.textChanged.connect(self.character_search)
@@ -56,163 +101,206 @@ class Controller:
         self.ui.add_character_button.clicked.connect(self.add_character)
         self.ui.character_removed_from_project.connect(self.remove_character_from_project)
         self.ui.character_deleted.connect(self.delete_character)
-        self.ui.closing_program.connect(self.save)   #TODO: There should be a way to close without saving.
+        self.ui.closing_program.connect(self.close)   #TODO: There should be a way to close without saving.
         self.ui.search_shortcut.activated.connect(self.project_search)
-        self.ui.search_panel_button_layout.button_clicked.connect(self.project_search_button_clicked)
-        self.ui.project_search_bar.textChanged.connect(self.project_filter)
+        self.ui.project_button_clicked.connect(self.project_search_button_clicked)
+        self.ui.project_search_changed.connect(self.project_filter)
+        self.ui.history_requested.connect(self.show_history)
+        self.ui.version_selected.connect(self.restore_version)
+        self.ui.fork_requested.connect(self.fork_tab)
     
     #TODO: I should probably change this to just pass in names. Either that or make the buttons actually track the projects.
     #Also, this is very similar to character_search()
     def project_search(self):
-        self.ui.stacked_widget.setCurrentIndex(1)
+        self.ui.show_search_view()
         self.project_filter()
     
     def project_filter(self):
-        if self.ui.stacked_widget.currentIndex() != 1:
+        if not self.ui.is_search_view_showing():
             return
         text = self.ui.project_search_bar.text().strip()
-        pattern = f"*{text.lower()}*"
-        #TODO If I'm looking at the keys, I don't need to to be lowercase.
-        matching_projects = [
-            project for name, project in Project.named_projects.items()
-            if fnmatch(name, pattern)
-        ]
-        self.ui.project_search(matching_projects)
+        if text == '':
+            self.ui.project_search(list(Project.named_projects.values()))
+            return
+        results = self.story_search.search(text)
+        self.ui.project_search_results(results, self.story_search.waiting)
+        #Stories that aren't indexed yet get indexed by the snapshot searching started, so it searches again once that's done.
+        if self.story_search.waiting and not self.waiting_for_index and self.journal.compacting is not None and self.journal.compacting.is_alive():
+            self.waiting_for_index = True
+            QTimer.singleShot(INDEX_POLL_INTERVAL, self._wait_for_index)
+
+    def _wait_for_index(self):
+        if self.journal.compacting.is_alive():
+            QTimer.singleShot(INDEX_POLL_INTERVAL, self._wait_for_index)
+            return
+        self.waiting_for_index = False
+        self.project_filter()
 
     def handle_abort(self):
-        self.aborting = True
-        kobold_api.abort()
+        job = self.scheduler.job_for(self.project)
+        if job is not None:
+            self.scheduler.cancel(job)
     
     def handle_send(self):
-        self.ui.lock_story_area(True)
-        self.ui.set_generating_state(True)
-        self.generating = self.project
-        self.completing = False
         # Process input and interact with the LLM
-        memory = self.ui.get_memory().strip()
-        #Add in all the characters. It might be better to use join() with the memory and characters.
-        for character in self.project.active_characters:
-            description = character.description
-            if description != '':
-                memory += '\n\n' + description
-        memory += '\n\n'
-        story = self.ui.get_story().strip()
+        memory = self.ui.get_memory()
+        characters = [(character.name, character.description) for character in self.project.active_characters]
         max_tokens = self.ui.get_max_tokens()
         temperature = self.ui.get_temperature()
         entry = self.ui.get_and_clear_entry()
         command_type = self.ui.get_command_type()
+        self.project.history.snapshot(self.project.story, "Before sending")
         if entry != '':
-            if story != '':
-                story += '\n\n'
-            story += f"{command_type} {entry.strip()}\n\n"
-            self.ui.set_story(story)
+            #Replace whatever whitespace is at the end of the story with the entry. Only the end changes, so it's one edit that can be undone instead of resetting the whole story.
+            story = self.project.story
+            end = str(story)
+            trailing = end[len(end.rstrip()):]
+            addition = ('\n\n' if len(trailing) < len(story) else '') + f"{command_type} {entry.strip()}\n\n"
+            story.replace(len(story) - len(trailing), len(trailing), addition)
+            self.ui.documents.replace_end(self.project, 'story', utf16_length(trailing), addition)
         self.extra_length = 0
         #kobold_api.prompt(self.update_story, story, memory, stopSequence = [command_type])
         #kobold_api.stream_prompt(self.update_story_simple, story, memory, stopSequence = [command_type])
-        threading.Thread(
-            target=lambda: kobold_api.stream_prompt(self.update_story_smooth, story, memory, max_tokens, temperature, stopSequence = [command_type]),
-            daemon=True
-        ).start()
+        #It waits in the scheduler until nothing else is generating. The prompt gets built once it starts, from whatever the story is by then.
+        self.scheduler.submit(GenerationJob(self.project, memory, characters, max_tokens, temperature, [command_type]))
+    
+    def _start_job(self, job):
+        job.stream_done = False
+        if job.project is self.project:
+            self.ui.lock_story_area(True)
+            self._update_typing()
+        #This runs on the Qt event loop through QtAsyncio, so it doesn't need its own thread.
+        asyncio.ensure_future(self._generate(job))
+    
+    def _abort_job(self, job):
+        if job is self.typing_job and not self.releasing:
+            self.typist.abort_requested.emit()
+        print("Sending Abort request")
+        asyncio.ensure_future(job.client.abort(job.genkey))
+    
+    async def _generate(self, job):
+        project = job.project
+        try:
+            memory, story, breakdown = await prompt_builder.build_prompt(self.endpoints.tokenizer(), job.memory, job.characters, project.story, job.remaining_tokens(), story_start=project.prompt_start, story_opening=project.prompt_opening, token_counts=project.token_counts)
+            print("Prompt breakdown:", breakdown)
+            project.prompt_start = breakdown['story_start']
+            project.prompt_opening = breakdown['story_opening']
+            #It was aborted while the prompt was being built, before there was anything on the server to abort.
+            if job.status == CANCELLED or job.preempted:
+                self._receive(job, '', True)
+                return
+            await job.client.stream_prompt(lambda token, done: self._receive(job, token, done), story, memory, job.remaining_tokens(), job.temperature, stopSequence = job.stop_sequence, genkey = job.genkey)
+        except ConnectionError as error:
+            print(f"Generation failed: {error}")
+            job.failed = True
+        finally:
+            #stream_prompt doesn't finish it if the request fails. It's finished here, after it's marked as failed, since a background tab's job is done as soon as it's finished, and the scheduler decides then whether to try it again.
+            if not job.stream_done:
+                self._receive(job, '', True)
+    
+    def _receive(self, job, token, done):
+        token = token or ''
+        if token != '':
+            job.tokens_generated += 1
+        if done:
+            job.stream_done = True
+        if job is self.typing_job:
+            if self.releasing:
+                self.held_tokens.append((token, done))
+            else:
+                self.update_story_smooth(token, done)
+            return
+        self._write_directly(job, token, done)
+    
+    #Generations in tabs that aren't showing skip the typing animation. Their text goes straight into the story, and into the document once the tab shows.
+    def _write_directly(self, job, token, done):
+        if token != '':
+            job.project.story += token
+            self.ui.add_text(token, job.project)
+        if done:
+            if job.project is self.project:
+                self.ui.lock_story_area(False)
+            self.scheduler.job_done.emit(job)
+    
+    def _generation_finished(self, job):
+        if job.status == DONE:
+            job.project.history.snapshot(job.project.story, "Generated")
+        elif job.status == CANCELLED:
+            job.project.history.snapshot(job.project.story, "Aborted")
+    
+    def show_history(self):
+        self.ui.show_history(self.project.history.versions)
+    
+    #The story as it is now goes in the history first, so restoring can be undone by restoring that.
+    def restore_version(self, index):
+        if self.scheduler.job_for(self.project) is not None:
+            return
+        history = self.project.history
+        text = history.text(index)
+        history.snapshot(self.project.story, "Before restoring")
+        self.project.story = text
+        self.ui.set_story(text)
+        history.snapshot(self.project.story, f"Restored version {index + 1}")
+    
+    #Shows which tabs are generating or waiting to, and whether the selected one has anything to abort.
+    def _update_generation_states(self):
+        for i, project in enumerate(Project.open_projects):
+            job = self.scheduler.job_for(project)
+            self.ui.set_tab_state(i, None if job is None else job.status, 0 if job is None else self.scheduler.queue_position(job))
+        if self.project is not None:
+            self.ui.set_generating_state(self.scheduler.job_for(self.project) is not None)
 
     def update_story_simple(self, extra, completed):
-        self.ui.add_text(extra, completed)
+        self.ui.add_text(extra)
 
     def update_story_smooth(self, extra, completed):
-        with self.lock:
-            if completed and self.generated_text == "" and extra == "":
-                self.add_text(extra, completed)
-            else:
-                self.generated_text += extra
-                self.completing = completed
-                self.wake_thread.set()
+        self.typist.text_received.emit(extra, completed)
     
+    #The typing thread calls this through a queued signal, so it always runs on the GUI thread.
     def add_text(self, text, completed):
         is_cur_story = self.generating is self.project
         if text != "":
             self.generating.story += text
-            if is_cur_story:
-                self.ui.add_text(text)
+            self.ui.add_text(text, self.generating)
         if completed:
-            self.ui.set_generating_state(False)
             if is_cur_story:
                 self.ui.lock_story_area(False)
             #print("Done generating")
             self.generating = None     #Commenting this out makes it work, but does it break anything else? This is how it tracks if anything is generating, and it looks like it would break tab switching.
+            job = self.typing_job
+            self.typing_job = None
+            self.scheduler.job_done.emit(job)     #The scheduler picks this up on the GUI thread and starts whatever's next.
+
+    #Only the tab that's showing gets the typing animation. When you switch away, the animation writes out what it has and the rest goes straight in. When you switch to a tab that's generating, the animation picks up from whatever comes in next.
+    def _update_typing(self):
+        if self.releasing:
+            return      #It'll check again once it's released.
+        if self.typing_job is not None:
+            if self.typing_job.project is not self.project:
+                self.releasing = True
+                self.typist.release_requested.emit()
+            return
+        job = self.scheduler.job_for(self.project)
+        if job is not None and job.status == RUNNING and not job.stream_done:
+            self.typing_job = job
+            self.generating = job.project
 
-    def _typing_loop(self):
-        index = 0
-        typing_time = 0
-        wait_time = None
-        while True:
-            interrupted = self.wake_thread.wait(wait_time)
-            self.wake_thread.clear()
-            with self.lock:
-                #I need to make sure this works for all the cases:
-                #1. (Done) It just recieved the first token.
-                    #1b. (Prevented) It recieved the first token, except it's an empty string.
-                #2. (Done) It recieved another token while in the middle of typing, and needs to update based on how long it waited so far.
-                #3. (Done) It recieved the last token, and needs to type quickly and then
-                    #3b. (Done) Alert the main thread that typing is completed and the text box can be unlocked.
-                #4. (Done) It's aborting, and must type the whole buffer.
-                #5. (Done) The wait_time completed and it's time to write the next letter.
-                
-                #The user clicked abort. Time to flush all the text.
-                if self.aborting:
-                    self.add_text(self.generated_text[index:], self.completing)
-                    index = len(self.generated_text)
-                    wait_time = None
-                    if self.completing:
-                        index = 0
-                        self.generated_text = ''
-                        self.aborting = False
-                    continue
-                #It recieved another token in the middle of typing. Update the wait times, but don't actually do anything. If it needs to immediatly type something, wait_time will be negative. I guess I could have it fall through, but this seems cleaner.
-                elif interrupted and wait_time is not None:
-                    new_time = time.monotonic()
-                    elapsed_time = new_time - start_time
-                    remaining_text = len(self.generated_text) - index
-                    typing_time = BASE_TYPING_TIME / remaining_text
-                    wait_time = typing_time - elapsed_time
-                    continue
-                #It finished typing the letter or it recieved the first token.
-                else:
-                    #If this is the first token, there's no lower bound for how fast to type, so set prev_duration to zero. Otherwise, calculate prev_duration based on when the last token was typed.
-                    if wait_time == None:
-                        prev_duration = 0
-                        start_time = time.monotonic()
-                    else:
-                        new_time = time.monotonic()
-                        prev_duration = new_time - start_time
-                        #print(f"prev_duration: {prev_duration}")
-                        start_time = new_time
-                    remaining_text = len(self.generated_text) - index
-                    #This line feels really weird. I print the letter at index, and then check if it's the last one. Except remaining_text is still 1, since that's the letter I just wrote. Then I increment index and decrement remaining_text. It feels like I should move this, but then I'd have to do something weirder use self.generated_text[index-1].
-                    #It's crashing on this line when given an empty token and nothing else.
-                    if self.generated_text == "":
-                        print(f"generated_text is empty. remaining_text is {remaining_text}.")
-                    #print(f"{self.generated_text[index]} {remaining_text}")
-                    self.add_text(self.generated_text[index], self.completing and remaining_text == 1)
-                    index += 1
-                    remaining_text -= 1
-                    #print(f"Remaining text: {remaining_text}")
-                    #If there's no text left, set the wait time to None (wait forever).
-                    if remaining_text == 0:
-                        wait_time = None
-                        if self.completing:
-                            print("Completed.")
-                            index = 0
-                            self.generated_text = ''
-                        else:
-                            print("Ran out of text. Waiting for next token.")
-                    #Otherwise, if this is the last token, set the wait time to a bit faster than the last one (finish quickly).
-                    elif self.completing:
-                        wait_time = typing_time * TYPING_TIME_MULTIPLIER
-                        #print(f"Completing. Current letter: {self.generated_text[index-1]}, wait_time: {wait_time}")
-                    #Otherwise, set it to base time/remaining (so the more is in the buffer the faster it types) but cap it at a bit faster than the last one.
-                    else:
-                        wait_time = max(BASE_TYPING_TIME / remaining_text, typing_time * TYPING_TIME_MULTIPLIER)
-                    typing_time = 0 if wait_time is None else wait_time
-                    continue
+    def _typist_released(self):
+        self.releasing = False
+        job = self.typing_job
+        held = self.held_tokens
+        self.held_tokens = []
+        #If the stream ended while it was releasing, add_text already finished the job.
+        if job is not None:
+            self.typing_job = None
+            self.generating = None
+            for token, done in held:
+                self._write_directly(job, token, done)
+        self._update_typing()
+
+    def _stop_typing_thread(self):
+        self.typing_thread.quit()
+        self.typing_thread.wait()
     
     def add_character(self):
         name = self.ui.character_search.text().strip()
@@ -221,6 +309,7 @@ class Controller:
             return
         new_character = Character(name)
         Project.all_characters[name.lower()] = new_character
+        self.character_index.add(new_character)
         self.project.project_characters.add(new_character)
         self.project.active_characters.add(new_character)
         self.set_selected_character(new_character)
@@ -235,12 +324,14 @@ class Controller:
     def delete_character(self, name):
         name = name.lower()
         character = Project.all_characters[name]
+        self.ui.documents.discard(character)
         self.project.project_characters.discard(character)
         self.project.active_characters.discard(character)
         if self.project.selected_character == character:
             self.project.selected_character = None
             self.ui.set_character(None)
         del Project.all_characters[name]
+        self.character_index.remove(character)
         self._update_character_buttons()
     
     def handle_character_selected(self, button):
@@ -291,16 +382,15 @@ class Controller:
         self.project.selected_character.name = new_name
         del Project.all_characters[old_name.lower()]
         Project.all_characters[new_name.lower()] = self.project.selected_character
+        self.character_index.changed(self.project.selected_character)
         self._update_character_buttons()
     
-    def update_character_data(self):
-        #If no character is selected, don't do anything.
-        #TODO: Maybe it should hide the window entirely.
-        if self.project.selected_character is None:
-            return
-        #If I change this to use a Character class, then it would look more like:
-        #self.project.selected_character.detail = character_detail
-        self.project.selected_character.description = self.ui.get_character_description()
+    def update_character_data(self, character, position, removed, added):
+        character.description = replace_utf16(character.description, position, removed, added)
+        self.character_index.changed(character)
+        if utf16_length(character.description) != self.ui.documents.utf16_length(character, 'description'):
+            print("Character description got out of sync with its document. Reloading it.")
+            character.description = self.ui.documents.text(character, 'description')
     
     def set_selected_character(self, character):
         self.project.selected_character = character
@@ -313,7 +403,7 @@ class Controller:
     def is_char_name_valid(self, name):
         return name.lower() not in Project.all_characters and name != '+'
     
-    #TODO: I should probably make it so if you type multiple words, it searches for something with all the words but not necessarily the whole string in order. And maybe make it search details instead of just names.
+    #Each word can be anywhere in the name or description. See character_index.py.
     def character_search(self, text):
         text = text.strip()
         self.searching_character = text != ''
@@ -321,19 +411,14 @@ class Controller:
         if not self.searching_character:
             self.ui.set_character_list(self.project.project_characters, self.project.active_characters, False, False)
             return
-        pattern = f"*{text.lower()}*"
-        #TODO If I'm looking at the keys, I don't need to to be lowercase.
-        matching_names = [
-            character for name, character in Project.all_characters.items()
-            if fnmatch(name, pattern)
-        ]
-        self.ui.set_character_list(matching_names, set(self.project.project_characters), True, self.is_char_name_valid(text))
+        matching_characters = self.character_index.search(text, Project.all_characters.values())
+        self.ui.set_character_list(matching_characters, set(self.project.project_characters), True, self.is_char_name_valid(text), self.character_index.more)
     
     def run(self):
         # self.start_kobold()   # This line would make it more convenient to run, but is really inconvenient for testing unless I make a way to check if it's already running.
         # Show the UI
         # Start the application event loop
-        return self.ui.run_app()
+        return self.ui.run_app(self.endpoints.health_loop())
     
     #If you change it to actually run this code, make sure to add in the model path.
     def start_kobold(self):
@@ -365,50 +450,79 @@ class Controller:
             i = len(Project.open_projects)
             Project.open_projects.append(project)
             self.ui.new_tab(project.name)
-        self.ui.stacked_widget.setCurrentIndex(0)
-        self.ui.project_search_bar.setText('')
+        self.ui.close_search_view()
         self.ui.tab_bar.setCurrentIndex(i)
 
     def populate_gui(self, project):
-        self.ui.set_memory(project.memory)
-        self.ui.set_story(project.story)
+        self.ui.show_project(project)
         self.ui.set_character_list(project.project_characters, project.active_characters)
         self.ui.set_character(project.selected_character)
         #print(project.name, project.project_characters)
     
+    #This only writes what changed since the last save. See save_journal.py.
     def save(self):
-        with open("save.json", "w") as outfile:
-            json.dump(Project.all_to_dictionary(), outfile, indent = 4)
+        self.journal.save()
+    
+    def close(self):
+        self.autosave_timer.stop()
+        self.journal.close()
     
     def load(self):
-        try:
-            with open('save.json', 'r') as openfile:
-                Project.load_from_dictionary(json.load(openfile))
+        if self.journal.load():
             print("File found and loaded.")
-        except FileNotFoundError:
+        else:
             print("Savefile not found. Creating a new save.")
-            Project.start_empty()
+        startup_timing.mark("Save loaded")
         self.ui.set_all_tabs([project.name for project in Project.open_projects], Project.story_index)
+        startup_timing.mark("Tab shown")
     
     def select_tab(self, i):
-        if self.generating is self.project:
-            self.ui.lock_story_area(False)
         Project.story_index = i
         self.project = Project.open_projects[i]
         self.populate_gui(self.project)
-        if self.generating is self.project:
-            self.ui.lock_story_area(True)
+        job = self.scheduler.job_for(self.project)
+        self.ui.lock_story_area(job is not None and job.status == RUNNING)
+        self.ui.set_generating_state(job is not None)
+        self._update_typing()
+        #If this tab has something queued, it might jump ahead of whatever's generating now.
+        self.scheduler.set_foreground(self.project)
+    
+    #Each document sends its edits along with who it belongs to, so they go to the right project even if it's not the one showing.
+    def _document_edited(self, owner, field, position, removed, added):
+        if field == 'story':
+            self.update_story(owner, position, removed, added)
+        elif field == 'memory':
+            self.update_memory(owner, position, removed, added)
+        elif field == 'description':
+            self.update_character_data(owner, position, removed, added)
     
-    def update_memory(self):
-        self.project.memory = self.ui.get_memory()
+    def update_memory(self, project, position, removed, added):
+        project.memory = replace_utf16(project.memory, position, removed, added)
+        if utf16_length(project.memory) != self.ui.documents.utf16_length(project, 'memory'):
+            print("Memory got out of sync with its document. Reloading it.")
+            project.memory = self.ui.documents.text(project, 'memory')
     
     def new_tab(self):
         Project.open_projects.append(Project())
         self.ui.new_tab('')
     
+    #The fork gets the story up to the cursor, so you can pick where it goes a different way. It opens in a new tab next to the + like any other new one.
+    def fork_tab(self):
+        position = self.project.story.from_utf16(self.ui.story_cursor_position())
+        Project.open_projects.append(self.project.fork(position))
+        self.ui.new_tab('')
+    
     #TODO: The name is too close to update_story_smooth. I'll need to change names to clarify update_story_smooth updating it in the UI vs update_story updating it from the UI to the model.
-    def update_story(self):
-        self.project.story = self.ui.get_story()
+    #This only applies the part that changed, so typing in a long story doesn't copy the whole thing every keystroke.
+    def update_story(self, project, position, removed, added):
+        story = project.story
+        start = story.from_utf16(position)
+        end = story.from_utf16(position + removed)
+        story.replace(start, end - start, added)
+        #Checking the length is cheap, and it catches anything the deltas missed.
+        if story.utf16_length() != self.ui.documents.utf16_length(project, 'story'):
+            print("Story got out of sync with its document. Reloading it.")
+            project.story = self.ui.documents.text(project, 'story')
     
     def _is_project_name_valid(self, name):
         name = name.lower()
@@ -432,8 +546,17 @@ class Controller:
             self.ui.set_tab_name(index, old_name)
     
     def close_tab(self, index):
+        #Untitled projects are gone once their tab closes, so there's no point finishing their generations. Named ones keep going in the background.
+        if Project.open_projects[index].name == '':
+            self.scheduler.cancel_project(Project.open_projects[index])
+        project = Project.open_projects[index]
+        self.ui.documents.discard(project)
         del Project.open_projects[index]
         self.ui.remove_tab(index)
+        self._update_generation_states()
+        #A closed project doesn't need its story in memory unless it's still generating. It's read from the save again if it's opened.
+        if project.name != '' and self.scheduler.job_for(project) is None:
+            self.journal.unload(project)
 
 # Application entry point
 if __name__ == "__main__":
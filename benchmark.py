@@ -0,0 +1,821 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import subprocess
+import collections
+import argparse
+import requests
+import kobold_api
+import mock_kobold
+from narrative_data import Project
+
+def _percentiles(times):
+    """Summarizes a list of durations in seconds, in milliseconds."""
+    if not times:
+        return {}
+    times = sorted(times)
+    count = len(times)
+    return {
+        'mean_ms': 1000 * sum(times) / count,
+        'p50_ms': 1000 * times[count // 2],
+        'p90_ms': 1000 * times[min(count - 1, count * 90 // 100)],
+        'p99_ms': 1000 * times[min(count - 1, count * 99 // 100)],
+        'max_ms': 1000 * times[-1],
+    }
+
+def _time_calls(function, calls):
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return _percentiles(times)
+
+#Compares a new connection per call (what kobold_api used to do) against the pooled KoboldClient, on the mock server.
+def bench_client(args):
+    calls = args.calls
+    server = mock_kobold.start(port=0)
+    base_url = server.base_url
+    client = kobold_api.KoboldClient(base_url)
+    text = 'The quick brown fox jumps over the lazy dog. ' * 20
+    client.token_count(text)    #Warm up the pool so the first connection isn't counted.
+    results = {
+        'bare_requests': _time_calls(lambda: requests.post(base_url + kobold_api.TOKEN_COUNT_PATH, json={'prompt': text}), calls),
+        'kobold_client': _time_calls(lambda: client.token_count(text), calls),
+    }
+    client.close()
+    server.shutdown()
+    return results
+
+#Builds a stream that looks like what kobold.cpp sends back, including some multi-byte characters so the chunk boundaries split them.
+def recorded_stream(tokens):
+    words = [' the', ' café', ' 🐉', ' naïve', '\n', ' résumé', ' and', ' 日本']
+    events = [f'event: message\ndata: {json.dumps({"token": words[i % len(words)], "finish_reason": None})}\n\n' for i in range(tokens - 1)]
+    events.append(f'event: message\ndata: {json.dumps({"token": "", "finish_reason": "length"})}\n\n')
+    return ''.join(events).encode()
+
+def bench_parser(args):
+    stream = recorded_stream(args.tokens)
+    results = {'tokens': args.tokens, 'bytes': len(stream)}
+    for chunk_size in (16, 1024, kobold_api.STREAM_CHUNK_SIZE):
+        chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+        start = time.perf_counter()
+        count = sum(1 for _ in kobold_api.iter_tokens(chunks))
+        elapsed = time.perf_counter() - start
+        assert count == args.tokens
+        results[f'chunk_{chunk_size}'] = {'seconds': elapsed, 'tokens_per_second': count / elapsed, 'mb_per_second': len(stream) / elapsed / 1e6}
+    return results
+
+#What generating does to a story: append one token at a time, and take the end of it for the prompt after each one. It compares a plain str, which is what Project.story used to be, against the StoryBuffer it is now.
+#The str case is an attribute on an object, like project.story was, so Python can't cheat and append in place.
+def bench_story(args):
+    class Holder:
+        pass
+    tail_length = kobold_api.baseSettings['max_context_length'] * 8
+    results = {}
+    for size in args.buffer_sizes:
+        text = ('Once upon a time, there was a story. ' * (size // 37 + 1))[:size]
+        size_results = {}
+        for name, story in (('str', Holder()), ('story_buffer', Project())):
+            story.story = text
+            append_times = []
+            tail_times = []
+            for i in range(args.appends):
+                start = time.perf_counter()
+                story.story += ' word'
+                append_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                story.story[-tail_length:]
+                tail_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            full = str(story.story)
+            materialize = time.perf_counter() - start
+            assert len(full) == size + 5 * args.appends
+            size_results[name] = {'append': _percentiles(append_times), 'tail': _percentiles(tail_times), 'materialize_ms': 1000 * materialize}
+        results[f'story_{size}'] = size_results
+    return results
+
+#What an autosave costs after a token is generated in one story, in an archive of --projects stories of --buffer-sizes characters each. It compares writing the whole thing with json.dump, which is what saving used to do, against appending to the journal.
+def bench_save(args):
+    from save_journal import SaveJournal
+    results = {}
+    for size in args.buffer_sizes:
+        directory = tempfile.mkdtemp()
+        journal = SaveJournal(directory)
+        journal.load()
+        text = ('Once upon a time, there was a story. ' * (size // 37 + 1))[:size]
+        Project.open_projects = []
+        for i in range(args.projects):
+            project = Project()
+            project.name = f'Story {i}'
+            project.story = text
+            Project.named_projects[project.name.lower()] = project
+            Project.open_projects.append(project)
+        journal.compact()
+        journal.compacting.join()
+        project = Project.open_projects[0]
+        def dump():
+            with open(os.path.join(directory, 'full.json'), 'w') as outfile:
+                json.dump(Project.all_to_dictionary(), outfile, indent = 4)
+        def append():
+            project.story += ' word'
+            journal.save()
+        results[f'story_{size}'] = {
+            'projects': args.projects,
+            'full_dump': _time_calls(dump, 5),
+            'journal': _time_calls(append, args.appends),
+            'journal_bytes': journal.journal_size,
+        }
+        journal.close()
+        #Starting up only reads the index and the journal, however big the stories are.
+        def startup():
+            loaded = SaveJournal(directory)
+            loaded.load()
+            loaded.journal.close()
+        results[f'story_{size}']['startup'] = _time_calls(startup, 5)
+    return results
+
+#Imports a KoboldAI Lite save for each of --buffer-sizes characters of story, split into actions of 20 words each like Lite saves a generation at a time, and exports it again. Peak memory is what tracemalloc saw Python allocate, to compare against the file size.
+def bench_lite(args):
+    import tracemalloc
+    from save_journal import SaveJournal
+    from kobold_lite import Importer, export_project
+    results = {}
+    for size in args.buffer_sizes:
+        directory = tempfile.mkdtemp()
+        journal = SaveJournal(directory)
+        journal.load()
+        words = mock_kobold.WORDS
+        actions = [''.join(' ' + words[(i + j) % len(words)] for j in range(20)) for i in range(size // 120)]
+        world_info = [{'key': f'Character {i}', 'content': f'Character {i} is a character. ' * 20, 'comment': '', 'constant': i % 2 == 0} for i in range(100)]
+        path = os.path.join(directory, 'Lite save.json')
+        with open(path, 'w') as outfile:
+            json.dump({'gamestarted': True, 'prompt': 'Once upon a time', 'memory': 'A story.', 'actions': actions, 'worldinfo': world_info}, outfile)
+        del actions
+        importer = Importer(journal)
+        importer.import_files([path])
+        #Again with tracemalloc, which slows it down too much to time it at the same time. The characters are all there already this time.
+        again = Importer(journal)
+        tracemalloc.start()
+        again.import_files([path])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        project = Project.named_projects['lite save']
+        start = time.perf_counter()
+        exported = export_project(project, os.path.join(directory, 'export.json'))
+        export_seconds = time.perf_counter() - start
+        journal.close()
+        megabytes = importer.bytes / 1024 / 1024
+        results[f'story_{size}'] = {
+            'file_mb': megabytes,
+            'import_mb_per_s': megabytes / importer.seconds,
+            'import_peak_mb': peak / 1024 / 1024,
+            'characters_added': importer.characters_added + again.characters_added,
+            'characters_reused': importer.characters_reused + again.characters_reused,
+            'export_mb_per_s': exported / 1024 / 1024 / export_seconds,
+        }
+    return results
+
+#Builds --versions versions of a story of each of --buffer-sizes characters, alternating between sending a command and generating a reply, with an edit somewhere in the middle now and then. Then restores random versions.
+def bench_history(args):
+    import random
+    from story_buffer import StoryBuffer
+    from story_history import StoryHistory
+    results = {}
+    words = mock_kobold.WORDS
+    for size in args.buffer_sizes:
+        random.seed(0)
+        #Random words, so the keyframes don't compress any better than a real story would.
+        story = StoryBuffer(''.join(' ' + random.choice(words) for _ in range(size // 6))[:size])
+        history = StoryHistory()
+        snapshot_times = []
+        for version in range(args.versions):
+            if version % 2 == 0:
+                story += f'\n\nYou: {random.choice(words)} {random.choice(words)}\n\n'
+            else:
+                story += ''.join(' ' + random.choice(words) for _ in range(100))
+            if version % 10 == 0:
+                story.replace(random.randrange(len(story)), 5, random.choice(words))
+            start = time.perf_counter()
+            history.snapshot(story, 'Generated')
+            snapshot_times.append(time.perf_counter() - start)
+        indices = [random.randrange(len(history)) for _ in range(50)]
+        restore_times = []
+        for index in indices:
+            start = time.perf_counter()
+            history.text(index)
+            restore_times.append(time.perf_counter() - start)
+        results[f'story_{size}'] = {
+            'versions': len(history),
+            'keyframes': len(history.keyframes),
+            'history_mb': history.size() / 1024 / 1024,
+            'uncompressed_mb': sum(length for seconds, label, length in history.versions) / 1024 / 1024,
+            'snapshot': _percentiles(snapshot_times),
+            'restore': _percentiles(restore_times),
+        }
+    return results
+
+#Makes --branches forks of a story of each of --buffer-sizes characters, each at a random point in the story or one of the last few forks, with up to 2000 characters added to it, while the story keeps going (and gets edited in the middle with --edit-parent). Memory is how many characters the chunks of all the stories add up to, counting shared ones once.
+def bench_fork(args):
+    import random
+    from save_journal import SaveJournal
+    results = {}
+    words = mock_kobold.WORDS
+    for size in args.buffer_sizes:
+        random.seed(0)
+        directory = tempfile.mkdtemp()
+        journal = SaveJournal(directory)
+        journal.load()
+        root = Project.open_projects[0]
+        root.story = ''.join(' ' + random.choice(words) for _ in range(size // 6))[:size]
+        journal.compact()
+        journal.compacting.join()
+        journal_start = journal.journal_size
+        forks = []
+        tails = 0
+        start = time.perf_counter()
+        for i in range(args.branches):
+            source = random.choice([root] + forks[-5:])
+            fork = source.fork(random.randrange(len(source.story)))
+            tail = ''.join(' ' + random.choice(words) for _ in range(random.randrange(2000) // 6))
+            fork.story += tail
+            tails += len(tail)
+            forks.append(fork)
+            Project.open_projects.append(fork)
+            root.story += ' ' + random.choice(words)
+            if args.edit_parent:
+                root.story.replace(random.randrange(len(root.story)), 5, random.choice(words))
+        fork_seconds = time.perf_counter() - start
+        journal.save()
+        def memory():
+            chunks = {id(chunk): len(chunk) for project in Project.open_projects for chunk in project.story.chunks()}
+            return sum(chunks.values()) / 1024 / 1024
+        results[f'story_{size}'] = {
+            'branches': args.branches,
+            'fork_ms': fork_seconds / args.branches * 1000,
+            'total_mb': sum(len(project.story) for project in Project.open_projects) / 1024 / 1024,
+            'memory_mb': memory(),
+            'tails_mb': tails / 1024 / 1024,
+            'journal_mb': (journal.journal_size - journal_start) / 1024 / 1024,
+            'dictionary_mb': len(json.dumps(Project.all_to_dictionary())) / 1024 / 1024,
+        }
+        journal.close()
+        #The dictionary only has each fork's pieces of its parent, and loading it shares the chunks again.
+        Project.load_from_dictionary(json.loads(json.dumps(Project.all_to_dictionary())))
+        results[f'story_{size}']['reloaded_memory_mb'] = memory()
+    return results
+
+#Searches --characters characters with made-up names and 60 word descriptions, compared against matching just the names with fnmatch. The words are random letters, used more or less often the way words in real text are (the nth most common one about 1/n as often as the most common one). Update is adding to a description and searching again.
+def bench_characters(args):
+    import random
+    import string
+    import itertools
+    from narrative_data import Character
+    from character_index import CharacterIndex
+    random.seed(0)
+    vocabulary = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 10))) for _ in range(20000)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    def words(count):
+        return ' '.join(random.choices(vocabulary, cum_weights=weights, k=count))
+    characters = [Character(f'{words(1).title()} {words(1).title()}', words(60)) for i in range(args.characters)]
+    index = CharacterIndex()
+    start = time.perf_counter()
+    index.build(characters)
+    build_seconds = time.perf_counter() - start
+    queries = {
+        #Parts of words, like while they're still being typed.
+        'one_word': [random.choice(vocabulary)[:random.randint(3, 6)] for _ in range(args.calls)],
+        'two_words': [f'{random.choice(vocabulary)[:random.randint(3, 6)]} {random.choice(vocabulary)[:random.randint(3, 6)]}' for _ in range(args.calls)],
+        'name': [random.choice(characters).name.split()[0] for _ in range(args.calls)],
+        'short': [random.choice(string.ascii_lowercase) * random.randint(1, 2) for _ in range(min(args.calls, 50))],
+    }
+    results = {'characters': len(characters), 'build_ms': build_seconds * 1000, 'words': len(index.descriptions), 'trigrams': len(index.trigrams)}
+    for name, texts in queries.items():
+        texts = iter(texts)
+        found = []
+        results[name] = _time_calls(lambda: found.append(len(index.search(next(texts), characters))), len(queries[name]))
+        results[name]['mean_results'] = sum(found) / len(found)
+    #What character_search() used to do, which only looked at names.
+    from fnmatch import fnmatch
+    names = {character.name.lower(): character for character in characters}
+    texts = iter(queries['one_word'])
+    def old_search():
+        pattern = f'*{next(texts)}*'
+        return [character for name, character in names.items() if fnmatch(name, pattern)]
+    results['fnmatch_names'] = _time_calls(old_search, min(args.calls, 50))
+    def update():
+        character = random.choice(characters)
+        character.description += ' ' + words(5)
+        index.changed(character)
+        index.search(random.choice(vocabulary)[:4], characters)
+    results['update'] = _time_calls(update, args.calls)
+    return results
+
+#Full-text search over --search-projects stories of --search-size characters each. The index gets written by compacting, then searched from a fresh load like at startup.
+def bench_search(args):
+    import random
+    import string
+    import itertools
+    from save_journal import SaveJournal
+    from story_search import StorySearch, SEARCH_DIRECTORY
+    random.seed(0)
+    vocabulary = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 10))) for _ in range(20000)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    def words(count):
+        return ' '.join(random.choices(vocabulary, cum_weights=weights, k=count))
+    directory = tempfile.mkdtemp()
+    journal = SaveJournal(directory)
+    journal.load()
+    Project.named_projects = {}
+    Project.open_projects = []
+    for i in range(args.search_projects):
+        project = Project()
+        project.name = f'{words(2).title()} {i}'
+        project.memory = words(50)
+        project.story = words(args.search_size // 6)
+        Project.named_projects[project.name.lower()] = project
+    Project.open_projects = [project]
+    text_bytes = sum(len(project.story) + len(project.memory) for project in Project.named_projects.values())
+    start = time.perf_counter()
+    journal.compact()
+    journal.compacting.join()
+    compact_seconds = time.perf_counter() - start
+    journal.close()
+    index_directory = os.path.join(directory, SEARCH_DIRECTORY)
+    results = {
+        'projects': args.search_projects,
+        'text_bytes': text_bytes,
+        'index_bytes': sum(os.path.getsize(os.path.join(index_directory, file_name)) for file_name in os.listdir(index_directory)),
+        'compact_ms': compact_seconds * 1000,
+    }
+    Project.start_empty()
+    journal = SaveJournal(directory)
+    start = time.perf_counter()
+    journal.load()
+    search = StorySearch(journal)
+    results['load_ms'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    search.search(random.choice(vocabulary))
+    results['first_search_ms'] = (time.perf_counter() - start) * 1000
+    queries = {
+        #Parts of words, like while they're still being typed.
+        'one_word': [random.choice(vocabulary)[:random.randint(3, 6)] for _ in range(args.calls)],
+        'two_words': [f'{random.choice(vocabulary)} {random.choice(vocabulary)[:random.randint(3, 6)]}' for _ in range(args.calls)],
+        #Words near the end of the vocabulary are rare, like a place that's only in a few stories.
+        'rare_word': [random.choice(vocabulary[-2000:]) for _ in range(args.calls)],
+        'short': [random.choice(string.ascii_lowercase) for _ in range(min(args.calls, 50))],
+    }
+    for name, texts in queries.items():
+        texts = iter(texts)
+        found = []
+        results[name] = _time_calls(lambda: found.append(len(search.search(next(texts)))), len(queries[name]))
+        results[name]['mean_results'] = sum(found) / len(found)
+    #What project_filter() used to do, which only looked at names.
+    from fnmatch import fnmatch
+    texts = iter(queries['one_word'])
+    def old_search():
+        pattern = f'*{next(texts)}*'
+        return [project for name, project in Project.named_projects.items() if fnmatch(name, pattern)]
+    results['fnmatch_names'] = _time_calls(old_search, min(args.calls, 50))
+    #Appending to a story makes it fresh, so the next search indexes it from memory, a chunk at a time.
+    project = Project.open_projects[0]
+    def append():
+        project.story.append(' ' + words(20))
+        journal.save()
+        search.search(random.choice(vocabulary)[:4])
+    results['append_and_search'] = _time_calls(append, min(args.calls, 200))
+    results['fresh_documents'] = len(search.fresh)
+    journal.close()
+    return results
+
+#Times a real stream from the mock server, as a list of (seconds since it started, token).
+def record_trace(tokens, tokens_per_second):
+    server = mock_kobold.start(port=0, tokens_per_second=tokens_per_second)
+    client = kobold_api.KoboldClient(server.base_url)
+    trace = []
+    start = time.perf_counter()
+    client.stream(lambda token, done: trace.append((time.perf_counter() - start, token)), {'prompt': 'Once upon a time', 'max_length': tokens})
+    client.close()
+    server.shutdown()
+    return [(seconds - trace[0][0], token) for seconds, token in trace if token]
+
+#Made-up streams for what the mock server doesn't do. Bursty is a server or proxy that sends tokens in clumps, and stall is one that stops for two seconds partway through.
+def bursty_trace(tokens, tokens_per_second, burst=6):
+    words = mock_kobold.WORDS
+    return [((i // burst) * burst / tokens_per_second, words[i % len(words)]) for i in range(tokens)]
+
+def stall_trace(tokens, tokens_per_second, stall=2):
+    words = mock_kobold.WORDS
+    return [(i / tokens_per_second + (stall if i >= tokens // 2 else 0), words[i % len(words)]) for i in range(tokens)]
+
+def simulate_pacing(pacer, trace):
+    """
+    Runs a trace through a pacer the way TypingWorker does, on a simulated clock instead of a timer, and returns a list of (time, text) for each write.
+
+    It follows TypingWorker._receive and _type_next, including rounding waits down to whole milliseconds like QTimer does.
+    """
+    import typing_worker
+    text = ''
+    index = 0
+    start_time = None
+    deadline = None
+    writes = []
+    arrivals = collections.deque(trace)
+    def type_next(now):
+        nonlocal index, start_time, deadline
+        start_time = now
+        start = index
+        while True:
+            index += 1
+            pacer.typed(1)
+            wait_time = pacer.delay(start_time, completing)
+            if wait_time is None or wait_time >= typing_worker.MIN_TYPING_TIME:
+                break
+        writes.append((now, text[start:index]))
+        if wait_time is None:
+            start_time = deadline = None
+        else:
+            deadline = now + int(max(0, wait_time) * 1000) / 1000
+    while arrivals or index < len(text):
+        if arrivals and (deadline is None or arrivals[0][0] <= deadline):
+            now, token = arrivals.popleft()
+            completing = not arrivals
+            text += token
+            pacer.received(len(token), now)
+            if not pacer.animated:
+                writes.append((now, text[index:]))
+                pacer.typed(len(text) - index)
+                index = len(text)
+            elif start_time is not None:
+                deadline = max(now, start_time + int(max(0, pacer.delay(start_time, completing)) * 1000) / 1000)
+            else:
+                type_next(now)
+        else:
+            type_next(deadline)
+    return writes
+
+#Replays arrival traces through each pacer in typing_worker.PACERS and measures:
+#latency: from when each character arrived until it was written.
+#write gap cv: how uneven the time between writes is (standard deviation / mean). Lower looks smoother. 0 is perfectly even.
+#largest write: the most characters that showed up at once.
+#finish lag: from the last token arriving until it's all written.
+def bench_pacing(args):
+    import typing_worker
+    traces = {
+        'mock': record_trace(args.gen_tokens, args.tps),
+        'bursty': bursty_trace(args.gen_tokens, args.tps),
+        'stall': stall_trace(args.gen_tokens, args.tps),
+    }
+    if args.trace:
+        with open(args.trace) as infile:
+            traces[os.path.basename(args.trace)] = [tuple(arrival) for arrival in json.load(infile)]
+    results = {}
+    for trace_name, trace in traces.items():
+        trace_results = {}
+        for pacer_name, pacer_class in typing_worker.PACERS.items():
+            writes = simulate_pacing(pacer_class(), trace)
+            assert ''.join(text for _, text in writes) == ''.join(token for _, token in trace)
+            arrived = [seconds for seconds, token in trace for _ in token]
+            written = [seconds for seconds, text in writes for _ in text]
+            gaps = [later[0] - earlier[0] for earlier, later in zip(writes, writes[1:])]
+            mean = sum(gaps) / max(1, len(gaps))
+            deviation = (sum((gap - mean) ** 2 for gap in gaps) / max(1, len(gaps))) ** 0.5
+            latencies = [end - start for start, end in zip(arrived, written)]
+            if pacer_name == 'adaptive':
+                assert max(latencies) <= typing_worker.MAX_DISPLAY_LATENCY, (trace_name, max(latencies))
+            elif pacer_name == 'none':
+                #Each token gets written as soon as it comes in.
+                assert writes == [(seconds, token) for seconds, token in trace if token], trace_name
+                assert not any(latencies), trace_name
+            trace_results[pacer_name] = {
+                'latency': _percentiles(latencies),
+                'writes': len(writes),
+                'write_gap_cv': deviation / mean if mean else 0,
+                'largest_write': max(len(text) for _, text in writes),
+                'finish_lag_ms': 1000 * (writes[-1][0] - trace[-1][0]),
+            }
+        results[trace_name] = trace_results
+    return results
+
+#Starts the whole app in a new process, like running it cold, with a save that has --projects open tabs of each of --buffer-sizes characters, and reports the startup times (see startup_timing.py) from the fastest of three runs. The app quits once it's read the other tabs.
+STARTUP_SCRIPT = """
+import sys, json
+sys.path.insert(0, sys.argv[1])
+import startup_timing
+import app_controller
+from PySide6.QtCore import QTimer
+controller = app_controller.Controller()
+def finish():
+    if controller.journal.preloading is None or controller.journal.preloading.is_alive():
+        QTimer.singleShot(10, finish)
+    else:
+        controller.ui.app.quit()
+finish()
+controller.ui.app.exec()
+controller.close()
+controller._stop_typing_thread()
+print(json.dumps(startup_timing.times()))
+"""
+
+def bench_startup(args):
+    import random
+    from save_journal import SaveJournal
+    results = {}
+    words = mock_kobold.WORDS
+    environment = dict(os.environ, KOBOLDUI_STARTUP_TIMES='1')
+    environment.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    for size in args.buffer_sizes:
+        random.seed(0)
+        directory = tempfile.mkdtemp()
+        journal = SaveJournal(directory)
+        journal.load()
+        Project.open_projects = []
+        for i in range(args.projects):
+            project = Project()
+            project.name = f'Story {i}'
+            project.story = ''.join(' ' + random.choice(words) for _ in range(size // 6))
+            Project.named_projects[project.name.lower()] = project
+            Project.open_projects.append(project)
+        journal.compact()
+        journal.compacting.join()
+        journal.close()
+        runs = []
+        for run in range(3):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, os.path.dirname(os.path.abspath(__file__))], cwd=directory, env=environment, capture_output=True, text=True, check=True).stdout
+            seconds = time.perf_counter() - start
+            runs.append((seconds, {label: milliseconds for label, milliseconds, thread in json.loads(output.splitlines()[-1])}))
+        seconds, times = min(runs, key=lambda run: run[0])
+        results[f'story_{size}'] = {'tabs': args.projects, 'process_ms': seconds * 1000, **times}
+    return results
+
+#The main thread should get back to its event loop at least this often. Any gap longer than this counts as a stall.
+STALL_THRESHOLD = 0.05
+STALL_TIMER_INTERVAL = 5   #ms
+
+def start_mock_process(tokens_per_second):
+    """Runs the mock server in its own process, so its CPU time doesn't get counted as the UI's. It picks a free port, and says which once it's listening. Returns the process and the server's URL."""
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_kobold.py'), '--port', '0', '--tps', str(tokens_per_second)], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith('Mock kobold.cpp listening on '):
+        process.kill()
+        raise RuntimeError("The mock server didn't start.")
+    return process, line.split()[-1]
+
+#Runs generations through the app's EndpointPool and GenerationScheduler on --servers mock servers in this process, and checks the pool does what it says. The jobs are for tabs that aren't showing, so they go through Controller._generate and write their text straight in, which is the path where a failure has to be noted before the job's finished.
+#spread: a batch of jobs for different projects uses every server.
+#affinity: a project's next job goes back to the server it last used, when that one's free.
+#failover: after a server gets killed, the jobs that try it fail, go back in the queue and finish on the others.
+#recovery: once it's back up, a health check puts it back in use.
+#dropped: jobs on a server that cuts every generation off partway through finish the rest of it on the others.
+#give_up: a job that keeps failing stops after MAX_ATTEMPTS tries, even if its server keeps looking healthy in between.
+def bench_pool(args):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6 import QtAsyncio
+    from app_controller import Controller
+    from generation_scheduler import GenerationJob, DONE, MAX_ATTEMPTS
+    tokens = 20
+    servers = [mock_kobold.start(port=0, tokens_per_second=args.tps, time_to_first_token=0.05, seed=i) for i in range(args.servers)]
+    urls = [server.base_url for server in servers]
+    working_directory = os.getcwd()
+    #The controller loads and saves save.json in the working directory, so keep it away from the real one.
+    os.chdir(tempfile.mkdtemp())
+    results = {}
+    try:
+        controller = Controller()
+        pool = controller.endpoints
+        scheduler = controller.scheduler
+        pool.set_endpoints(urls)
+        runs = []   #(project, the url of the server it ran on) for each time a job started
+        start_job = scheduler.start_job
+        def record_start(job):
+            runs.append((job.project, job.client.base_url))
+            start_job(job)
+        scheduler.start_job = record_start
+        for _ in range(3 * args.servers):
+            controller.new_tab()
+        projects = [project for project in Project.open_projects if project is not controller.project][:3 * args.servers]
+        for project in projects:
+            project.story = 'Once upon a time'
+
+        async def run(batch):
+            del runs[:]
+            jobs = [GenerationJob(project, '', [], tokens, 0.7, []) for project in batch]
+            lengths = [len(project.story) for project in batch]
+            start = time.perf_counter()
+            for job in jobs:
+                scheduler.submit(job)
+            while any(job.status != DONE for job in jobs):
+                await asyncio.sleep(0.01)
+            for job, length in zip(jobs, lengths):
+                #Every token went into the story exactly once, including the ones from before a failure.
+                assert len(job.project.story) > length and job.project.history.versions[-1][1] == 'Generated', job.project.history.versions[-1]
+            return jobs, time.perf_counter() - start
+
+        def finished_all(jobs):
+            return all(job.tokens_generated == tokens for job in jobs)
+
+        async def run_all():
+            jobs, seconds = await run(projects)
+            spread = collections.Counter(url for project, url in runs)
+            assert set(spread) == set(urls), spread
+            assert finished_all(jobs)
+            results['spread'] = {'jobs': len(jobs), 'seconds': seconds, 'jobs_per_server': sorted(spread.values())}
+
+            #One at a time, so the server each one used last is always free.
+            last = {project: pool.affinity[project].base_url for project in projects}
+            returned = 0
+            for project in projects:
+                await run([project])
+                returned += runs[0][1] == last[project]
+            assert returned == len(projects), returned
+            results['affinity'] = {'returned': returned, 'projects': len(projects)}
+
+            killed = servers[0]
+            killed.kill()
+            jobs, seconds = await run(projects)
+            assert finished_all(jobs)
+            failed_over = [job for job in jobs if job.failures > 0]
+            #The ones that tried the killed server tried again somewhere else.
+            last_runs = {project: url for project, url in runs}
+            assert failed_over and killed.base_url not in last_runs.values(), runs
+            results['failover'] = {'seconds': seconds, 'jobs_failed_over': len(failed_over), 'attempts': len(runs)}
+
+            servers[0] = mock_kobold.start(port=killed.server_port, tokens_per_second=args.tps, time_to_first_token=0.05)
+            await pool.check_health()
+            assert len(pool.healthy()) == len(servers)
+            jobs, seconds = await run(projects[:len(servers)])
+            assert killed.base_url in {url for project, url in runs}, runs
+            results['recovery'] = {'seconds': seconds, 'servers_used': len({url for project, url in runs})}
+
+            servers[0].drop_rate = 1
+            #Each one goes back to the server it used last, so send them to the dropping one first.
+            batch = [project for project in projects if pool.affinity[project].base_url == killed.base_url]
+            jobs, seconds = await run(batch)
+            assert finished_all(jobs) and all(job.failures > 0 for job in jobs), [(job.tokens_generated, job.failures) for job in jobs]
+            results['dropped'] = {'seconds': seconds, 'jobs': len(jobs), 'attempts': len(runs)}
+
+            servers[0].kill()
+            dead = next(client for client in pool.clients if client.base_url == killed.base_url)
+            pool.set_endpoints([killed.base_url])
+            job = GenerationJob(projects[0], '', [], tokens, 0.7, [])
+            scheduler.submit(job)
+            while job.status != DONE:
+                #A server that answers health checks but fails every generation.
+                if job in scheduler.queue:
+                    dead.healthy = True
+                    scheduler.schedule()
+                await asyncio.sleep(0.01)
+            assert job.failures == MAX_ATTEMPTS and job.tokens_generated == 0
+            results['give_up'] = {'attempts': job.failures}
+
+        QtAsyncio.run(run_all(), keep_running=False)
+    finally:
+        os.chdir(working_directory)
+        for server in servers[1:]:
+            server.shutdown()
+            server.server_close()
+    return results
+
+#Drives the whole app headlessly against the mock server. For each story size, it generates once and measures:
+#time to first token: from Send until the first generated text is in the story area.
+#arrival to paint: from when each character arrives from the server until it's in the story area. This includes the typing animation's deliberate delay.
+#stalls: how long the main thread went without getting back to its event loop.
+#cpu per token: CPU time of this process (not the server's) per generated token.
+def bench_e2e(args):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6 import QtAsyncio
+    from PySide6.QtCore import QTimer
+    from app_controller import Controller
+
+    server, base_url = start_mock_process(args.tps)
+    working_directory = os.getcwd()
+    #The controller loads and saves save.json in the working directory, so keep it away from the real one.
+    os.chdir(tempfile.mkdtemp())
+    results = {}
+    try:
+        controller = Controller()
+        controller.endpoints.set_endpoints([base_url])
+        controller.ui.max_tokens.setText(str(args.gen_tokens))
+
+        async def run_all():
+            for size in args.story_sizes:
+                results[f'story_{size}'] = await run_one(size)
+
+        async def run_one(size):
+            project = controller.project
+            project.story = ('Once upon a time, there was a story. ' * (size // 37 + 1))[:size]
+            #Drop the old document so the project gets a new one with the new story.
+            controller.ui.documents.discard(project)
+            controller.populate_gui(project)
+            document = controller.ui.story_area.document()
+            await asyncio.sleep(0.5)
+
+            arrivals = collections.deque()  #[time, characters not painted yet]
+            latencies = []
+            first_paint = [None]
+            tokens = [0]
+            original_receive = controller._receive
+            def receive(job, token, done):
+                if token:
+                    arrivals.append([time.perf_counter(), len(token)])
+                    tokens[0] += 1
+                original_receive(job, token, done)
+            controller._receive = receive
+            def painted(position, removed, added):
+                now = time.perf_counter()
+                if first_paint[0] is None and added > 0:
+                    first_paint[0] = now
+                while added > 0 and arrivals:
+                    arrival = arrivals[0]
+                    count = min(added, arrival[1])
+                    latencies.extend([now - arrival[0]] * count)
+                    arrival[1] -= count
+                    added -= count
+                    if arrival[1] == 0:
+                        arrivals.popleft()
+            document.contentsChange.connect(painted)
+
+            ticks = []
+            timer = QTimer()
+            timer.timeout.connect(lambda: ticks.append(time.perf_counter()))
+            timer.start(STALL_TIMER_INTERVAL)
+
+            cpu_start = time.process_time()
+            send_time = time.perf_counter()
+            controller.handle_send()
+            while controller.scheduler.job_for(project) is not None:
+                await asyncio.sleep(0.05)
+            cpu = time.process_time() - cpu_start
+
+            timer.stop()
+            document.contentsChange.disconnect(painted)
+            controller._receive = original_receive
+            gaps = [later - earlier for earlier, later in zip(ticks, ticks[1:])]
+            stalls = [gap for gap in gaps if gap > STALL_THRESHOLD]
+            return {
+                'story_characters': size,
+                'tokens': tokens[0],
+                'time_to_first_token_ms': None if first_paint[0] is None else 1000 * (first_paint[0] - send_time),
+                'arrival_to_paint': _percentiles(latencies),
+                'stall_count': len(stalls),
+                'stall_total_ms': 1000 * sum(stalls),
+                'longest_gap_ms': 1000 * max(gaps, default=0),
+                'cpu_ms_per_token': 1000 * cpu / max(1, tokens[0]),
+            }
+
+        QtAsyncio.run(run_all(), keep_running=False)
+    finally:
+        os.chdir(working_directory)
+        server.kill()
+    return results
+
+BENCHMARKS = {
+    'client': bench_client,
+    'parser': bench_parser,
+    'story': bench_story,
+    'save': bench_save,
+    'lite': bench_lite,
+    'history': bench_history,
+    'fork': bench_fork,
+    'characters': bench_characters,
+    'search': bench_search,
+    'startup': bench_startup,
+    'pacing': bench_pacing,
+    'e2e': bench_e2e,
+    'pool': bench_pool,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for KoboldUI.')
+    parser.add_argument('names', nargs='*', default=list(BENCHMARKS), help='Which benchmarks to run. Runs all of them by default.')
+    parser.add_argument('--calls', type=int, default=1000, help='How many calls to time per case.')
+    parser.add_argument('--tokens', type=int, default=100000, help='How many tokens are in the recorded streams.')
+    parser.add_argument('--tps', type=float, default=50, help='Tokens per second from the mock server, for the end-to-end and pacing benchmarks.')
+    parser.add_argument('--gen-tokens', type=int, default=200, help='How many tokens to generate per story size for the end-to-end benchmark, and per trace for the pacing benchmark.')
+    parser.add_argument('--story-sizes', type=int, nargs='+', default=[1000, 100000, 1000000], help='Story sizes in characters, for the end-to-end benchmark.')
+    parser.add_argument('--buffer-sizes', type=int, nargs='+', default=[1000000, 10000000], help='Story sizes in characters, for the story buffer, save, Lite import, history, fork and startup benchmarks.')
+    parser.add_argument('--projects', type=int, default=10, help='How many stories are in the archive, for the save benchmark, and how many tabs are open, for the startup benchmark.')
+    parser.add_argument('--versions', type=int, default=2000, help='How many versions of each story to keep, for the history benchmark.')
+    parser.add_argument('--branches', type=int, default=100, help='How many forks to make of each story, for the fork benchmark.')
+    parser.add_argument('--edit-parent', action='store_true', help='Edit the story being forked somewhere in the middle after each fork, for the fork benchmark. Each edit copies the chunk it\'s in, and the forks keep the old one.')
+    parser.add_argument('--characters', type=int, default=50000, help='How many characters to search, for the character search benchmark.')
+    parser.add_argument('--servers', type=int, default=3, help='How many mock servers to spread generations across, for the endpoint pool benchmark.')
+    parser.add_argument('--search-projects', type=int, default=2000, help='How many stories to search, for the full-text search benchmark.')
+    parser.add_argument('--search-size', type=int, default=20000, help='How long each of those stories is, in characters.')
+    parser.add_argument('--appends', type=int, default=2000, help='How many tokens to append per story size, for the story buffer and save benchmarks.')
+    parser.add_argument('--trace', help='A JSON file with a list of [seconds, token] arrivals to replay, for the pacing benchmark, on top of the built-in ones.')
+    parser.add_argument('--output', help='Also write the results to this JSON file, to compare against later runs.')
+    args = parser.parse_args()
+    results = {name: BENCHMARKS[name](args) for name in args.names}
+    json.dump(results, sys.stdout, indent=4)
+    print()
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import bisect
+import heapq
+from array import array
+
+#Each word of a search counts this much toward a character's rank if a word in their name starts with it, or half that if it's somewhere else in their name. Words only in the description don't add anything, so name hits come first.
+NAME_SCORE = 2
+#At most this many characters come back from a search. The list can't usefully show more than that, and ranking just these is a lot cheaper than sorting everything that matches.
+RESULT_LIMIT = 100
+
+def _trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+#Every one and two characters in a row in word.
+def _short_pieces(word):
+    return {word[i:i + length] for length in (1, 2) for i in range(len(word) - length + 1)}
+
+def _words(text):
+    return set(text.lower().split())
+
+#The first one and two characters of each word in name.
+def _name_prefixes(name):
+    return {word[:length] for word in _words(name) for length in (1, 2)}
+
+class CharacterIndex:
+    """
+    Finds characters with every word of a search somewhere in their name or description, without looking through all of them.
+
+    Names and descriptions get split into words at whitespace, lowercased, and each word maps to a sorted array of the ids of the characters with it in their name, and another for their description. A search word can be any part of one of those, so there's a trigram index over the words themselves too: every three characters in a row maps to the words that have them. Each search word finds the words with all of its trigrams, checks that it's really in them, and takes everyone with any of those words. That only costs as much as how many words and characters match. Search words shorter than three characters don't have any trigrams, so there's a table of every one and two characters in a row too, which gives their words straight away.
+
+    A search for just one or two letters, like when someone starts typing, matches nearly everyone, and working all of them out would take a while. Only the first RESULT_LIMIT get shown though, and the ones with a word in their name starting with it come first, so there's one more table: the first one and two letters of each word in a name, to everyone with one, already in order by name. If that has more than enough of them, they're the results.
+
+    It's built the first time there's a search, and kept up to date by add(), remove() and changed() after that.
+    """
+    def __init__(self):
+        self.built = False
+        self.entries = []       #id: (character, their name, their description) as of when they were last indexed, or None if they were removed
+        self.sort_names = []    #id: their name lowercased, to sort results by
+        self.ids = {}           #character: id
+        self.names = {}         #word: array of the ids of the characters with it in their name, smallest first
+        self.descriptions = {}  #word: the same, for descriptions
+        self.trigrams = {}      #trigram: set of the words in either of those with it in them
+        self.short = {}         #one or two characters: the same
+        self.prefixes = {}      #the first one or two characters of a word in someone's name: array of the ids of everyone with one, in order of their sort_names
+        self.stale = set()      #Characters whose name or description changed since they were indexed. They get indexed again before the next search.
+        self.more = False       #Whether the last search matched more characters than it returned.
+
+    def add(self, character):
+        if not self.built:
+            return
+        id = len(self.entries)
+        self.ids[character] = id
+        self.entries.append(None)
+        self.sort_names.append(None)
+        self._index(id, character)
+
+    def remove(self, character):
+        if not self.built:
+            return
+        self.stale.discard(character)
+        id = self.ids.pop(character)
+        old_character, name, description = self.entries[id]
+        self._update_postings(self.names, id, _words(name), set())
+        self._update_postings(self.descriptions, id, _words(description), set())
+        self._update_prefixes(id, name, '')
+        self.entries[id] = None
+        self.sort_names[id] = None
+
+    #Typing in a description changes it every keystroke, so this just notes it, and it only gets indexed again once there's a search.
+    def changed(self, character):
+        if self.built:
+            self.stale.add(character)
+
+    def search(self, text, characters, limit=RESULT_LIMIT):
+        """
+        The first limit characters with every word of text somewhere in their name or description, ignoring case, with the best matches first. Ones with the words in their name come first, especially at the start of a word in it, then the rest by name. self.more says whether there were any more than that.
+
+        characters is all of them (Project.all_characters.values()), to build the index from the first time.
+        """
+        if not self.built or len(self.ids) != len(characters):
+            #Adding them some other way, like loading a save, doesn't go through add(). Checking the count is cheap, and it catches that.
+            self.build(characters)
+        for character in self.stale:
+            self._index(self.ids[character], character)
+        self.stale.clear()
+        self.more = False
+        terms = list(dict.fromkeys(text.lower().split()))
+        if not terms:
+            return []
+        #The shortcuts that skip working out everyone it matches are only taken when they have more than limit, so there are more either way.
+        if len(terms) == 1 and len(terms[0]) < 3:
+            first = self.prefixes.get(terms[0], ())
+            if len(first) > limit:
+                self.more = True
+                entries = self.entries
+                return [entries[id][0] for id in first[:limit]]
+        matches = None
+        name_hits = []      #(ids with a word in their name starting with it, ids with it anywhere in their name) for each term
+        #Longer terms are in fewer words, so going through them first keeps the sets that get intersected small.
+        for term in sorted(terms, key=len, reverse=True):
+            words = self._words_containing(term)
+            starts = set()
+            in_name = set()
+            for word in words:
+                ids = self.names.get(word)
+                if ids is not None:
+                    in_name.update(ids)
+                    if word.startswith(term):
+                        starts.update(ids)
+            name_hits.append((starts, in_name))
+            #With just one word, everyone with it in their name comes before everyone else, so if there are more than enough of them, it doesn't matter who has it in their description.
+            if len(terms) == 1 and len(in_name) > limit:
+                matches = in_name
+                break
+            found = set()
+            for word in words:
+                ids = self.descriptions.get(word)
+                if ids is not None:
+                    found.update(ids if matches is None else matches.intersection(ids))
+            found |= in_name
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+        sort_names = self.sort_names
+        entries = self.entries
+        self.more = len(matches) > limit
+        if len(terms) == 1 and len(name_hits[0][0]) >= limit:
+            #Everyone with a word in their name starting with it scores the same, and better than everyone else.
+            return [entries[id][0] for id in heapq.nsmallest(limit, name_hits[0][0], key=sort_names.__getitem__)]
+        #Only name hits need scoring. Everyone else is just sorted by name after them.
+        scores = {}
+        for starts, in_name in name_hits:
+            for id in in_name & matches:
+                scores[id] = scores.get(id, 0) + (NAME_SCORE if id in starts else NAME_SCORE // 2)
+        ranked = heapq.nsmallest(limit, scores, key=lambda id: (-scores[id], sort_names[id]))
+        if len(ranked) < limit:
+            ranked += heapq.nsmallest(limit - len(ranked), matches.difference(scores), key=sort_names.__getitem__)
+        return [entries[id][0] for id in ranked]
+
+    def _words_containing(self, term):
+        if len(term) < 3:
+            return self.short.get(term, ())
+        grams = _trigrams(term)
+        words = min((self.trigrams.get(gram, ()) for gram in grams), key=len)
+        return [word for word in words if term in word]
+
+    def build(self, characters):
+        self.entries = []
+        self.sort_names = []
+        self.ids = {}
+        self.names = {}
+        self.descriptions = {}
+        self.trigrams = {}
+        self.short = {}
+        self.prefixes = {}
+        self.stale = set()
+        self.built = True
+        #The same as add() for each of them, but ids only go up here, so every word just gets appended.
+        for id, character in enumerate(characters):
+            self.ids[character] = id
+            self.entries.append((character, character.name, character.description))
+            self.sort_names.append(character.name.lower())
+            for postings, text in ((self.names, character.name), (self.descriptions, character.description)):
+                for word in _words(text):
+                    ids = postings.get(word)
+                    if ids is None:
+                        self._add_word(word)
+                        ids = postings[word] = array('I')
+                    ids.append(id)
+            for prefix in _name_prefixes(character.name):
+                self.prefixes.setdefault(prefix, []).append(id)
+        for prefix, ids in self.prefixes.items():
+            self.prefixes[prefix] = array('I', sorted(ids, key=self.sort_names.__getitem__))
+
+    #Only the words that the character gained or lost get touched, so a small edit to a long description stays cheap.
+    def _index(self, id, character):
+        old = self.entries[id]
+        old_name, old_description = ('', '') if old is None else old[1:]
+        if character.name != old_name:
+            self._update_postings(self.names, id, _words(old_name), _words(character.name))
+            self._update_prefixes(id, old_name, character.name)
+        if character.description != old_description:
+            self._update_postings(self.descriptions, id, _words(old_description), _words(character.description))
+        self.entries[id] = (character, character.name, character.description)
+        self.sort_names[id] = character.name.lower()
+
+    def _update_postings(self, postings, id, old, new):
+        for word in old - new:
+            ids = postings[word]
+            del ids[bisect.bisect_left(ids, id)]
+            if not ids:
+                del postings[word]
+                if word not in self.names and word not in self.descriptions:
+                    for grams, pieces in ((self.trigrams, _trigrams(word)), (self.short, _short_pieces(word))):
+                        for gram in pieces:
+                            words = grams[gram]
+                            words.discard(word)
+                            if not words:
+                                del grams[gram]
+        for word in new - old:
+            ids = postings.get(word)
+            if ids is None:
+                self._add_word(word)
+                ids = postings[word] = array('I')
+            ids.insert(bisect.bisect_left(ids, id), id)
+
+    #Where someone goes in the prefix table depends on their name, so a new one takes them out by the old one first.
+    def _update_prefixes(self, id, old_name, new_name):
+        key = self.sort_names.__getitem__
+        for prefix in _name_prefixes(old_name):
+            ids = self.prefixes[prefix]
+            del ids[ids.index(id, bisect.bisect_left(ids, key(id), key=key))]
+            if not ids:
+                del self.prefixes[prefix]
+        self.sort_names[id] = new_name.lower()
+        for prefix in _name_prefixes(new_name):
+            ids = self.prefixes.setdefault(prefix, array('I'))
+            ids.insert(bisect.bisect_right(ids, key(id), key=key), id)
+
+    #Puts a word that's not in any name or description yet in the trigram index and the table of short pieces.
+    def _add_word(self, word):
+        if word not in self.names and word not in self.descriptions:
+            for gram in _trigrams(word):
+                self.trigrams.setdefault(gram, set()).add(word)
+            for piece in _short_pieces(word):
+                self.short.setdefault(piece, set()).add(word)
@@ -0,0 +1,254 @@
+import collections
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtGui import QTextDocument, QTextCursor
+from PySide6.QtWidgets import QPlainTextDocumentLayout
+from story_buffer import StoryBuffer, utf16_length
+
+#How many documents to keep at once. Past that, the least recently shown ones get dropped, and made again from the model's text if they're needed.
+DOCUMENT_LIMIT = 24
+#Generated text gets written to documents at most once per this many milliseconds, about once per frame at 60 Hz. Anything that comes in between waits and goes in with it.
+FRAME_INTERVAL = 16
+#Text longer than this gets loaded into its document a piece at a time, starting from the end, so opening a long story doesn't freeze the window.
+LOAD_CHUNK_SIZE = 262144
+
+class DocumentPool(QObject):
+    """
+    Keeps a QTextDocument for each piece of text a project shows: its story and memory, and each character's description.
+
+    Switching tabs just swaps which documents the text areas show, so nothing gets laid out again and each one keeps its own undo history. Generated text for a tab that isn't showing waits until it is, so background generations don't cost any layout.
+
+    Each document belongs to an owner (a Project or Character) and a field, which is the name of the owner's attribute it holds. The model always has the same text as the documents, since edits get sent to it as they happen, so dropping a document doesn't lose anything.
+    """
+    #(owner, field, position, removed, added text) for each edit the user makes, straight from QTextDocument.contentsChange. Positions are in Qt's UTF-16 code units. Text written through the pool doesn't send these.
+    edited = Signal(object, str, int, int, str)
+    text_added = Signal(QTextDocument)     #Generated text was just written to this document.
+    text_loaded = Signal(QTextDocument)    #Another piece of a long text was just loaded in front of what was already in this document.
+
+    def __init__(self, limit=DOCUMENT_LIMIT):
+        super().__init__()
+        self.limit = limit
+        self.documents = collections.OrderedDict()     #(owner, field): document, least recently used first
+        self.pending = {}       #document: generated text that hasn't been written to it yet. Documents that aren't showing keep theirs until they are.
+        self.writing = False    #True while the program is writing to a document, so it's not mistaken for the user editing it.
+        self.showing = {}       #text area: the document it's showing. These never get dropped.
+        self.locked = set()     #Text areas that should be read-only no matter what they're showing. See set_read_only().
+        self.loading = {}       #document: [its text, how much of the start of it isn't loaded yet, and that part's UTF-16 length]
+        self.load_timer = QTimer(self)
+        self.load_timer.setInterval(0)
+        self.load_timer.timeout.connect(self._load_next)
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FRAME_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def get(self, owner, field):
+        """The document for this owner's field, making it from the model's text if there isn't one."""
+        key = (owner, field)
+        document = self.documents.get(key)
+        if document is None:
+            document = QTextDocument(self)
+            #It's shown in a QPlainTextEdit, which lays out a block at a time, so long stories stay quick to edit and scroll.
+            document.setDocumentLayout(QPlainTextDocumentLayout(document))
+            self._set_plain_text(document, getattr(owner, field))
+            document.contentsChange.connect(lambda position, removed, added: self._forward_edit(owner, field, document, position, removed, added))
+            self.documents[key] = document
+            self._evict()
+        self.documents.move_to_end(key)
+        return document
+
+    def show(self, text_edit, owner, field):
+        """Gets the document for this owner's field and shows it in text_edit."""
+        document = self.get(owner, field)
+        self.show_document(text_edit, document)
+        return document
+
+    def show_document(self, text_edit, document):
+        self.showing[text_edit] = document
+        if text_edit.document() is document:
+            return
+        #Documents don't pick up the text area's font on their own. Laying one out reports all of its text as added, so neither of these should count as an edit.
+        self._write(document.setDefaultFont, text_edit.font())
+        self._write(text_edit.setDocument, document)
+        self._update_read_only(text_edit)
+        self._write_pending(document)
+
+    def set_read_only(self, text_edit, read_only):
+        """Makes text_edit read-only or not, like while generating. It stays read-only anyway while the document it's showing is still loading."""
+        if read_only:
+            self.locked.add(text_edit)
+        else:
+            self.locked.discard(text_edit)
+        self._update_read_only(text_edit)
+
+    #Loading turns off the undo history for a moment, which clears it (see _load_chunk()), so nothing that should be undoable can go in until it's done.
+    def _update_read_only(self, text_edit):
+        text_edit.setReadOnly(text_edit in self.locked or self.showing.get(text_edit) in self.loading)
+
+    def _update_showing(self, document):
+        for text_edit, showing in self.showing.items():
+            if showing is document:
+                self._update_read_only(text_edit)
+
+    def cursor_position(self, text_edit):
+        """Where the cursor is in the text shown in text_edit, in UTF-16 code units, counting text that hasn't loaded yet."""
+        return text_edit.textCursor().position() + self._unloaded_length(text_edit.document())
+
+    def peek(self, owner, field):
+        """The document for this owner's field if there is one, without making it or counting it as used."""
+        return self.documents.get((owner, field))
+
+    def discard(self, owner):
+        """Drops all of this owner's documents, like when its tab closes."""
+        for key in [key for key in self.documents if key[0] is owner]:
+            self._drop(key)
+
+    def set_text(self, owner, field, text):
+        """Replaces the text of this owner's document, if it has one. The caller should have already put it in the model."""
+        document = self.peek(owner, field)
+        if document is not None:
+            self.pending.pop(document, None)
+            self._set_plain_text(document, text)
+
+    def replace_end(self, owner, field, length, text):
+        """Replaces the last length characters (in UTF-16 code units) of this owner's document with text. It's one edit, so it can be undone."""
+        document = self.peek(owner, field)
+        if document is None:
+            return
+        self.finish_loading(document)
+        self._write_pending(document)
+        cursor = QTextCursor(document)
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.setPosition(cursor.position() - length, QTextCursor.MoveMode.KeepAnchor)
+        self._write(cursor.insertText, text)
+
+    #This just queues the text. Writing it to the document means laying it out again, so flush does it all at once on the next frame.
+    def append(self, owner, field, text):
+        """Adds generated text to the end of this owner's document, if it has one. The caller should have already put it in the model."""
+        document = self.peek(owner, field)
+        if document is None or text == '':
+            return
+        self.pending.setdefault(document, []).append(text)
+        if document in self.showing.values() and not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self):
+        """Writes the generated text that's waiting for the documents that are showing."""
+        self.flush_timer.stop()
+        for document in set(self.showing.values()):
+            self._write_pending(document)
+
+    def _write_pending(self, document):
+        texts = self.pending.pop(document, None)
+        if texts is None:
+            return
+        #It goes in the undo history, so it can't go in before loading's done with it.
+        self.finish_loading(document)
+        cursor = QTextCursor(document)
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        self._write(cursor.insertText, ''.join(texts))
+        self.text_added.emit(document)
+
+    def text(self, owner, field):
+        """All the text in this owner's document, after loading and writing anything that's waiting."""
+        document = self.get(owner, field)
+        self.finish_loading(document)
+        self._write_pending(document)
+        return document.toPlainText()
+
+    def finish_loading(self, document):
+        while document in self.loading:
+            self._load_chunk(document)
+
+    def utf16_length(self, owner, field):
+        """How long this owner's document is in UTF-16 code units, counting text that hasn't been loaded or written to it yet. None if it doesn't have one."""
+        document = self.peek(owner, field)
+        if document is None:
+            return None
+        return document.characterCount() - 1 + self._unloaded_length(document) + sum(utf16_length(text) for text in self.pending.get(document, []))
+
+    #Loads just the end of a long text right away, and queues the rest to go in front of it a piece at a time. The text can be a StoryBuffer, so only the pieces that get loaded are ever joined.
+    def _set_plain_text(self, document, text):
+        self.loading.pop(document, None)
+        if len(text) <= LOAD_CHUNK_SIZE:
+            self._write(document.setPlainText, str(text))
+            self._update_showing(document)
+            return
+        if isinstance(text, StoryBuffer):
+            #Edits to the story while it's loading shouldn't move what's left of it. See StoryBuffer.fork().
+            text = text.fork()
+        start = self._load_start(text, len(text))
+        end = text[start:]
+        self._write(document.setPlainText, end)
+        units = text.utf16_length() if isinstance(text, StoryBuffer) else utf16_length(text)
+        self.loading[document] = [text, start, units - utf16_length(end)]
+        self._update_showing(document)
+        self.load_timer.start()
+
+    #Where the piece of text to load before end starts. It's split at a line break if there's one nearby, so no paragraph gets laid out half at a time.
+    def _load_start(self, text, end):
+        start = max(0, end - LOAD_CHUNK_SIZE)
+        if start > 0:
+            search_start = max(0, start - LOAD_CHUNK_SIZE // 4)
+            line_break = text[search_start:start].rfind('\n')
+            if line_break != -1:
+                start = search_start + line_break + 1
+        return start
+
+    def _unloaded_length(self, document):
+        return self.loading[document][2] if document in self.loading else 0
+
+    #The documents that are showing go first.
+    def _load_next(self):
+        if not self.loading:
+            self.load_timer.stop()
+            return
+        showing = [document for document in self.showing.values() if document in self.loading]
+        self._load_chunk(showing[0] if showing else next(iter(self.loading)))
+
+    def _load_chunk(self, document):
+        text, end, units = self.loading[document]
+        start = self._load_start(text, end)
+        chunk = text[start:end]
+        if start == 0:
+            del self.loading[document]
+        else:
+            self.loading[document] = [text, start, units - utf16_length(chunk)]
+        cursor = QTextCursor(document)
+        #Loading isn't something to undo. Turning undo off clears the history, so whatever's showing it stays read-only until it's done, and the program finishes loading before writing anything that goes in the history.
+        document.setUndoRedoEnabled(False)
+        self._write(cursor.insertText, chunk)
+        document.setUndoRedoEnabled(True)
+        if start == 0:
+            self._update_showing(document)
+        self.text_loaded.emit(document)
+
+    def _write(self, function, *args):
+        self.writing = True
+        try:
+            function(*args)
+        finally:
+            self.writing = False
+
+    def _forward_edit(self, owner, field, document, position, removed, added):
+        if self.writing:
+            return
+        #The counts can include the paragraph separator at the very end, which isn't really part of the text.
+        end = min(position + added, document.characterCount() - 1)
+        cursor = QTextCursor(document)
+        cursor.setPosition(position)
+        cursor.setPosition(end, QTextCursor.MoveMode.KeepAnchor)
+        #selectedText() uses Unicode separators where toPlainText() would use plain ones.
+        text = cursor.selectedText().replace('\u2029', '\n').replace('\u2028', '\n').replace('\xa0', ' ')
+        #Positions are counted from the start of the document, which is missing any of the text that hasn't loaded yet.
+        self.edited.emit(owner, field, position + self._unloaded_length(document), removed, text)
+
+    def _evict(self):
+        showing = set(self.showing.values())
+        for key in [key for key, document in self.documents.items() if document not in showing][:max(0, len(self.documents) - self.limit)]:
+            self._drop(key)
+
+    def _drop(self, key):
+        document = self.documents.pop(key)
+        self.pending.pop(document, None)
+        self.loading.pop(document, None)
+        document.deleteLater()
@@ -0,0 +1,73 @@
+import asyncio
+import weakref
+from PySide6.QtCore import QObject, Signal
+from kobold_async import AsyncKoboldClient
+
+HEALTH_CHECK_PERIOD = 10
+#kobold.cpp only generates one thing at a time. If a server is run with --multiuser it can queue more, but they still wait for each other.
+GENERATIONS_PER_ENDPOINT = 1
+
+class EndpointPool(QObject):
+    """
+    A set of kobold.cpp servers to spread generations across.
+
+    Each generation goes to a healthy server with a free slot. A project goes back to the same server it used last time if it can, since that server still has the project's prompt cached. Otherwise it goes to whichever server has the fewest requests waiting on it.
+
+    Tokenizing can go to any healthy server, so all of them should be running the same model.
+    """
+    capacity_changed = Signal()     #A server came back, so there might be room for another generation.
+
+    def __init__(self, base_urls, generations_per_endpoint=GENERATIONS_PER_ENDPOINT):
+        super().__init__()
+        self.generations_per_endpoint = generations_per_endpoint
+        self.clients = []
+        self.generations = {}       #client: how many generations it's running
+        self.affinity = weakref.WeakKeyDictionary()     #project: the client it last generated on
+        self.set_endpoints(base_urls)
+
+    def set_endpoints(self, base_urls):
+        #That includes ones that were removed but are still running something, so adding one back doesn't give its server a second generation.
+        old_clients = {client.base_url: client for client in self.generations}
+        self.clients = [old_clients.get(url.rstrip('/')) or AsyncKoboldClient(url) for url in base_urls]
+        for client in self.clients:
+            self.generations.setdefault(client, 0)
+        #Servers that were removed stay in generations until what's running on them finishes. See release().
+        for client in [client for client, count in self.generations.items() if count == 0 and client not in self.clients]:
+            del self.generations[client]
+        self.capacity_changed.emit()
+
+    def healthy(self):
+        return [client for client in self.clients if client.healthy]
+
+    def acquire(self, project):
+        """Picks a server for a generation for this project and reserves a slot on it. Returns None if there's no room anywhere."""
+        free = [client for client in self.healthy() if self.generations[client] < self.generations_per_endpoint]
+        if not free:
+            return None
+        client = self.affinity.get(project)
+        if client not in free:
+            client = min(free, key=lambda client: (self.generations[client], client.outstanding))
+        self.generations[client] += 1
+        self.affinity[project] = client
+        return client
+
+    def release(self, client):
+        self.generations[client] -= 1
+        if self.generations[client] == 0 and client not in self.clients:
+            del self.generations[client]
+
+    def tokenizer(self):
+        """A client for counting tokens and detokenizing. Falls back to an unhealthy one rather than nothing, so the caller gets a proper error."""
+        return min(self.healthy() or self.clients, key=lambda client: client.outstanding)
+
+    async def check_health(self):
+        was_healthy = set(self.healthy())
+        await asyncio.gather(*[client.check_health() for client in self.clients])
+        if set(self.healthy()) - was_healthy:
+            self.capacity_changed.emit()
+
+    async def health_loop(self):
+        """Checks every server every HEALTH_CHECK_PERIOD seconds, forever."""
+        while True:
+            await self.check_health()
+            await asyncio.sleep(HEALTH_CHECK_PERIOD)
@@ -0,0 +1,146 @@
+import itertools
+from PySide6.QtCore import QObject, Signal
+import kobold_api
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+#Added to a job's priority while its project is in the selected tab, so whatever you're looking at goes first.
+FOREGROUND_BOOST = 1
+#How many times a job can fail to reach a server before it gives up, instead of going back in the queue for another server.
+MAX_ATTEMPTS = 3
+
+class GenerationJob:
+    """Everything needed to run one generation for a project, plus where it is in the queue."""
+    _order = itertools.count()
+
+    def __init__(self, project, memory, characters, max_tokens, temperature, stop_sequence, priority=0):
+        self.project = project
+        self.memory = memory
+        self.characters = characters
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.stop_sequence = stop_sequence
+        self.priority = priority
+        self.genkey = kobold_api.make_genkey()
+        self.status = QUEUED
+        self.order = next(GenerationJob._order)  #Breaks ties between equal priorities, so it's first come first served.
+        self.tokens_generated = 0
+        self.preempted = False
+        self.failures = 0
+        self.failed = False     #Set by whoever runs it if it couldn't reach the server this time.
+        self.client = None      #The server it's running on, while it's running.
+
+    def remaining_tokens(self):
+        return self.max_tokens - self.tokens_generated
+
+class GenerationScheduler(QObject):
+    """
+    Queues generations from any tab and runs them, highest priority first, on whichever servers in the EndpointPool have room.
+
+    If a job with a higher priority is waiting than one that's running (usually because it's for the selected tab) and there's no room for it, the running one is aborted and put back in the queue. It picks up where it left off the next time it runs.
+
+    It doesn't run anything itself. start_job(job) should start generating on job.client, abort_job(job) should stop it early, and whoever is running it emits job_done once all its text is written out.
+    """
+    job_done = Signal(object)   #Safe to emit from any thread. The scheduler always handles it on the GUI thread.
+    queue_changed = Signal()
+
+    def __init__(self, start_job, abort_job, endpoints):
+        super().__init__()
+        self.start_job = start_job
+        self.abort_job = abort_job
+        self.endpoints = endpoints
+        self.queue = []
+        self.running = []
+        self.foreground = None
+        self.job_done.connect(self._finish)
+        self.endpoints.capacity_changed.connect(self.schedule)
+
+    def effective_priority(self, job):
+        return job.priority + (FOREGROUND_BOOST if job.project is self.foreground else 0)
+
+    def submit(self, job):
+        job.status = QUEUED
+        self.queue.append(job)
+        self.queue_changed.emit()
+        self.schedule()
+
+    def cancel(self, job):
+        if job in self.queue:
+            self.queue.remove(job)
+            job.status = CANCELLED
+            self.queue_changed.emit()
+        elif job in self.running:
+            #It's marked cancelled now, but it stays running until its text is done being written.
+            job.status = CANCELLED
+            self.abort_job(job)
+
+    def cancel_project(self, project):
+        for job in [job for job in self.queue + self.running if job.project is project]:
+            self.cancel(job)
+
+    def set_foreground(self, project):
+        self.foreground = project
+        self.schedule()
+
+    def job_for(self, project):
+        """The running or queued job for this project, or None if it isn't generating."""
+        for job in self.running + self.queue:
+            if job.project is project and job.status != CANCELLED:
+                return job
+        return None
+
+    def queue_position(self, job):
+        """1 for the job that will run next, 2 for the one after that, and so on. 0 if it's running or not queued."""
+        if job not in self.queue:
+            return 0
+        return sorted(self.queue, key=self._sort_key).index(job) + 1
+
+    def _sort_key(self, job):
+        return (-self.effective_priority(job), job.order)
+
+    def schedule(self):
+        """Starts as many queued jobs as there's room for, and preempts a running job if something more important is waiting."""
+        while self.queue:
+            best = min(self.queue, key=self._sort_key)
+            client = self.endpoints.acquire(best.project)
+            if client is None:
+                break
+            self.queue.remove(best)
+            best.status = RUNNING
+            best.client = client
+            self.running.append(best)
+            self.queue_changed.emit()
+            self.start_job(best)
+        if not self.queue or any(job.preempted for job in self.running):
+            return
+        best = min(self.queue, key=self._sort_key)
+        #If there's more than one it could preempt, pick the least important, and out of those the newest.
+        candidates = [job for job in self.running if job.status == RUNNING]
+        if not candidates:
+            return
+        victim = min(candidates, key=lambda job: (self.effective_priority(job), -job.order))
+        if self.effective_priority(best) > self.effective_priority(victim):
+            print(f"Preempting generation {victim.genkey} for {best.genkey}")
+            victim.preempted = True
+            self.abort_job(victim)
+
+    def _finish(self, job):
+        self.running.remove(job)
+        self.endpoints.release(job.client)
+        job.client = None
+        if job.failed:
+            job.failures += 1
+        retry = job.preempted or (job.failed and job.failures < MAX_ATTEMPTS)
+        if job.status == RUNNING and retry and job.remaining_tokens() > 0:
+            job.preempted = False
+            job.failed = False
+            job.genkey = kobold_api.make_genkey()   #So a late abort meant for the old run can't stop the new one.
+            job.status = QUEUED
+            self.queue.append(job)
+        elif job.status == RUNNING:
+            job.status = DONE
+        self.queue_changed.emit()
+        self.schedule()
@@ -1,20 +1,39 @@
-import requests
 import json
+import codecs
 import re
 import collections
-import winsound
 import threading
 import random
 import time
 
-GENERATE_URL = 'http://localhost:5001/api/v1/generate'
-POLL_URL = 'http://localhost:5001/api/extra/generate/check'
-STREAM_URL = 'http://localhost:5001/api/extra/generate/stream'
-TOKEN_COUNT = 'http://localhost:5001/api/extra/tokencount'
-DETOKENIZE = 'http://localhost:5001/api/extra/detokenize'
-ABORT = 'http://localhost:5001/api/extra/abort'
+DEFAULT_BASE_URL = 'http://localhost:5001'
+GENERATE_PATH = '/api/v1/generate'
+POLL_PATH = '/api/extra/generate/check'
+STREAM_PATH = '/api/extra/generate/stream'
+TOKEN_COUNT_PATH = '/api/extra/tokencount'
+DETOKENIZE_PATH = '/api/extra/detokenize'
+ABORT_PATH = '/api/extra/abort'
+VERSION_PATH = '/api/extra/version'
 POLLING_PERIOD = 0.5
 
+#(connect, read) timeouts in seconds. Generating can sit in prompt processing for a long time on a CPU before the first byte comes back, so those don't have a read timeout.
+CONNECT_TIMEOUT = 3.05
+DEFAULT_TIMEOUTS = {
+    GENERATE_PATH: (CONNECT_TIMEOUT, None),
+    STREAM_PATH: (CONNECT_TIMEOUT, None),
+    POLL_PATH: (CONNECT_TIMEOUT, 10),
+    TOKEN_COUNT_PATH: (CONNECT_TIMEOUT, 30),
+    DETOKENIZE_PATH: (CONNECT_TIMEOUT, 30),
+    ABORT_PATH: (CONNECT_TIMEOUT, 10),
+    VERSION_PATH: (CONNECT_TIMEOUT, 5),
+}
+#Only failed connections are retried. If the request made it to the server, retrying a generate would start a second generation.
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.1
+POOL_SIZE = 4
+#How much to read off the socket at once while streaming. It returns as soon as anything arrives, so this only caps it.
+STREAM_CHUNK_SIZE = 65536
+
 baseSettings = {
   "n": 1,
   "max_context_length": 2048,
@@ -43,24 +62,168 @@ baseSettings = {
   "use_default_badwordsids": False,
 }
 
+class SSEParser:
+    """
+    Incremental parser for a Server-Sent Events stream. Feed it bytes as they come off the socket, in chunks of any size, and it returns the events those bytes completed as (event, data) tuples.
+    
+    Multi-line data fields are joined with newlines, and UTF-8 characters split across chunks are held until the rest of them arrives.
+    """
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial_line = ''
+        self._event = ''
+        self._data = []
+    
+    def feed(self, chunk):
+        text = self._partial_line + self._decoder.decode(chunk)
+        if '\r' in text:
+            #A \r at the very end might be the first half of a \r\n, so leave it for the next chunk.
+            hold = '\r' if text.endswith('\r') else ''
+            text = text[:len(text) - len(hold)].replace('\r\n', '\n').replace('\r', '\n') + hold
+        lines = text.split('\n')
+        self._partial_line = lines.pop()
+        events = []
+        for line in lines:
+            if line == '':
+                if self._data:
+                    events.append((self._event or 'message', '\n'.join(self._data)))
+                self._event = ''
+                self._data = []
+                continue
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'data':
+                self._data.append(value)
+            elif field == 'event':
+                self._event = value
+            #Anything else is a comment (an empty field name), id or retry, none of which kobold.cpp needs.
+        return events
+
+def read_chunks(raw, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields whatever is available on a streamed urllib3 response, up to chunk_size bytes at a time, without waiting for the buffer to fill."""
+    while True:
+        chunk = raw.read1(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def shared_prefix_length(a, b):
+    """How many items at the start of a and b are the same. Binary search over slices, so it's fast even for whole stories."""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+#kobold.cpp keeps the last prompt it processed cached, and only has to process what comes after the part that's the same as last time. client.shared_prefix says how many bytes that was for the last prompt sent, so it's easy to check when something keeps changing the start of the prompt.
+def record_prompt(client, settings):
+    prompt = (settings.get('memory', '') + settings.get('prompt', '')).encode()
+    client.shared_prefix = shared_prefix_length(client.last_prompt, prompt)
+    client.last_prompt = prompt
+
+def make_genkey():
+    return ''.join([random.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(10)])
+
+def iter_tokens(chunks):
+    """Turns the raw chunks of a kobold.cpp generate stream into (token, done) tuples."""
+    parser = SSEParser()
+    for chunk in chunks:
+        for event, data in parser.feed(chunk):
+            if event != 'message':
+                continue
+            data = json.loads(data)
+            #Before, this was checking for "null". Did the new version of kobold.cpp change it?
+            yield data.get('token'), data.get('finish_reason') != None
+
+class KoboldClient:
+    """
+    Talks to a kobold.cpp server over a pooled keep-alive session, so repeated calls (token counts, aborts, polling) reuse the same connection instead of opening a new one each time.
+    """
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeouts=None, retries=MAX_RETRIES, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = DEFAULT_TIMEOUTS.copy()
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.genkey = ''
+        self.last_prompt = b''
+        self.shared_prefix = 0
+        #requests takes longer to import than the rest of this module put together, and the window only uses the async client, so it's imported when a KoboldClient is made instead of with the module.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retry = Retry(total=retries, connect=retries, read=False, status=False, redirect=False, backoff_factor=RETRY_BACKOFF)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def _post(self, path, body, **kwargs):
+        return self.session.post(self.base_url + path, json=body, timeout=self.timeouts[path], **kwargs)
+    
+    def new_genkey(self):
+        self.genkey = make_genkey()
+        return self.genkey
+    
+    def generate(self, settings):
+        record_prompt(self, settings)
+        response = self._post(GENERATE_PATH, settings)
+        return json.loads(response.text)['results'][0]['text']
+    
+    def check(self, genkey=None):
+        response = self._post(POLL_PATH, {'genkey': self.genkey if genkey is None else genkey})
+        return json.loads(response.text)['results'][0]['text']
+    
+    def stream(self, outFunction, settings):
+        record_prompt(self, settings)
+        with self._post(STREAM_PATH, settings, stream=True) as resp:
+            for token, done in iter_tokens(read_chunks(resp.raw)):
+                outFunction(token, done)
+                if done:
+                    return
+    
+    def token_count(self, text):
+        response = self._post(TOKEN_COUNT_PATH, {"prompt": text})
+        result = json.loads(response.text)
+        return result['value'], result['ids']
+    
+    def detokenize(self, ids):
+        response = self._post(DETOKENIZE_PATH, {"ids": ids})
+        return json.loads(response.text)['result']
+    
+    def abort(self, genkey=None):
+        self._post(ABORT_PATH, {"genkey": self.genkey if genkey is None else genkey})
+    
+    def close(self):
+        self.session.close()
+
+#The module-level functions all go through this. Change its base_url (or replace it) to point somewhere other than localhost:5001. It's made the first time one of them is called, so importing this module doesn't import requests.
+client = None
+
+def default_client():
+    global client
+    if client is None:
+        client = KoboldClient()
+    return client
+
 #This prompts the LLM, and prints the result. Note that it's polling it to see progress, so simply returning the result won't work. I'll need something more sophisticated.
 def prompt(outFunction, text = '', memory = '', grammar = '', stopSequence = []):
-    global genkey
     settings = baseSettings.copy()
     settings['prompt'] = text
     settings['stop_sequence'] = stopSequence
     settings['grammar'] = grammar
     settings['memory'] = memory
-    settings['genkey'] = genkey
+    settings['genkey'] = default_client().genkey
     
     result = [None]
     thread = threading.Thread(target=request, args=(settings, result))
     thread.start()
     thread.join(POLLING_PERIOD)
     while thread.is_alive():
-        #response = requests.get(POLL_URL)
-        response = requests.post(POLL_URL, json = {'genkey': genkey})
-        outFunction(json.loads(response.text)['results'][0]['text'], False)
+        outFunction(default_client().check(), False)
         #thread.join(POLLING_PERIOD)
     outFunction(result[0], True)
     return
@@ -69,41 +232,24 @@ def prompt(outFunction, text = '', memory = '', grammar = '', stopSequence = [])
 #Note to self: If this is what's happening, the abort button shouldn't continue the text. Does abort ever work correctly?
 def stream_prompt(outFunction, text='', memory='', max_length=100, temperature=1, grammar='', stopSequence = []):
     print("Streaming prompt.")
-    global genkey
     settings = baseSettings.copy()
-    genkey = ''.join([random.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(10)])
+    genkey = default_client().new_genkey()
     settings.update({'prompt': text, 'memory': memory, 'max_length': max_length, 'temperature': temperature, 'grammar': grammar, 'stop_sequence': stopSequence, 'genkey': genkey})
-    prevTime = -1
-    with requests.post(STREAM_URL, json=settings, stream=True) as resp:
-        for line in resp.iter_lines(decode_unicode=True, chunk_size=1):
-            print(f"stream_prompt: {line}")
-            if line.startswith('data: '):
-                data = json.loads(line[6:])
-                token = data.get('token')
-                #Before, this was checking for "null". Did the new version of kobold.cpp change it?
-                done = data.get('finish_reason') != None
-                outFunction(token, done)
-                if done:
-                    return
+    default_client().stream(outFunction, settings)
 
 #This is run in a thread, so it can't return a result normally.
 def request(settings, result):
-    response = requests.post(GENERATE_URL, json = settings)
-    text = json.loads(response.text)['results'][0]['text']
-    result[0] = text
+    result[0] = default_client().generate(settings)
 
 def tokenCount(text):
-    response = requests.post(TOKEN_COUNT, json = {"prompt": text})
-    result = json.loads(response.text)
-    return result['value'], result['ids']
+    return default_client().token_count(text)
 
 def detokenize(ids):
-    response = requests.post(DETOKENIZE, json = {"ids": ids})
-    return json.loads(response.text)['result']
+    return default_client().detokenize(ids)
 
 def abort():
     print("Sending Abort request")
-    requests.post(ABORT, json = {"genkey": genkey})
+    default_client().abort()
 
 def mainLoop():
     while True:
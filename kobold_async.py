@@ -0,0 +1,149 @@
+import asyncio
+import json
+from PySide6.QtCore import QUrl, QByteArray
+from PySide6.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
+import kobold_api
+
+#QtAsyncio runs asyncio on top of the Qt event loop, but it doesn't implement sockets, so the actual HTTP is done by a QNetworkAccessManager and its replies get turned into futures.
+#Everything here has to run on the GUI thread, inside QtAsyncio.run().
+class AsyncKoboldClient:
+    """
+    The same calls as kobold_api.KoboldClient, but as coroutines on the Qt event loop instead of blocking calls.
+
+    QNetworkAccessManager keeps connections alive and runs several requests to the same server at once, so nothing here needs its own thread.
+    """
+    def __init__(self, base_url=kobold_api.DEFAULT_BASE_URL, timeouts=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeouts = kobold_api.DEFAULT_TIMEOUTS.copy()
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+        self.genkey = ''
+        self.healthy = True     #Cleared when a request fails to get through, and set again by check_health().
+        self.outstanding = 0    #How many requests are waiting on this server right now.
+        self.last_prompt = b''
+        self.shared_prefix = 0
+        self.manager = QNetworkAccessManager()
+
+    def _request(self, path):
+        request = QNetworkRequest(QUrl(self.base_url + path))
+        request.setHeader(QNetworkRequest.KnownHeaders.ContentTypeHeader, 'application/json')
+        #Qt only has one timeout, for how long the transfer can go without any data. A read timeout of None means no timeout, which Qt spells 0.
+        read_timeout = self.timeouts[path][1]
+        request.setTransferTimeout(0 if read_timeout is None else int(read_timeout * 1000))
+        return request
+
+    def _post(self, path, body):
+        return self.manager.post(self._request(path), QByteArray(json.dumps(body).encode()))
+
+    async def _post_json(self, path, body):
+        return await self._read_json(self._post(path, body))
+
+    async def _get_json(self, path):
+        return await self._read_json(self.manager.get(self._request(path)))
+
+    async def _read_json(self, reply):
+        finished = asyncio.get_running_loop().create_future()
+        reply.finished.connect(lambda: finished.done() or finished.set_result(None))
+        self.outstanding += 1
+        try:
+            await finished
+            self._raise_for_error(reply)
+            return json.loads(bytes(reply.readAll().data()))
+        finally:
+            self.outstanding -= 1
+            #If the coroutine was cancelled, the request might still be going.
+            reply.abort()
+            reply.deleteLater()
+
+    #This has to be checked before reply.abort() is called, since that sets the error too.
+    def _raise_for_error(self, reply):
+        if reply.error() != QNetworkReply.NetworkError.NoError:
+            self.healthy = False
+            raise ConnectionError(f"{reply.url().toString()}: {reply.errorString()}")
+
+    def new_genkey(self):
+        self.genkey = kobold_api.make_genkey()
+        return self.genkey
+
+    async def generate(self, settings):
+        kobold_api.record_prompt(self, settings)
+        return (await self._post_json(kobold_api.GENERATE_PATH, settings))['results'][0]['text']
+
+    async def check(self, genkey=None):
+        return (await self._post_json(kobold_api.POLL_PATH, {'genkey': self.genkey if genkey is None else genkey}))['results'][0]['text']
+
+    async def stream(self, settings):
+        """Async generator of (token, done) tuples, as they arrive. Raises ConnectionError if the request fails, or if the stream ends before the server says the generation is done."""
+        kobold_api.record_prompt(self, settings)
+        reply = self._post(kobold_api.STREAM_PATH, settings)
+        chunks = asyncio.Queue()
+        def read():
+            chunks.put_nowait(bytes(reply.readAll().data()))
+        def finish():
+            read()
+            chunks.put_nowait(None)
+        reply.readyRead.connect(read)
+        reply.finished.connect(finish)
+        parser = kobold_api.SSEParser()
+        self.outstanding += 1
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    self._raise_for_error(reply)
+                    #kobold.cpp always ends with an event that has a finish_reason. Without one, the connection was cut off partway through.
+                    self.healthy = False
+                    raise ConnectionError(f"{reply.url().toString()}: The stream ended before the generation finished.")
+                for event, data in parser.feed(chunk):
+                    if event != 'message':
+                        continue
+                    data = json.loads(data)
+                    done = data.get('finish_reason') != None
+                    yield data.get('token'), done
+                    if done:
+                        return
+        finally:
+            self.outstanding -= 1
+            #Aborting emits finished, and there's nobody left to read it.
+            reply.readyRead.disconnect(read)
+            reply.finished.disconnect(finish)
+            reply.abort()
+            reply.deleteLater()
+
+    async def token_count(self, text):
+        result = await self._post_json(kobold_api.TOKEN_COUNT_PATH, {"prompt": text})
+        return result['value'], result['ids']
+
+    async def detokenize(self, ids):
+        return (await self._post_json(kobold_api.DETOKENIZE_PATH, {"ids": ids}))['result']
+
+    async def abort(self, genkey=None):
+        await self._post_json(kobold_api.ABORT_PATH, {"genkey": self.genkey if genkey is None else genkey})
+
+    async def check_health(self):
+        """Asks the server for its version, and sets self.healthy to whether it answered."""
+        try:
+            await self._get_json(kobold_api.VERSION_PATH)
+            self.healthy = True
+        except ConnectionError:
+            self.healthy = False
+        return self.healthy
+
+    async def prompt(self, outFunction, settings):
+        """Like kobold_api.prompt(). Runs a non-streaming generate and polls it for progress every POLLING_PERIOD seconds."""
+        generation = asyncio.ensure_future(self.generate(settings))
+        while not generation.done():
+            await asyncio.wait([generation], timeout=kobold_api.POLLING_PERIOD)
+            if not generation.done():
+                outFunction(await self.check(settings.get('genkey')), False)
+        outFunction(generation.result(), True)
+
+    async def stream_prompt(self, outFunction, text='', memory='', max_length=100, temperature=1, grammar='', stopSequence=[], genkey=None):
+        """Adapter for the old callback contract. Calls outFunction(token, done) for each token, like kobold_api.stream_prompt(). If the request fails or gets cut off, it raises ConnectionError instead of saying it's done, so the caller can note the failure before finishing up."""
+        if genkey is None:
+            genkey = self.new_genkey()
+        self.genkey = genkey
+        settings = kobold_api.baseSettings.copy()
+        settings.update({'prompt': text, 'memory': memory, 'max_length': max_length, 'temperature': temperature, 'grammar': grammar, 'stop_sequence': stopSequence, 'genkey': genkey})
+        async for token, done in self.stream(settings):
+            outFunction(token, done)
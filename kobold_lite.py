@@ -0,0 +1,339 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+from json.decoder import scanstring
+from narrative_data import Project, Character
+
+#How much of a file gets read at a time.
+READ_SIZE = 1024 * 1024
+#What Lite puts in new saves for the author's note, which there's nothing for here.
+AUTHORS_NOTE_TEMPLATE = "[Author's note: <|>]"
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SCALAR = re.compile(r'[^ \t\n\r,\]}]*')
+#As much of the inside of a string as can be decoded on its own: anything but quotes and backslashes, and whole escapes.
+_STRING_PART = re.compile(r'[^"\\]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\]*)*')
+_HIGH_SURROGATE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+_decoder = json.JSONDecoder()
+
+class JsonStream:
+    """
+    Reads JSON from a file a piece at a time, so a save with a story tens of MB long never has to be in memory all at once.
+
+    It only reads what it's asked for, and that has to be what comes next in the file. items() and elements() step through an object or array, strings() gives back a string in pieces, value() reads a whole value at once (so it's for small ones) and skip() reads past one.
+    """
+    def __init__(self, infile, read_size=READ_SIZE):
+        self.infile = infile
+        self.read_size = read_size
+        self.buffer = ''
+        self.position = 0
+
+    #Reads more of the file onto the end of the buffer. Returns False at the end of the file.
+    def _fill(self, size=None):
+        text = self.infile.read(size or self.read_size)
+        if text == '':
+            return False
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def peek(self):
+        """The next character that isn't whitespace, or '' at the end of the file."""
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def _expect(self, character):
+        found = self.peek()
+        if found != character:
+            raise ValueError(f"Expected {character!r} but found {found!r}.")
+        self.position += 1
+
+    def value(self):
+        #A number, true, false or null doesn't end with anything, so all of it has to be read before it can tell it's whole.
+        if self.peek() not in ('{', '[', '"'):
+            while _SCALAR.match(self.buffer, self.position).end() == len(self.buffer) and self._fill():
+                pass
+            value, self.position = _decoder.raw_decode(self.buffer, self.position)
+            return value
+        size = self.read_size
+        while True:
+            try:
+                value, self.position = _decoder.raw_decode(self.buffer, self.position)
+                return value
+            except json.JSONDecodeError:
+                #Double how much it reads each time, so reading a big value doesn't take as many tries as it has read_sizes.
+                if not self._fill(size):
+                    raise
+                size *= 2
+
+    def items(self):
+        """Steps through an object, giving each key. Its value has to be read before the next one."""
+        self._expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self.peek() != ',':
+                self._expect('}')
+                return
+            self.position += 1
+
+    def elements(self):
+        """Steps through an array, giving each index. Each element has to be read before the next one."""
+        self._expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.peek() != ',':
+                self._expect(']')
+                return
+            self.position += 1
+
+    def strings(self):
+        """Reads a string, giving it back in pieces."""
+        self._expect('"')
+        #Most strings fit in what's been read, and json's scanner can do those all at once.
+        try:
+            text, self.position = scanstring(self.buffer, self.position)
+            yield text
+            return
+        except json.JSONDecodeError:
+            pass
+        while True:
+            stop = _STRING_PART.match(self.buffer, self.position).end()
+            finished = stop < len(self.buffer) and self.buffer[stop] == '"'
+            end = stop
+            #Characters outside the BMP are escaped as two \\u escapes, and splitting them into different pieces would leave each one half a character.
+            if not finished and self._ends_with_high_surrogate(end):
+                end -= 6
+            if end > self.position:
+                yield json.loads('"' + self.buffer[self.position:end] + '"')
+            self.position = end
+            if finished:
+                self.position += 1
+                return
+            #It stopped at a backslash. If there's enough after it for any escape, it's not a valid one.
+            if stop < len(self.buffer) - 6:
+                raise ValueError(f"Invalid escape {self.buffer[stop:stop + 6]!r} in a string.")
+            if not self._fill():
+                raise ValueError("The file ends in the middle of a string.")
+
+    #Whether the string so far ends in an escape for the first half of a surrogate pair, and not a backslash followed by something that looks like one.
+    def _ends_with_high_surrogate(self, end):
+        if not _HIGH_SURROGATE.search(self.buffer, self.position, end):
+            return False
+        backslashes = 0
+        while end - 6 - backslashes >= self.position and self.buffer[end - 6 - backslashes] == '\\':
+            backslashes += 1
+        return backslashes % 2 == 1
+
+    def skip(self):
+        next = self.peek()
+        if next == '{':
+            for key in self.items():
+                self.skip()
+        elif next == '[':
+            for index in self.elements():
+                self.skip()
+        elif next == '"':
+            for piece in self.strings():
+                pass
+        else:
+            self.value()
+
+def _normalize(name):
+    return ' '.join(name.split()).casefold()
+
+def _character_key(name, description):
+    return (_normalize(name), hashlib.sha1(description.encode()).hexdigest())
+
+#Adds a number to the end of a name until it's not taken.
+def _unique_name(name, taken):
+    unique = name
+    number = 2
+    while unique.lower() in taken:
+        unique = f'{name} {number}'
+        number += 1
+    return unique
+
+class Importer:
+    """
+    Adds projects and characters from KoboldAI Lite saves (the .json files from its Save button, which are the same as KoboldAI's) and world info exports.
+
+    Each story gets written straight to its body file in the save as it's read (see SaveJournal.open_body()), so importing doesn't hold more than a piece of one story at a time. A save becomes a project named after its file, with the prompt and actions as its story, and its world info as its characters. Entries marked constant start out active. Lite's author's note and settings don't have anywhere to go, so they're left out.
+
+    Characters that are already there with the same name (ignoring case and spaces) and description get reused instead of added again. Ones with a name that's taken and a different description get a number after the name.
+    """
+    def __init__(self, journal):
+        self.journal = journal
+        self.characters = {_character_key(character.name, character.description): character for character in Project.all_characters.values()}
+        self.projects = 0
+        self.characters_added = 0
+        self.characters_reused = 0
+        self.bytes = 0
+        self.seconds = 0
+
+    def import_files(self, paths):
+        for path in paths:
+            self.import_file(path)
+        #Once at the end instead of after every file, since each save has the list of all the projects.
+        self.journal.save()
+
+    def import_file(self, path):
+        start = time.perf_counter()
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'r', encoding='utf-8-sig') as infile:
+            stream = JsonStream(infile)
+            if stream.peek() == '[':
+                for character, constant in self._world_info(stream):
+                    pass
+            else:
+                self._import_save(stream, name)
+        self.bytes += os.path.getsize(path)
+        self.seconds += time.perf_counter() - start
+
+    def _import_save(self, stream, name):
+        project = Project()
+        writer = self.journal.open_body(project)
+        memory = ''
+        characters = []
+        is_save = False
+        try:
+            for key in stream.items():
+                #Lite always puts the prompt before the actions, and the story's written in the order it comes.
+                if key == 'prompt':
+                    is_save = True
+                    for piece in stream.strings():
+                        writer.write(piece)
+                elif key == 'actions':
+                    is_save = True
+                    for index in stream.elements():
+                        if stream.peek() != '"':
+                            stream.skip()
+                            continue
+                        for piece in stream.strings():
+                            writer.write(piece)
+                elif key == 'memory':
+                    is_save = True
+                    memory = stream.value()
+                elif key == 'worldinfo':
+                    characters = list(self._world_info(stream))
+                else:
+                    stream.skip()
+        except Exception:
+            writer.discard()
+            raise
+        #It was just world info.
+        if not is_save:
+            writer.discard()
+            return
+        writer.close(memory)
+        project.name = _unique_name(name, set(Project.named_projects) | {'+', 'untitled'})
+        for character, constant in characters:
+            project.project_characters.add(character)
+            if constant:
+                project.active_characters.add(character)
+        Project.named_projects[project.name.lower()] = project
+        self.projects += 1
+
+    #Reads an array of world info entries, giving (character, whether it's constant) for each one that's a character.
+    def _world_info(self, stream):
+        for index in stream.elements():
+            entry = stream.value()
+            if not isinstance(entry, dict):
+                continue
+            name = entry.get('comment') or entry.get('key', '').split(',')[0]
+            name = name.strip()
+            if name == '':
+                continue
+            yield self._add_character(name, entry.get('content', '')), entry.get('constant', False)
+
+    def _add_character(self, name, description):
+        key = _character_key(name, description)
+        character = self.characters.get(key)
+        if character is not None:
+            self.characters_reused += 1
+            return character
+        character = Character(_unique_name(name, Project.all_characters.keys() | {'+'}), description)
+        Project.all_characters[character.name.lower()] = character
+        self.characters[key] = character
+        self.characters_added += 1
+        return character
+
+    def report(self):
+        megabytes = self.bytes / 1024 / 1024
+        rate = megabytes / self.seconds if self.seconds > 0 else 0
+        return f"Imported {self.projects} projects and {self.characters_added} characters ({self.characters_reused} already there) from {megabytes:.1f} MB in {self.seconds:.2f} seconds ({rate:.1f} MB/s)."
+
+def export_project(project, path):
+    """Writes a project as a KoboldAI Lite save, with its story as the prompt and its characters as world info. Returns how many bytes it wrote."""
+    world_info = [{
+        'key': character.name,
+        'keysecondary': '',
+        'content': character.description,
+        'comment': character.name,
+        'folder': None,
+        'selective': False,
+        'constant': character in project.active_characters,
+    } for character in project.project_characters]
+    rest = {
+        'memory': project.memory,
+        'authorsnote': '',
+        'anotetemplate': AUTHORS_NOTE_TEMPLATE,
+        'actions': [],
+        'actions_metadata': {},
+        'worldinfo': world_info,
+        'wifolders_d': {},
+        'wifolders_l': [],
+    }
+    with open(path, 'w', encoding='utf-8') as outfile:
+        #The story goes out a chunk at a time, so it's never copied into one big string.
+        outfile.write('{"gamestarted": true, "prompt": "')
+        for chunk in project.story.chunks():
+            outfile.write(json.dumps(chunk)[1:-1])
+        outfile.write('", ' + json.dumps(rest)[1:])
+        return outfile.tell()
+
+#Only run these while KoboldUI isn't, or it'll save over them.
+if __name__ == '__main__':
+    from save_journal import SaveJournal
+    parser = argparse.ArgumentParser(description="Imports KoboldAI Lite saves and world info into the save in this folder, or exports a project as a Lite save.")
+    parser.add_argument('--directory', default='.', help="Where save.json is.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import')
+    import_parser.add_argument('files', nargs='+')
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('name', help="The name of the project to export.")
+    export_parser.add_argument('file')
+    args = parser.parse_args()
+    journal = SaveJournal(args.directory)
+    journal.load()
+    if args.command == 'import':
+        importer = Importer(journal)
+        importer.import_files(args.files)
+        print(importer.report())
+    else:
+        project = Project.named_projects.get(args.name.lower())
+        if project is None:
+            print(f"There's no project named {args.name!r}.")
+            sys.exit(1)
+        start = time.perf_counter()
+        size = export_project(project, args.file)
+        seconds = time.perf_counter() - start
+        print(f"Exported {args.name!r} ({size / 1024 / 1024:.1f} MB) in {seconds:.2f} seconds ({size / 1024 / 1024 / max(seconds, 1e-9):.1f} MB/s).")
+    journal.close()
@@ -1,15 +1,28 @@
 import sys
-from auto_grid_layout import *
-from PySide6.QtWidgets import *
+import html
+import time
+from auto_grid_layout import AutoGridLayout
+from document_pool import DocumentPool
+from PySide6.QtWidgets import (QApplication, QComboBox, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QMenu, QMessageBox, QPlainTextDocumentLayout,
+                               QPlainTextEdit, QPushButton, QScrollArea, QSizePolicy, QSplitter, QStackedWidget, QTabBar, QTextEdit, QVBoxLayout, QWidget)
 from PySide6.QtCore import Qt, QSize, QMetaObject, Signal, QRect, QEvent
-from PySide6.QtGui import QIntValidator, QDoubleValidator, QUndoStack, QUndoCommand, QTextCursor, QAction, QCursor, QKeySequence, QShortcut
+try:
+    from PySide6 import QtAsyncio
+except SyntaxError:
+    #PySide6 6.9.0's QtAsyncio has f-strings that only parse on Python 3.12 and up.
+    sys.exit("KoboldUI needs PySide6 6.9.1 or newer on Python 3.11 and older. Run: pip install -r requirements.txt")
+from PySide6.QtGui import QIntValidator, QDoubleValidator, QUndoStack, QUndoCommand, QTextCursor, QAction, QCursor, QKeySequence, QShortcut, QColor, QTextDocument
 
 MARGIN = 10
 FONT_SIZE = 18
 TAB_WIDTH = 200
+#Tab text colors for projects that are generating or waiting to.
+TAB_STATE_COLORS = {
+    'running': QColor('#2e8b57'),
+    'queued': QColor('#b8860b'),
+}
 
 class KoboldUI(QMainWindow):
-    text_to_add = Signal(str)
     tab_selected = Signal(int)  # Signal for when a tab is selected
     new_tab_requested = Signal()  # Signal for when the "+" tab is clicked
     tab_renamed = Signal(int, str)  # Signal for when a tab is renamed
@@ -22,6 +35,11 @@ class KoboldUI(QMainWindow):
     character_deleted = Signal(str)
     tab_closed = Signal(int)
     closing_program = Signal()
+    history_requested = Signal()    # Signal when you click History
+    version_selected = Signal(int)  # Signal with the index of the version to restore, from the history menu
+    fork_requested = Signal()       # Signal when you click Fork
+    project_search_changed = Signal(str)            # Signal with the text in the project search bar when it changes
+    project_button_clicked = Signal(QPushButton)    # Signal with the button for a project in the project search view
 
     def __init__(self):
         super().__init__()
@@ -50,7 +68,13 @@ class KoboldUI(QMainWindow):
         self.tab_bar.setDocumentMode(True)
         self.tab_bar.addTab("+")
         self.tab_bar.currentChanged.connect(self._handle_tab_changed)
-        self.text_to_add.connect(self._add_text)
+        #Each project's story and memory, and each character's description, has its own document. See document_pool.py.
+        self.documents = DocumentPool()
+        self.documents.text_added.connect(self._text_added)
+        self.documents.text_loaded.connect(self._text_loaded)
+        self.shown_project = None
+        self.no_character = QTextDocument(self)     #Shown in the details area when there's no character selected.
+        self.no_character.setDocumentLayout(QPlainTextDocumentLayout(self.no_character))
         self.tab_bar.tabBarDoubleClicked.connect(self._rename_tab)
         self.tab_bar.event = self._tab_bar_event
         self.tab_bar.setAttribute(Qt.WA_Hover)
@@ -105,14 +129,16 @@ class KoboldUI(QMainWindow):
         main_splitter.setSizes([1, 2, 1])
         main_splitter.setHandleWidth(8)
         
-        # Setup each panel
+        # Setup each panel. The right panel and the search view aren't needed to show the story, so they wait until after the window's up. See setup_deferred_panels() and show_search_view().
         self.setup_left_panel()
         self.setup_middle_panel()
-        self.setup_right_panel()
-        self.setup_search_panel()
+        self.right_panel_built = False
+        self.project_search_bar = None
         
         self.command_entry.returnPressed.connect(self._on_command_entry_return)
         self.send_button.clicked.connect(self._on_send_button_clicked)
+        self.history_button.clicked.connect(self.history_requested.emit)
+        self.fork_button.clicked.connect(self.fork_requested.emit)
         
         self.is_generating = False
         
@@ -121,18 +147,83 @@ class KoboldUI(QMainWindow):
         # Create shortcuts
         self.search_shortcut = QShortcut(QKeySequence("Ctrl+O"), self)
     
+    def setup_deferred_panels(self):
+        if not self.right_panel_built:
+            self.right_panel_built = True
+            self.setup_right_panel()
+    
+    def show_search_view(self):
+        if self.project_search_bar is None:
+            self.setup_search_panel()
+        self.stacked_widget.setCurrentIndex(1)
+    
+    def is_search_view_showing(self):
+        return self.stacked_widget.currentIndex() == 1
+    
+    def close_search_view(self):
+        self.stacked_widget.setCurrentIndex(0)
+        self.project_search_bar.setText('')
+    
     def setup_search_panel(self):
         self.project_search_bar = QLineEdit()
+        self.project_search_bar.textChanged.connect(self.project_search_changed.emit)
         self.search_layout.addWidget(self.project_search_bar, 0)
+        self.search_status = QLabel()
+        self.search_status.hide()
+        self.search_layout.addWidget(self.search_status, 0)
         self.search_panel_button_layout = AutoGridLayout()
+        self.search_panel_button_layout.button_clicked.connect(self.project_button_clicked.emit)
         self.search_layout.addWidget(self.search_panel_button_layout, 0)
         self.search_layout.setAlignment(self.search_panel_button_layout, Qt.AlignTop)
+        # Full-text search results, a project button with a snippet under it for each. Only one of these and the grid shows at a time.
+        self.search_results = QScrollArea()
+        self.search_results.setWidgetResizable(True)
+        self.search_results.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        results_container = QWidget()
+        self.search_results_layout = QVBoxLayout(results_container)
+        self.search_results_layout.setAlignment(Qt.AlignTop)
+        self.search_results.setWidget(results_container)
+        self.search_results.hide()
+        self.search_layout.addWidget(self.search_results, 1)
         self.search_layout.addStretch(1)
 
     #TODO: I should probably change it to just pass in names, and have the controller talk directly to the auto_grid_layout.
     def project_search(self, projects):
+        self.search_results.hide()
+        self.search_status.hide()
+        self.search_panel_button_layout.show()
+        self.search_layout.setStretch(self.search_layout.count() - 1, 1)
         self.search_panel_button_layout.setButtons([project.name for project in projects])
 
+    def project_search_results(self, results, waiting = 0):
+        """Shows full-text search results, a list of (project, snippet, [(start, end) of each part of the snippet to highlight]). waiting is how many stories aren't searchable yet."""
+        self.search_panel_button_layout.hide()
+        self.search_results.show()
+        self.search_layout.setStretch(self.search_layout.count() - 1, 0)
+        if waiting:
+            self.search_status.setText(f"Still indexing {waiting} {'story' if waiting == 1 else 'stories'}...")
+        elif not results:
+            self.search_status.setText("No projects found.")
+        self.search_status.setVisible(bool(waiting or not results))
+        while self.search_results_layout.count():
+            self.search_results_layout.takeAt(0).widget().deleteLater()
+        for project, snippet, highlights in results:
+            button = QPushButton(project.name)
+            button.setStyleSheet("text-align: left; font-weight: bold;")
+            button.clicked.connect(lambda checked=False, button=button: self.project_button_clicked.emit(button))
+            self.search_results_layout.addWidget(button)
+            pieces = []
+            end = 0
+            for start, highlight_end in highlights:
+                pieces.append(html.escape(snippet[end:start]))
+                pieces.append('<b>' + html.escape(snippet[start:highlight_end]) + '</b>')
+                end = highlight_end
+            pieces.append(html.escape(snippet[end:]))
+            label = QLabel(''.join(pieces))
+            label.setTextFormat(Qt.RichText)
+            label.setWordWrap(True)
+            self.search_results_layout.addWidget(label)
+
     def setup_left_panel(self):
         layout = QVBoxLayout(self.left_panel)
         layout.setContentsMargins(MARGIN, MARGIN, 0, MARGIN)
@@ -148,7 +239,7 @@ class KoboldUI(QMainWindow):
         top_layout.addWidget(self.char_name)
         
         # Character Detail Editor
-        self.char_detail = QTextEdit()
+        self.char_detail = QPlainTextEdit()
         self.char_detail.setPlaceholderText("Character Details")
         top_layout.addWidget(self.char_detail)
         
@@ -182,6 +273,12 @@ class KoboldUI(QMainWindow):
         # Set the container as the scroll area's widget
         char_list_scroll.setWidget(char_list_container)
         bottom_layout.addWidget(char_list_scroll)
+        
+        #Searches only show the best matches. This says when there were more.
+        self.more_characters = QLabel("More characters match. Keep typing to narrow it down.")
+        self.more_characters.setWordWrap(True)
+        self.more_characters.hide()
+        bottom_layout.addWidget(self.more_characters)
         content_splitter.addWidget(bottom_widget)
         
         # Set up the menu for right clicking on character buttons
@@ -199,12 +296,13 @@ class KoboldUI(QMainWindow):
         content_splitter = QSplitter(Qt.Vertical)
         
         # Memory area
-        self.memory_area = QTextEdit()
+        self.memory_area = QPlainTextEdit()
         self.memory_area.setPlaceholderText("Memory Area")
         content_splitter.addWidget(self.memory_area)
         
         # Story area
-        self.story_area = QTextEdit()
+        #It's a QPlainTextEdit because that lays out text a paragraph at a time, instead of the whole document, so it stays smooth with very long stories.
+        self.story_area = QPlainTextEdit()
         self.story_area.setPlaceholderText("Story Area")
         content_splitter.addWidget(self.story_area)
         
@@ -240,6 +338,14 @@ class KoboldUI(QMainWindow):
         #self.send_button.clicked.connect(self.on_send)
         bottom_layout.addWidget(self.send_button)
         
+        # History button, to go back to an earlier version of the story
+        self.history_button = QPushButton("History")
+        bottom_layout.addWidget(self.history_button)
+        
+        # Fork button, to try a different way for the story to go from the cursor in a new tab
+        self.fork_button = QPushButton("Fork")
+        bottom_layout.addWidget(self.fork_button)
+        
         # Temperature
         self.temperature_label = QLabel("Temperature:")
         self.temperature = QLineEdit()
@@ -333,22 +439,40 @@ class KoboldUI(QMainWindow):
         return self.memory_area.toPlainText()
     
     def set_memory(self, text):
-        self.memory_area.setText(text)
+        self.documents.set_text(self.shown_project, 'memory', text)
     
     def get_story(self):
-        return self.story_area.toPlainText()
+        return self.documents.text(self.shown_project, 'story')
     
     def set_story(self, text):
-        self.story_area.setText(text)
+        self.documents.set_text(self.shown_project, 'story', text)
+    
+    def story_cursor_position(self):
+        return self.documents.cursor_position(self.story_area)
+    
+    def story_length(self):
+        """The length of the story in UTF-16 code units, including generated text that hasn't been written yet."""
+        return self.documents.utf16_length(self.shown_project, 'story')
+    
+    #This swaps in the project's own documents, so it doesn't matter how long the story is.
+    def show_project(self, project):
+        self.shown_project = project
+        self.documents.show(self.memory_area, project, 'memory')
+        self.documents.show(self.story_area, project, 'story')
+        #Long stories load from the end, so start there.
+        self.story_area.moveCursor(QTextCursor.MoveOperation.End)
     
     def set_character(self, character):
         self.char_name.setText('' if character is None else character.name)
-        self.char_detail.setText('' if character is None else character.description)
+        if character is None:
+            self.documents.show_document(self.char_detail, self.no_character)
+        else:
+            self.documents.show(self.char_detail, character, 'description')
     
     def get_character_description(self):
         return self.char_detail.toPlainText()
     
-    def set_character_list(self, characters, active_characters = set(), is_searching = False, character_addable = False):
+    def set_character_list(self, characters, active_characters = set(), is_searching = False, character_addable = False, more = False):
         # Clear existing buttons
         # But leave the + (first thing on the list) and the stretch (last thing)
         while self.char_list_layout.count() > 2:
@@ -362,6 +486,7 @@ class KoboldUI(QMainWindow):
         
         # Make the + visible if and only if you can add the current text as a character
         self.add_character_button.setVisible(character_addable)
+        self.more_characters.setVisible(more)
     
     def _add_character(self, name, active, is_searching):
         button = QPushButton()
@@ -412,15 +537,18 @@ class KoboldUI(QMainWindow):
     def get_temperature(self):
         return float(self.temperature.text())
     
-    def add_text(self, new_text):
-        self.text_to_add.emit(new_text)
+    #Adds generated text to the end of a project's story, whether or not it's showing. It gets written on the next frame.
+    def add_text(self, new_text, project = None):
+        self.documents.append(self.shown_project if project is None else project, 'story', new_text)
+    
+    def _text_added(self, document):
+        if document is self.story_area.document():
+            self.story_area.moveCursor(QTextCursor.MoveOperation.End)
     
-    def _add_text(self, new_text):
-        cursor = self.story_area.textCursor()
-        cursor.movePosition(cursor.MoveOperation.End)
-        self.story_area.setTextCursor(cursor)
-        self.story_area.insertPlainText(new_text)
-        QApplication.processEvents()
+    #Text going in above pushes everything down, but the scroll bar stays where it was, so it ends up looking at the new text. Put it back on the cursor, which is where the story opened.
+    def _text_loaded(self, document):
+        if document is self.story_area.document():
+            self.story_area.ensureCursorVisible()
     
     def _handle_tab_changed(self, index):
         if self.edited_tab_index >= 0:
@@ -457,13 +585,38 @@ class KoboldUI(QMainWindow):
             print("Locking story area")
         else:
             print("Unlocking story area")
-        self.story_area.setReadOnly(locked)
-        QApplication.processEvents()    #TODO: Do I need this?
+        #Get the last of the generated text in before anyone can type after it.
+        if not locked:
+            self.documents.flush()
+        self.documents.set_read_only(self.story_area, locked)
+    
+    def set_tab_state(self, index, state, queue_position = 0):
+        # An invalid QColor puts it back to the default color.
+        self.tab_bar.setTabTextColor(index, TAB_STATE_COLORS.get(state, QColor()))
+        if state == 'running':
+            self.tab_bar.setTabToolTip(index, "Generating")
+        elif state == 'queued':
+            self.tab_bar.setTabToolTip(index, f"Queued ({queue_position} in line)")
+        else:
+            self.tab_bar.setTabToolTip(index, "")
     
     def set_generating_state(self, locked = True):
         print("Setting generating state.")
         self.is_generating = locked
         self.send_button.setText("Abort" if locked else "Send")
+        #Restoring a version while text is still coming in would mix the two.
+        self.history_button.setEnabled(not locked)
+    
+    #versions is a list of (time, label, length) from StoryHistory, oldest first. The newest go at the top.
+    def show_history(self, versions):
+        menu = QMenu(self)
+        if not versions:
+            menu.addAction("No earlier versions yet").setEnabled(False)
+        for index in reversed(range(len(versions))):
+            seconds, label, length = versions[index]
+            action = menu.addAction(f"{index + 1}. {time.strftime('%b %d %H:%M:%S', time.localtime(seconds))}  {label}  ({length:,} characters)")
+            action.triggered.connect(lambda checked = False, index = index: self.version_selected.emit(index))
+        menu.exec_(self.history_button.mapToGlobal(self.history_button.rect().topLeft()))
     
     def new_tab(self, name):
         print("New tab")
@@ -539,14 +692,16 @@ class KoboldUI(QMainWindow):
         self.edited_tab_index = -1
     
     def create_window():
-        app = QApplication(sys.argv)
+        #Something else, like a benchmark, might have made one already. There can only be one.
+        app = QApplication.instance() or QApplication(sys.argv)
         window = KoboldUI()
         window.app = app
         window.showMaximized()
         return window
     
-    def run_app(self):
-        return self.app.exec()
+    #QtAsyncio runs the Qt event loop with an asyncio event loop on top of it, so the controller can run coroutines without any threads.
+    def run_app(self, coro = None):
+        return QtAsyncio.run(coro, keep_running=True, handle_sigint=True)
 
 if __name__ == "__main__":
     window = create_window()
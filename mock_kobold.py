@@ -0,0 +1,206 @@
+import re
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import kobold_api
+
+#Pieces of text it "generates". It doesn't need to make sense, just look a bit like text and include some multi-byte characters.
+WORDS = [' the', ' dragon', ' looked', ' at', ' her', ' and', ' said', ',', '.', ' "Why', ' café', ' naïve', ' 🐉', '\n\n', ' slowly', ' away']
+#Splits text into "tokens" that join back into exactly the same text.
+TOKEN_PATTERN = re.compile(r'\s*\S+|\s+')
+
+class MockKoboldServer(ThreadingHTTPServer):
+    """
+    A stand-in for kobold.cpp that answers the endpoints kobold_api uses, with made-up text and configurable timing and faults.
+
+    Like kobold.cpp, it only generates one thing at a time, and keeps the last prompt cached so only the part after the shared prefix costs processing time.
+
+    Args:
+        port: Port to listen on. 0 picks a free one.
+        time_to_first_token: Seconds before the first token, on top of prompt processing.
+        tokens_per_second: How fast it generates once it starts.
+        prompt_delay: Seconds of processing per prompt token that isn't already cached.
+        drop_rate: Chance that a generation's connection gets cut off partway through.
+        abort_delay: Seconds between an abort request and the generation actually stopping.
+        seed: Seed for the made-up text and the faults, so runs can be repeated.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=5001, time_to_first_token=0.2, tokens_per_second=20, prompt_delay=0.0005, drop_rate=0, abort_delay=0, seed=0):
+        super().__init__(('127.0.0.1', port), MockKoboldHandler)
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.prompt_delay = prompt_delay
+        self.drop_rate = drop_rate
+        self.abort_delay = abort_delay
+        self.random = random.Random(seed)
+        self.vocabulary = {}        #piece: id
+        self.pieces = []            #id: piece
+        self.cached_prompt = []
+        self.generation_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.generated = {}         #genkey: text so far, for polling
+        self.aborted = set()
+        self.connections = set()    #Sockets of the connections that are open, so kill() can cut them off.
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        super().shutdown_request(request)
+
+    def kill(self):
+        """Stops it like its process died. shutdown() only stops it listening, and connections that are kept alive would still get answered."""
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def tokenize(self, text):
+        with self.lock:
+            ids = []
+            for piece in TOKEN_PATTERN.findall(text):
+                if piece not in self.vocabulary:
+                    self.vocabulary[piece] = len(self.pieces)
+                    self.pieces.append(piece)
+                ids.append(self.vocabulary[piece])
+            return ids
+
+    def detokenize(self, ids):
+        return ''.join(self.pieces[i] for i in ids)
+
+    def process_prompt(self, settings):
+        """Sleeps for as long as processing the uncached part of the prompt would take."""
+        ids = self.tokenize(settings.get('memory', '') + settings.get('prompt', ''))
+        shared = kobold_api.shared_prefix_length(self.cached_prompt, ids)
+        self.cached_prompt = ids
+        time.sleep(self.time_to_first_token + (len(ids) - shared) * self.prompt_delay)
+
+    def generate(self, settings):
+        """Yields (token, finish_reason) tuples at tokens_per_second, or raises ConnectionResetError if it decides to drop the connection."""
+        genkey = settings.get('genkey', '')
+        max_length = settings.get('max_length', 100)
+        drop_at = self.random.randrange(max_length) if self.random.random() < self.drop_rate else None
+        with self.generation_lock:
+            self.aborted.discard(genkey)
+            self.generated[genkey] = ''
+            self.process_prompt(settings)
+            for i in range(max_length):
+                if drop_at == i:
+                    raise ConnectionResetError("Dropping the connection on purpose.")
+                if genkey in self.aborted:
+                    self.aborted.discard(genkey)
+                    yield '', 'stop'
+                    return
+                token = self.random.choice(WORDS)
+                self.generated[genkey] += token
+                time.sleep(1 / self.tokens_per_second)
+                yield token, 'length' if i == max_length - 1 else None
+
+    def abort(self, genkey):
+        def abort_later():
+            time.sleep(self.abort_delay)
+            self.aborted.add(genkey)
+        threading.Thread(target=abort_later, daemon=True).start()
+
+class MockKoboldHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  #Otherwise the headers and body go out as separate packets and a kept-alive connection waits on delayed ACKs.
+
+    def do_GET(self):
+        if self.path == kobold_api.VERSION_PATH:
+            self._reply({'result': 'KoboldCpp', 'version': 'mock'})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        if self.path == kobold_api.STREAM_PATH:
+            self._stream(body)
+        elif self.path == kobold_api.GENERATE_PATH:
+            try:
+                text = ''.join(token for token, finish_reason in server.generate(body))
+            except ConnectionResetError:
+                self.close_connection = True
+                return
+            self._reply({'results': [{'text': text}]})
+        elif self.path == kobold_api.POLL_PATH:
+            self._reply({'results': [{'text': server.generated.get(body.get('genkey', ''), '')}]})
+        elif self.path == kobold_api.TOKEN_COUNT_PATH:
+            ids = server.tokenize(body['prompt'])
+            self._reply({'value': len(ids), 'ids': ids})
+        elif self.path == kobold_api.DETOKENIZE_PATH:
+            self._reply({'result': server.detokenize(body['ids']), 'success': True})
+        elif self.path == kobold_api.ABORT_PATH:
+            server.abort(body.get('genkey', ''))
+            self._reply({'success': 'true'})
+        else:
+            self.send_error(404)
+
+    def _reply(self, reply):
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    #kobold.cpp doesn't send a length or use chunked encoding for the stream. It just closes the connection at the end.
+    def _stream(self, settings):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for token, finish_reason in self.server.generate(settings):
+                self.wfile.write(f'event: message\ndata: {json.dumps({"token": token, "finish_reason": finish_reason})}\n\n'.encode())
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def start(**kwargs):
+    """Starts a MockKoboldServer on a background thread and returns it. Call shutdown() on it to stop it."""
+    server = MockKoboldServer(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='A stand-in for kobold.cpp, for testing without a model.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--ttft', type=float, default=0.2, help='Seconds before the first token, on top of prompt processing.')
+    parser.add_argument('--tps', type=float, default=20, help='Tokens per second.')
+    parser.add_argument('--prompt-delay', type=float, default=0.0005, help='Seconds per uncached prompt token.')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Chance a generation gets its connection cut partway through.')
+    parser.add_argument('--abort-delay', type=float, default=0, help='Seconds between an abort and the generation stopping.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    server = MockKoboldServer(args.port, args.ttft, args.tps, args.prompt_delay, args.drop_rate, args.abort_delay, args.seed)
+    #Flushed, so something running it with --port 0 can read which port it got.
+    print(f"Mock kobold.cpp listening on {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 import traceback
+import uuid
+from story_buffer import StoryBuffer
+from story_history import StoryHistory
 
 class Character:
     def __init__(self, name, description=''):
@@ -10,6 +13,23 @@ class Character:
     def to_dictionary(self):
         return {'name':self.name, 'description':self.description}
 
+#A set that remembers the order things were added in. Sets iterate in whatever order their hashes put them in, which changes between runs, and the prompt needs the characters in the same order every time or kobold.cpp has to reprocess everything after the first difference.
+class OrderedSet:
+    def __init__(self, items=()):
+        self._items = dict.fromkeys(items)
+    def add(self, item):
+        self._items[item] = None
+    def discard(self, item):
+        self._items.pop(item, None)
+    def remove(self, item):
+        del self._items[item]
+    def __contains__(self, item):
+        return item in self._items
+    def __iter__(self):
+        return iter(self._items)
+    def __len__(self):
+        return len(self._items)
+
 class Project:
     named_projects = {}
     open_projects = []
@@ -17,6 +37,8 @@ class Project:
     max_tokens = 100
     temperature = 0.7
     story_index = 0
+    endpoints = ['http://localhost:5001']  #The kobold.cpp servers to generate on. See endpoint_pool.py.
+    pacing = 'adaptive'     #How the typing animation paces generated text. See typing_worker.PACERS.
     
     def start_empty():
         Project.all_characters = {}
@@ -25,52 +47,178 @@ class Project:
         Project.max_tokens = 500
         Project.temperature = 0.7
         Project.story_index = 0
+        Project.endpoints = ['http://localhost:5001']
+        Project.pacing = 'adaptive'
     
     def __init__(self):
+        self.id = uuid.uuid4().hex    #Stays the same when it's renamed, so the save journal can tell which project an edit goes to. See save_journal.py.
         self.name = ''
+        self.parent_id = None       #The id of the project this was forked from, if it was. See fork().
+        self._load_body = None      #Reads the story and memory from the save, if they haven't been read yet. See save_journal.py.
+        self._deferred = []         #Changes to make to the story and memory once they're read.
         self.memory = ''
         self.story = ''
-        self.project_characters = set()
-        self.active_characters = set()
+        self.project_characters = OrderedSet()
+        self.active_characters = OrderedSet()
         self.selected_character = None
+        self.prompt_start = None    #Where in the story the last prompt started. See prompt_builder.build_prompt().
+        self.prompt_opening = None  #The text it started with.
+        self.token_counts = {}      #Token counts of the memory and descriptions from the last prompt. See prompt_builder.build_prompt().
+        self.history = StoryHistory()   #Earlier versions of the story, from before each send and after each generation.
+    
+    #The story is a StoryBuffer so generated text can be appended a token at a time without copying the whole story. Setting it to a str wraps it in one.
+    @property
+    def story(self):
+        self._load()
+        return self._story
+    
+    @story.setter
+    def story(self, text):
+        self._load()
+        self._story = text if isinstance(text, StoryBuffer) else StoryBuffer(text)
+    
+    @property
+    def memory(self):
+        self._load()
+        return self._memory
+    
+    @memory.setter
+    def memory(self, text):
+        self._load()
+        self._memory = text
+    
+    #The story and memory (the project's "body") can stay in the save until something uses them, so projects nobody opens don't cost anything to load.
+    def is_loaded(self):
+        return self._load_body is None
+    
+    def unload(self, load_body):
+        """Drops the story and memory. load_body gets called to get (story, memory) back the next time something uses them."""
+        self._load_body = load_body
+        self._story = None
+        self._memory = None
     
+    def defer(self, change):
+        """Calls change with this project once its story and memory are loaded, or now if they already are."""
+        if self.is_loaded():
+            change(self)
+        else:
+            self._deferred.append(change)
+    
+    def _load(self):
+        if self._load_body is None:
+            return
+        load_body = self._load_body
+        self._load_body = None
+        story, memory = load_body()
+        self._story = story if isinstance(story, StoryBuffer) else StoryBuffer(story)
+        self._memory = memory
+        deferred = self._deferred
+        self._deferred = []
+        for change in deferred:
+            change(self)
+    
+    def fork(self, position=None):
+        """A new project that starts as a copy of this one, with the story up to position (or all of it), to try a different way for it to go. It shares the story and its history with this one instead of copying them."""
+        project = Project()
+        project.parent_id = self.id
+        project.story = self.story.fork(position)
+        project.memory = self.memory
+        project.project_characters = OrderedSet(self.project_characters)
+        project.active_characters = OrderedSet(self.active_characters)
+        project.selected_character = self.selected_character
+        project.history = self.history.fork()
+        return project
+    
+    #Saves from before save_journal.py have the story and memory in with everything else. Newer ones leave them out, for the journal to load when they're needed. Forks have their story as pieces of their parent's, and get put together once their parent's loaded. See load_from_dictionary().
     def from_dictionary(dictionary):
         project = Project()
-        project.name = dictionary['name']
-        project.memory = dictionary['memory']
-        project.story = dictionary['story']
-        project.project_characters = set(Project.all_characters[name] for name in dictionary['project_characters'])
-        project.active_characters = set(Project.all_characters[name] for name in dictionary['active_characters'])
-        name = dictionary['selected_character']
-        project.selected_character = None if name == '' else Project.all_characters[name]
+        project.id = dictionary.get('id', project.id)
+        if 'story' in dictionary:
+            project.story = dictionary['story']
+        if 'story' in dictionary or 'pieces' in dictionary:
+            project.memory = dictionary['memory']
+        project.load_meta(dictionary)
         return project
     
-    def to_dictionary(self):
+    #Everything but the story and memory, which are the only parts that get big.
+    def load_meta(self, dictionary):
+        self.name = dictionary['name']
+        self.parent_id = dictionary.get('parent')
+        self.project_characters = OrderedSet(Project.all_characters[name] for name in dictionary['project_characters'])
+        self.active_characters = OrderedSet(Project.all_characters[name] for name in dictionary['active_characters'])
+        name = dictionary['selected_character']
+        self.selected_character = None if name == '' else Project.all_characters[name]
+    
+    def meta_to_dictionary(self):
         return {
+            'id': self.id,
             'name': self.name,
-            'memory': self.memory,
-            'story': self.story,
+            'parent': self.parent_id,
             'project_characters': [character.name.lower() for character in self.project_characters],
             'active_characters': [character.name.lower() for character in self.active_characters],
             'selected_character': '' if self.selected_character is None else self.selected_character.name.lower(),
         }
     
+    #If it's given its parent, the story is saved as pieces of the parent's. See StoryBuffer.pieces().
+    def to_dictionary(self, parent=None):
+        dictionary = self.meta_to_dictionary()
+        dictionary['memory'] = self.memory
+        if parent is None:
+            dictionary['story'] = str(self.story)
+        else:
+            dictionary['pieces'] = self.story.pieces(parent.story)
+        return dictionary
+    
     def load_from_dictionary(dictionary):
         #all_characters must be read first since those characters are loaded into the other variables.
         Project.all_characters = {name:Character.from_dictionary(char_dict) for name, char_dict in dictionary['all_characters'].items()}
         Project.named_projects = {name:Project.from_dictionary(project_dict) for name, project_dict in dictionary['named_projects'].items()}
         Project.open_projects = [Project.named_projects[project_dict] if isinstance(project_dict, str) else Project.from_dictionary(project_dict) for project_dict in dictionary['open_projects']]
+        Project.load_settings(dictionary)
+        #Forks get the start of their story from their parent, which might be a fork too.
+        projects = {project.id: project for project in Project._all()}
+        project_dicts = [project_dict for project_dict in list(dictionary['named_projects'].values()) + dictionary['open_projects'] if isinstance(project_dict, dict)]
+        pieces = {project_dict['id']: project_dict['pieces'] for project_dict in project_dicts if 'pieces' in project_dict}
+        def join(project):
+            if project.id not in pieces:
+                return
+            parent = projects[project.parent_id]
+            join(parent)
+            project.story = StoryBuffer.from_pieces(pieces.pop(project.id), parent.story)
+        for project in projects.values():
+            join(project)
+    
+    def load_settings(dictionary):
         Project.max_tokens = dictionary['max_tokens']
         Project.temperature = dictionary['temperature']
         Project.story_index = dictionary['story_index']
+        Project.endpoints = dictionary.get('endpoints', ['http://localhost:5001'])
+        Project.pacing = dictionary.get('pacing', 'adaptive')
     
-    def all_to_dictionary():
-        myDict = {
-            'named_projects': {name: project.to_dictionary() for name, project in Project.named_projects.items()},
-            'open_projects': [project.to_dictionary() if project.name == '' else project.name.lower() for project in Project.open_projects],
-            'all_characters': {name: character.to_dictionary() for name, character in Project.all_characters.items()},
+    def settings_to_dictionary():
+        return {
             'max_tokens': Project.max_tokens,
             'temperature': Project.temperature,
             'story_index': Project.story_index,
+            'endpoints': list(Project.endpoints),
+            'pacing': Project.pacing,
+        }
+    
+    #Every project in a list, named ones first.
+    def _all():
+        projects = {project.id: project for project in Project.named_projects.values()}
+        projects.update((project.id, project) for project in Project.open_projects)
+        return list(projects.values())
+    
+    def all_to_dictionary():
+        #Forks are saved as what they add to their parent, as long as their parent's saved too.
+        projects = {project.id: project for project in Project._all()}
+        def to_dictionary(project):
+            return project.to_dictionary(projects.get(project.parent_id))
+        myDict = {
+            'named_projects': {name: to_dictionary(project) for name, project in Project.named_projects.items()},
+            'open_projects': [to_dictionary(project) if project.name == '' else project.name.lower() for project in Project.open_projects],
+            'all_characters': {name: character.to_dictionary() for name, character in Project.all_characters.items()},
         }
+        myDict.update(Project.settings_to_dictionary())
         return myDict
\ No newline at end of file
@@ -0,0 +1,126 @@
+import asyncio
+import kobold_api
+
+#Memory and character descriptions can use at most this much of the context that's left after reserving room for the reply. The story gets the rest, plus whatever they don't use.
+MEMORY_SHARE = 0.5
+#Joining the pieces together can tokenize a little differently than counting them separately, so leave a few tokens of slack.
+SAFETY_MARGIN = 8
+#Used to guess how much of the end of the story to tokenize. It's deliberately generous, since guessing too low means tokenizing again.
+MAX_CHARS_PER_TOKEN = 8
+SEPARATOR = '\n\n'
+#When the story has to be trimmed, trim this much of the budget extra. The next few sends can then start the story at the same place, so kobold.cpp sees the same prefix and can reuse its cache instead of reprocessing it.
+TRIM_SLACK = 0.25
+#How much of the start of the story's part of the prompt gets kept, to find where it started again next time.
+OPENING_LENGTH = 64
+
+async def build_prompt(client, memory, characters, story, max_length, max_context_length=None, story_start=None, story_opening=None, token_counts=None):
+    """
+    Fits the memory, character descriptions and story into the context window, so the server never has to truncate it itself.
+
+    Args:
+        client: An AsyncKoboldClient, used for counting tokens and detokenizing.
+        memory: The memory text.
+        characters: (name, description) pairs for the active characters, in the order they should appear.
+        story: The whole story, as a str or StoryBuffer. Only the end of it is tokenized.
+        max_length: How many tokens to reserve for the reply.
+        max_context_length: Size of the context window. Defaults to the one in kobold_api.baseSettings.
+        story_start: Where in the story the last prompt started (breakdown['story_start'] from last time). If the story from there still fits, it starts there again.
+        story_opening: The text the last prompt's story started with (breakdown['story_opening'] from last time). Edits before story_start move the text after it, so it's used to check it's still starting at the same text, or find where that went.
+        token_counts: A dictionary to keep token counts of the memory and descriptions in between calls, so the ones that haven't changed don't get counted again. Pass the same one each time for the same project.
+
+    Returns:
+        (memory, story, breakdown), where memory has the character descriptions that fit appended to it, story is the part of the story that fits, and breakdown is a dictionary of what was included and how many tokens each part used.
+    """
+    if max_context_length is None:
+        max_context_length = kobold_api.baseSettings['max_context_length']
+    available = max(0, max_context_length - max_length - SAFETY_MARGIN)
+    memory_budget = int(available * MEMORY_SHARE)
+
+    memory = memory.strip()
+    characters = [(name, description.strip()) for name, description in characters if description.strip() != '']
+    texts = [memory] + [description for name, description in characters]
+    cached = {} if token_counts is None else token_counts
+    new_texts = list(dict.fromkeys(text for text in texts if text not in cached))
+    for text, count in zip(new_texts, await asyncio.gather(*[client.token_count(text) for text in new_texts])):
+        cached[text] = count
+    counts = [cached[text] for text in texts]
+    #Only keep the ones in use, so it doesn't grow every time the memory is edited.
+    for text in set(cached) - set(texts):
+        del cached[text]
+
+    memory_tokens, memory_ids = counts[0]
+    memory_truncated = memory_tokens > memory_budget
+    if memory_truncated:
+        memory = await client.detokenize(memory_ids[:memory_budget])
+        memory_tokens = memory_budget
+    used = memory_tokens
+    included = [memory] if memory != '' else []
+    character_breakdown = []
+    for (name, description), (tokens, ids) in zip(characters, counts[1:]):
+        fits = used + tokens <= memory_budget
+        if fits:
+            included.append(description)
+            used += tokens
+        character_breakdown.append({'name': name, 'tokens': tokens, 'included': fits})
+    memory = SEPARATOR.join(included) + SEPARATOR if included else ''
+
+    story_budget = available - used
+    story_text, story_tokens = await _keep_end(client, story, story_budget, _find_start(story, story_start, story_opening))
+    breakdown = {
+        'max_context_length': max_context_length,
+        'reserved_for_reply': max_length,
+        'memory_tokens': memory_tokens,
+        'memory_truncated': memory_truncated,
+        'characters': character_breakdown,
+        'story_tokens': story_tokens,
+        'story_characters_included': len(story_text),
+        'story_characters_dropped': len(story) - len(story_text),
+        'story_start': len(story) - len(story_text),
+        'story_opening': story_text[:OPENING_LENGTH],
+    }
+    return memory, story_text, breakdown
+
+#Where the text the last prompt started with is now. It's at the same place unless something before it was edited, and then it's looked for nearby, closest first. None if it's gone.
+def _find_start(text, start, opening):
+    if start is None or not opening or start > len(text):
+        return None
+    if text[start:start + len(opening)] == opening:
+        return start
+    #About as far as the prompt went, either way.
+    reach = max(len(opening), len(text) - start)
+    window_start = max(0, start - reach)
+    window = text[window_start:start + reach + len(opening)]
+    offset = start - window_start
+    found = [position + window_start for position in (window.rfind(opening, 0, offset + len(opening)), window.find(opening, offset)) if position != -1]
+    return min(found, key=lambda position: abs(position - start)) if found else None
+
+#Returns the end of the text that fits in the budget and how many tokens it is. It only tokenizes a tail of the text that's probably big enough, and only goes further back if that wasn't enough.
+async def _keep_end(client, text, budget, start=None):
+    if budget <= 0:
+        return '', 0
+    if start is not None and 0 < start <= len(text):
+        tokens, ids = await client.token_count(text[start:])
+        if tokens <= budget:
+            return text[start:], tokens
+    tail_length = budget * MAX_CHARS_PER_TOKEN
+    while True:
+        tail = text[-tail_length:]
+        tokens, ids = await client.token_count(tail)
+        if tokens > budget:
+            keep = budget - int(budget * TRIM_SLACK)
+            kept = await client.detokenize(ids[-keep:])
+            #It has to be a real part of the text, since where it starts gets used again next time. Detokenizing doesn't always give back exactly the same characters, like when the cut is in the middle of a multi-byte character. That's nearly always right at the start, so it keeps as much of the text as matches kept from the end. If they differ further in than that, it just keeps as many characters as kept has.
+            matching = len(kept) if tail.endswith(kept) else _common_suffix_length(tail, kept)
+            length = matching if len(kept) - matching <= MAX_CHARS_PER_TOKEN else min(len(kept), len(tail))
+            return tail[len(tail) - length:], keep
+        if len(tail) == len(text):
+            return str(text), tokens
+        tail_length *= 2
+
+def _common_suffix_length(a, b):
+    length = 0
+    for x, y in zip(reversed(a), reversed(b)):
+        if x != y:
+            break
+        length += 1
+    return length
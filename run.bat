@@ -1,7 +1,7 @@
 if not exist venv (
     python -m venv venv
     call venv\Scripts\activate
-    pip install PySide6 requests
+    pip install -r requirements.txt
 )
 
 call venv\Scripts\activate
@@ -0,0 +1,564 @@
+import os
+import re
+import json
+import hashlib
+import weakref
+import threading
+from narrative_data import Project, Character
+from story_buffer import StoryBuffer, Chunk
+from story_search import SEARCH_DIRECTORY, index_bodies
+
+SNAPSHOT_FILE = 'save.json'
+JOURNAL_FILE = 'save.journal'
+#Each project's story and memory get their own file in here, so loading the rest of the save doesn't have to read them.
+BODY_DIRECTORY = 'stories'
+#The stories themselves, in pieces named after a hash of what's in them, so stories that have the same piece (like forks, see Project.fork()) share the file.
+CHUNK_DIRECTORY = 'chunks'
+#The journal gets folded into a new snapshot once it's bigger than the snapshot, so the time spent writing snapshots stays proportional to how much has changed. Below this size it's not worth it.
+MIN_COMPACT_SIZE = 1024 * 1024
+
+class SaveJournal:
+    """
+    Saves by appending what changed since the last save to a journal, instead of writing everything out again.
+
+    The snapshot is save.json, an index of everything but the stories and memories, and a file in stories/ for each project with its story and memory (its "body"). The index has each project's name, characters, story length and which body file it's in. Each journal file, save.journal.<generation>, has one line of JSON per save with what changed on top of the snapshot of that generation. Loading reads the index and replays the journals on top of it.
+
+    Bodies only get read when something uses them (see Project.is_loaded()), so starting up doesn't depend on how big the stories are. Changes to them from the journal wait until then too.
+
+    A body file lists the chunks of its story (see StoryBuffer.chunks()), which are files in chunks/ named by the hash of what's in them. Forks share most of their chunks with the story they came from, so they share the files too, and stories loaded at the same time share the chunks they both have in memory. A new fork gets journaled as which project it came from and its story as pieces of that one's (see StoryBuffer.pieces()).
+
+    Stories only journal their edits (see StoryBuffer.take_edits()). Everything else is small, so it gets compared to what was last saved and journaled whole if it's different. Projects are kept track of by their id, so renaming one doesn't lose track of it.
+
+    When the journal gets big, compact() starts a new journal and writes a new snapshot on a background thread. Only bodies that changed get written, each to a new file. The index gets written to a temporary file and renamed over the old one, so there's always a whole snapshot. The old journals and bodies only get deleted once the new index is in place, so crashing at any point loses at most the last save.
+
+    Writing a snapshot also indexes the bodies it wrote for searching, into search/ (see story_search.py), so the search index never has to be built at startup.
+    """
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.generation = 0         #The generation of the journal being written to.
+        self.journal = None         #The open journal file
+        self.journal_size = 0
+        self.snapshot_size = 0
+        self.body_files = {}        #id: the file in BODY_DIRECTORY with that project's body in the snapshot
+        self.story_lengths = {}     #id: how long its story was in the snapshot
+        self.dirty = set()          #ids of projects whose body changed since the snapshot
+        self.compacting = None      #The thread writing a snapshot, if there is one.
+        self.compaction = None      #(body_files, story_lengths, ids of the bodies it wrote) for the snapshot being written, to use once it's done.
+        self.compacted = False      #Whether the last snapshot got written.
+        self.saved_characters = {}  #name: dictionary, as of the last save
+        self.saved_projects = {}    #id: (story, meta dictionary, memory) as of the last save. The story and memory are None if they weren't loaded. If the story isn't the same StoryBuffer anymore, it was replaced and gets saved whole.
+        self.saved_world = None
+        self.writing = set()        #Body files BodyWriters are still writing.
+        self.chunks = weakref.WeakValueDictionary()     #hash: a chunk that's been loaded, for as long as some story has it
+        self.preloading = None      #The thread reading bodies ahead of time, if there is one. See preload().
+        self.preloaded = {}         #file name: (story, memory) it read, until they're used
+        self.lock = threading.Lock()    #For chunks and preloaded, which the preloading thread uses too
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def _journal_path(self, generation):
+        return self._path(f'{JOURNAL_FILE}.{generation}')
+
+    #Generations of the journals on disk, in order.
+    def _journal_generations(self):
+        pattern = re.compile(re.escape(JOURNAL_FILE) + r'\.(\d+)$')
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+
+    def load(self):
+        """Loads the index and replays the journals on top of it. Returns False if there's no save at all, and starts an empty one."""
+        try:
+            with open(self._path(SNAPSHOT_FILE), 'r') as infile:
+                dictionary = json.load(infile)
+            Project.load_from_dictionary(dictionary)
+            self.generation = dictionary.get('generation', 0)
+        except FileNotFoundError:
+            #There's no snapshot until the first journal gets big enough, so this might still have journals to replay.
+            dictionary = None
+            Project.start_empty()
+            self.generation = 0
+        projects = self._all_projects()
+        index_entries = [] if dictionary is None else [entry for entry in list(dictionary['named_projects'].values()) + dictionary['open_projects'] if isinstance(entry, dict)]
+        for entry in index_entries:
+            if 'body' in entry:
+                self.body_files[entry['id']] = entry['body']
+                self.story_lengths[entry['id']] = entry['story_length']
+                self._unload(projects[entry['id']])
+        self.snapshot_size = sum(self.story_lengths.values()) + (0 if dictionary is None else os.path.getsize(self._path(SNAPSHOT_FILE)))
+        replayed = 0
+        for generation in self._journal_generations():
+            #Anything older is already in the snapshot. Anything after a gap can't be applied.
+            if generation != self.generation + replayed:
+                continue
+            self._replay(generation, projects)
+            replayed += 1
+        #This goes after the journal's changes, so they don't count as new ones.
+        for project in projects.values():
+            if not project.is_loaded():
+                project.defer(self._body_loaded)
+        self.generation += max(0, replayed - 1)
+        #A new save doesn't have anything to compare to, so the first save journals everything, including the empty project it starts with.
+        if dictionary is not None or replayed > 0:
+            self._mark_saved()
+        self._open_journal(fresh=replayed == 0)
+        #Saves from before there were body files have everything in save.json, and the journal can't refer to their projects until there's a snapshot with ids. If it crashed partway through compacting, there's more than one journal to fold in.
+        if replayed > 1 or any('body' not in entry for entry in index_entries):
+            self.compact()
+        return dictionary is not None or replayed > 0
+
+    #Bodies from before there were chunks, and from BodyWriter, have the story in them.
+    def _read_body(self, file_name):
+        with open(self._path(BODY_DIRECTORY, file_name), 'r') as infile:
+            body = json.load(infile)
+        if 'chunks' in body:
+            return StoryBuffer.from_chunks(self._read_chunk(hash) for hash in body['chunks']), body['memory']
+        return body['story'], body['memory']
+
+    #A body's memory and the pieces of its story, without making a StoryBuffer of them. Old bodies have the whole story as one piece.
+    def _body_parts(self, file_name):
+        with open(self._path(BODY_DIRECTORY, file_name), 'r') as infile:
+            body = json.load(infile)
+        if 'chunks' in body:
+            return body['memory'], [self._read_chunk(hash) for hash in body['chunks']]
+        return body['memory'], [body['story']]
+
+    def read_part(self, file_name, part):
+        """Part of a body: its memory if part is 0, or the part - 1th chunk of its story, like the search index has them (see story_search.document_words()). None if there isn't one."""
+        with open(self._path(BODY_DIRECTORY, file_name), 'r') as infile:
+            body = json.load(infile)
+        if part == 0:
+            return body['memory']
+        if 'chunks' not in body:
+            return body['story'] if part == 1 else None
+        if part > len(body['chunks']):
+            return None
+        return self._read_chunk(body['chunks'][part - 1])
+
+    def _read_chunk(self, hash):
+        with self.lock:
+            chunk = self.chunks.get(hash)
+        if chunk is None:
+            with open(self._path(CHUNK_DIRECTORY, hash), 'rb') as infile:
+                chunk = Chunk(infile.read().decode())
+            #If the other thread read it at the same time, they both use whichever got there first.
+            with self.lock:
+                chunk = self.chunks.setdefault(hash, chunk)
+        return chunk
+
+    #Leaves the project's body in its file until something uses it.
+    def _unload(self, project):
+        file_name = self.body_files[project.id]
+        project.unload(lambda: self._load_body(file_name))
+
+    def _load_body(self, file_name):
+        with self.lock:
+            body = self.preloaded.pop(file_name, None)
+        return self._read_body(file_name) if body is None else body
+
+    def preload(self, projects, done=None):
+        """
+        Starts reading the bodies of these projects on a background thread, in order, so they're already read when they get used. Ones that are loaded already get skipped. done gets called on that thread once it's finished.
+
+        It's for tabs that are open but not showing. Reading every body there is would undo leaving them in their files.
+        """
+        file_names = [self.body_files[project.id] for project in projects if not project.is_loaded() and project.id in self.body_files]
+        self.preloading = threading.Thread(target=self._preload, args=(file_names, done), daemon=True)
+        self.preloading.start()
+
+    def _preload(self, file_names, done):
+        for file_name in file_names:
+            try:
+                body = self._read_body(file_name)
+            except OSError:
+                continue    #It'll be read again when it's used, and say what went wrong then.
+            with self.lock:
+                self.preloaded[file_name] = body
+        if done is not None:
+            done()
+
+    #When a body's loaded, that's what the next save compares against.
+    def _body_loaded(self, project):
+        project.story.take_edits()
+        saved = self.saved_projects.get(project.id)
+        if saved is not None:
+            self.saved_projects[project.id] = (project.story, saved[1], project.memory)
+
+    def _replay(self, generation, projects):
+        path = self._journal_path(generation)
+        valid = 0
+        with open(path, 'rb') as infile:
+            for line in infile:
+                #The last line might only be half written, if it crashed in the middle of saving.
+                if not line.endswith(b'\n'):
+                    print(f"Ignoring an incomplete save at the end of {path}.")
+                    break
+                self._apply(json.loads(line), projects)
+                valid += len(line)
+        #Cut it off there, so the next save doesn't get stuck to the end of it.
+        if valid != os.path.getsize(path):
+            os.truncate(path, valid)
+
+    def _apply(self, entry, projects):
+        #Characters get changed in place, so the projects that have them keep the same object.
+        for name, dictionary in entry.get('characters', {}).items():
+            if dictionary is None:
+                continue
+            character = Project.all_characters.get(name)
+            if character is None:
+                Project.all_characters[name] = Character.from_dictionary(dictionary)
+            else:
+                character.name = dictionary['name']
+                character.description = dictionary['description']
+        for id, change in entry.get('projects', {}).items():
+            project = projects.get(id)
+            if project is None:
+                project = projects[id] = Project()
+                project.id = id
+            #A body that was written straight to its file. See BodyWriter.
+            if 'body' in change:
+                self.body_files[id] = change['body']
+                self.story_lengths[id] = change['story_length']
+                self.dirty.discard(id)
+                self._unload(project)
+            if 'story' in change or 'edits' in change or 'memory' in change:
+                self.dirty.add(id)
+                project.defer(lambda project, change=change: self._apply_body(project, change))
+            if 'meta' in change:
+                project.load_meta(change['meta'])
+        #Forks start from their parent as of the end of this save, so they go after everything else. A fork of a fork needs the one it's from to be done first.
+        forks = {id: change['fork'] for id, change in entry.get('projects', {}).items() if 'fork' in change}
+        def apply_fork(id):
+            parent_id, pieces = forks.pop(id)
+            if parent_id in forks:
+                apply_fork(parent_id)
+            self.dirty.add(id)
+            projects[id].defer(lambda project: self._apply_fork(project, projects[parent_id], pieces))
+        while forks:
+            apply_fork(next(iter(forks)))
+        world = entry.get('world')
+        if world is not None:
+            Project.named_projects = {name: projects[id] for name, id in world['named_projects'].items()}
+            Project.open_projects = [projects[id] for id in world['open_projects']]
+            Project.load_settings(world)
+        #Deleted last, since they're only gone once nothing refers to them.
+        for name, dictionary in entry.get('characters', {}).items():
+            if dictionary is None:
+                Project.all_characters.pop(name, None)
+
+    def _apply_body(self, project, change):
+        if 'story' in change:
+            project.story = change['story']
+        for position, removed, text in change.get('edits', []):
+            project.story.replace(position, removed, text)
+        if 'memory' in change:
+            project.memory = change['memory']
+
+    def _apply_fork(self, project, parent, pieces):
+        project.story = StoryBuffer.from_pieces(pieces, parent.story)
+
+    def _all_projects(self):
+        projects = {project.id: project for project in Project.named_projects.values()}
+        projects.update((project.id, project) for project in Project.open_projects)
+        return projects
+
+    def _world(self):
+        world = {
+            'named_projects': {name: project.id for name, project in Project.named_projects.items()},
+            'open_projects': [project.id for project in Project.open_projects],
+        }
+        world.update(Project.settings_to_dictionary())
+        return world
+
+    #Makes what's loaded now the baseline for the next save.
+    def _mark_saved(self):
+        self.saved_characters = {name: character.to_dictionary() for name, character in Project.all_characters.items()}
+        self.saved_projects = {}
+        for id, project in self._all_projects().items():
+            if project.is_loaded():
+                project.story.take_edits()
+                self.saved_projects[id] = (project.story, project.meta_to_dictionary(), project.memory)
+            else:
+                self.saved_projects[id] = (None, project.meta_to_dictionary(), None)
+        self.saved_world = self._world()
+
+    def changes(self):
+        """What changed since the last save, as a journal entry, or None if nothing did. It counts as saved after this, so it should go in the journal."""
+        entry = {}
+        characters = {name: character.to_dictionary() for name, character in Project.all_characters.items()}
+        changed = {name: dictionary for name, dictionary in characters.items() if self.saved_characters.get(name) != dictionary}
+        changed.update((name, None) for name in self.saved_characters.keys() - characters.keys())
+        if changed:
+            entry['characters'] = changed
+        self.saved_characters = characters
+        projects = {}
+        saved_projects = {}
+        projects_now = self._all_projects()
+        for id, project in projects_now.items():
+            change = {}
+            saved = self.saved_projects.get(id)
+            meta = project.meta_to_dictionary()
+            if saved is None or saved[1] != meta:
+                change['meta'] = meta
+            #A body that isn't loaded can't have changed.
+            if project.is_loaded():
+                edits = project.story.take_edits()
+                parent = projects_now.get(project.parent_id)
+                #A new fork only needs what it doesn't share with its parent.
+                pieces = project.story.pieces(parent.story) if saved is None and parent is not None and parent.is_loaded() else []
+                if any(isinstance(piece, list) for piece in pieces):
+                    change['fork'] = [parent.id, pieces]
+                elif saved is None or saved[0] is not project.story:
+                    change['story'] = str(project.story)
+                elif edits:
+                    change['edits'] = edits
+                if saved is None or saved[2] != project.memory:
+                    change['memory'] = project.memory
+                if 'story' in change or 'fork' in change or 'edits' in change or 'memory' in change:
+                    self.dirty.add(id)
+                saved_projects[id] = (project.story, meta, project.memory)
+            else:
+                saved_projects[id] = (None, meta, None)
+            if change:
+                projects[id] = change
+        if projects:
+            entry['projects'] = projects
+        #Projects that aren't in any list anymore, like closed untitled ones, are just left out.
+        self.saved_projects = saved_projects
+        world = self._world()
+        if world != self.saved_world:
+            entry['world'] = world
+        self.saved_world = world
+        return entry or None
+
+    def save(self):
+        """Appends whatever changed to the journal, and starts compacting if the journal's gotten big enough. Returns whether there was anything to save."""
+        self._check_compaction()
+        if not self._append(self.changes()):
+            return False
+        if self.journal_size > max(MIN_COMPACT_SIZE, self.snapshot_size):
+            self.compact()
+        return True
+
+    def unload(self, project):
+        """Drops the project's story and memory if they're already in the snapshot, like when its tab closes. They get read again if it's opened again. Returns whether it did."""
+        self._check_compaction()
+        self._append(self.changes())
+        #A tab that closes before it's shown doesn't need what was read ahead for it.
+        with self.lock:
+            self.preloaded.pop(self.body_files.get(project.id), None)
+        if not project.is_loaded() or project.id in self.dirty or project.id not in self.body_files or self.compaction is not None:
+            return False
+        self._unload(project)
+        project.defer(self._body_loaded)
+        saved = self.saved_projects[project.id]
+        self.saved_projects[project.id] = (None, saved[1], None)
+        return True
+
+    def snapshot_bodies(self):
+        """{id: body file} for the projects whose story and memory are the same as in their body file in the snapshot, for the search index (see StorySearch)."""
+        self._check_compaction()
+        writing = set() if self.compaction is None else set(self.compaction[2])
+        bodies = {}
+        for id, project in self._all_projects().items():
+            if id in self.dirty or id in writing or id not in self.body_files:
+                continue
+            #A loaded one might have changed since the last save.
+            if project.is_loaded():
+                saved = self.saved_projects.get(id)
+                if saved is None or saved[0] is not project.story or saved[2] != project.memory or project.story.has_edits():
+                    continue
+            bodies[id] = self.body_files[id]
+        return bodies
+
+    def open_body(self, project):
+        """Returns a BodyWriter to write a new project's story straight to a body file, a piece at a time. The project should be new, and not in any list yet."""
+        #A snapshot that's being written would delete the file, since it's not in it.
+        if self.compacting is not None:
+            self.compacting.join()
+        self._check_compaction()
+        os.makedirs(self._path(BODY_DIRECTORY), exist_ok=True)
+        file_name = f'{project.id}.{self.generation}.json'
+        self.writing.add(file_name)
+        return BodyWriter(self, project, file_name)
+
+    #The body's in its file, so the journal only needs to say which file.
+    def _stored(self, writer):
+        project = writer.project
+        self.writing.discard(writer.file_name)
+        self.body_files[project.id] = writer.file_name
+        self.story_lengths[project.id] = writer.length
+        self.dirty.discard(project.id)
+        self._append({'projects': {project.id: {'body': writer.file_name, 'story_length': writer.length}}})
+        self._unload(project)
+        project.defer(self._body_loaded)
+
+    def _append(self, entry):
+        if entry is None:
+            return False
+        line = (json.dumps(entry) + '\n').encode()
+        self.journal.write(line)
+        #Flushing gets it to the OS, which is enough to survive the program crashing. Snapshots get synced all the way to the disk.
+        self.journal.flush()
+        self.journal_size += len(line)
+        return True
+
+    #A fresh journal replaces anything left over with the same generation, which could only be from a snapshot that never got written.
+    def _open_journal(self, fresh=False):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self._journal_path(self.generation), 'wb' if fresh else 'ab')
+        self.journal_size = self.journal.tell()
+
+    def compact(self):
+        """Starts a new journal and writes a snapshot on a background thread. Does nothing if it's already writing one, or if a BodyWriter is still writing, since the snapshot would delete its file."""
+        self._check_compaction()
+        if self.compaction is not None or self.writing:
+            return
+        #The snapshot deletes body files, which can't be deleted on Windows while they're being read.
+        if self.preloading is not None:
+            self.preloading.join()
+        #Everything up to now goes in the old journal first, so if the snapshot doesn't get written, the journals still have it all.
+        self._append(self.changes())
+        self.generation += 1
+        #Only the bodies that changed get written. That loads any that have changes from the journal waiting.
+        projects = self._all_projects()
+        written = [id for id in projects if id in self.dirty or id not in self.body_files]
+        body_files = {id: self.body_files[id] for id in projects if id not in written}
+        story_lengths = {id: self.story_lengths[id] for id in body_files}
+        bodies = {}
+        for id in written:
+            project = projects[id]
+            body_files[id] = f'{id}.{self.generation}.json'
+            story_lengths[id] = len(project.story)
+            #Chunks never change, so the thread can have them as they are. Splitting them up means stories that share most of their text share most of their chunks.
+            project.story.split_chunks()
+            bodies[body_files[id]] = {'chunks': list(project.story.chunks()), 'memory': project.memory}
+        def index_entry(project):
+            entry = project.meta_to_dictionary()
+            entry['body'] = body_files[project.id]
+            entry['story_length'] = story_lengths[project.id]
+            return entry
+        #It's all new dicts and lists of strings, so the thread can have it without anything here changing it.
+        index = {
+            'generation': self.generation,
+            'named_projects': {name: index_entry(project) for name, project in Project.named_projects.items()},
+            'open_projects': [index_entry(project) if project.name == '' else project.name.lower() for project in Project.open_projects],
+            'all_characters': {name: character.to_dictionary() for name, character in Project.all_characters.items()},
+        }
+        index.update(Project.settings_to_dictionary())
+        self.dirty -= set(written)
+        self.compaction = (body_files, story_lengths, written)
+        self._open_journal(fresh=True)
+        self.compacting = threading.Thread(target=self._write_snapshot, args=(index, bodies, set(body_files.values()), self.generation))
+        self.compacting.start()
+
+    def _write_snapshot(self, index, bodies, body_files, generation):
+        self.compacted = False
+        try:
+            os.makedirs(self._path(BODY_DIRECTORY), exist_ok=True)
+            os.makedirs(self._path(CHUNK_DIRECTORY), exist_ok=True)
+            chunk_files = set(os.listdir(self._path(CHUNK_DIRECTORY)))
+            used_chunks = set()
+            #Bodies get new names, so nothing the current index refers to gets touched until the new one is in place.
+            for file_name, body in bodies.items():
+                hashes = [self._write_chunk(chunk, chunk_files) for chunk in body['chunks']]
+                used_chunks.update(hashes)
+                with open(self._path(BODY_DIRECTORY, file_name), 'w') as outfile:
+                    json.dump({'chunks': hashes, 'memory': body['memory']}, outfile)
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+            #The search index is just for finding things, so not being able to write it isn't a reason not to write the snapshot.
+            try:
+                clean_index = index_bodies(self._path(SEARCH_DIRECTORY), generation, {file_name: (body['memory'], body['chunks']) for file_name, body in bodies.items()}, self._body_parts, body_files)
+            except OSError as error:
+                print(f"Couldn't update the search index: {error}")
+                clean_index = None
+            path = self._path(SNAPSHOT_FILE)
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'w') as outfile:
+                json.dump(index, outfile, indent = 4)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(temporary_path, path)
+            self.compacted = True
+            for old_generation in self._journal_generations():
+                if old_generation < generation:
+                    os.remove(self._journal_path(old_generation))
+            for file_name in os.listdir(self._path(BODY_DIRECTORY)):
+                if file_name not in body_files:
+                    os.remove(self._path(BODY_DIRECTORY, file_name))
+                elif file_name not in bodies:
+                    with open(self._path(BODY_DIRECTORY, file_name), 'r') as infile:
+                        used_chunks.update(json.load(infile).get('chunks', []))
+            for hash in chunk_files - used_chunks:
+                os.remove(self._path(CHUNK_DIRECTORY, hash))
+            if clean_index is not None:
+                clean_index()
+        except OSError as error:
+            #The journals still have everything, so nothing's lost. It'll try again next time.
+            print(f"Couldn't write the snapshot: {error}")
+
+    #Writes a chunk if there isn't already a file for it, and returns its hash. It's written to a temporary file first, so a chunk file is never half written.
+    def _write_chunk(self, chunk, chunk_files):
+        data = chunk.encode()
+        hash = hashlib.sha1(data).hexdigest()
+        if hash not in chunk_files:
+            path = self._path(CHUNK_DIRECTORY, hash)
+            with open(path + '.tmp', 'wb') as outfile:
+                outfile.write(data)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(path + '.tmp', path)
+            chunk_files.add(hash)
+        return hash
+
+    #Once the thread's done, the new snapshot's body files are the ones to load from. If it failed, the bodies it was writing still need writing.
+    def _check_compaction(self):
+        if self.compaction is None or self.compacting.is_alive():
+            return
+        body_files, story_lengths, written = self.compaction
+        self.compaction = None
+        if self.compacted:
+            self.body_files = body_files
+            self.story_lengths = story_lengths
+            self.snapshot_size = sum(story_lengths.values()) + os.path.getsize(self._path(SNAPSHOT_FILE))
+        else:
+            self.dirty.update(written)
+
+    def close(self):
+        """Saves, and waits for any snapshot that's being written."""
+        self.save()
+        if self.compacting is not None:
+            self.compacting.join()
+        self._check_compaction()
+        self.journal.close()
+
+class BodyWriter:
+    """
+    Writes a project's story to its body file as it comes in, so it never has to be in memory all at once, like when importing a big save (see kobold_lite.py). Get one from SaveJournal.open_body(), write() each piece of the story, then close() it with the memory. The project's left with its body unloaded.
+    """
+    def __init__(self, journal, project, file_name):
+        self.journal = journal
+        self.project = project
+        self.file_name = file_name
+        self.length = 0
+        self.outfile = open(journal._path(BODY_DIRECTORY, file_name), 'w')
+        self.outfile.write('{"story": "')
+
+    def write(self, text):
+        #A string's escaped the same in pieces as it is whole, once the quotes come off.
+        self.outfile.write(json.dumps(text)[1:-1])
+        self.length += len(text)
+
+    def close(self, memory):
+        self.outfile.write('", "memory": ' + json.dumps(memory) + '}')
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+        self.outfile.close()
+        self.journal._stored(self)
+
+    def discard(self):
+        """Deletes what it's written, if the story turns out not to be one."""
+        self.outfile.close()
+        os.remove(self.outfile.name)
+        self.journal.writing.discard(self.file_name)
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import threading
+
+#Run with --startup-times (or with KOBOLDUI_STARTUP_TIMES set) to print how long each part of starting up took.
+ENABLED = '--startup-times' in sys.argv or bool(os.environ.get('KOBOLDUI_STARTUP_TIMES'))
+
+#Times are counted from when this module was first imported, which app_controller.py does before anything else.
+_start = time.perf_counter()
+_marks = []     #(what just finished, perf_counter() when it did, the thread it was on)
+_lock = threading.Lock()
+
+def mark(label):
+    """Notes that label just finished, if startup timing is on. It can be called from any thread."""
+    if not ENABLED:
+        return
+    with _lock:
+        _marks.append((label, time.perf_counter(), threading.current_thread().name))
+
+def times():
+    """(label, ms since start, thread name) for each mark so far, in the order they happened."""
+    with _lock:
+        return [(label, (seconds - _start) * 1000, thread) for label, seconds, thread in sorted(_marks, key=lambda mark: mark[1])]
+
+def report():
+    """The marks so far, with how long each took since the one before on the same thread. '' if startup timing is off."""
+    if not ENABLED:
+        return ''
+    lines = ["Startup times (ms since start, ms since the last step on the same thread):"]
+    last = {}
+    for label, milliseconds, thread in times():
+        since = milliseconds - last.get(thread, 0)
+        last[thread] = milliseconds
+        where = '' if thread == 'MainThread' else f'  [{thread}]'
+        lines.append(f"{milliseconds:8.1f} {since:8.1f}  {label}{where}")
+    return '\n'.join(lines)
@@ -0,0 +1,323 @@
+#Appending past this many characters starts a new chunk instead of copying the last one. See append() for chunks shared with a fork.
+CHUNK_SIZE = 65536
+
+#How much text StoryBuffer.pieces() looks for in the story it's comparing to, to find where a chunk picks up again after an edit, and how far from where the edit was it looks.
+PIECE_ANCHOR_LENGTH = 64
+PIECE_SEARCH_LENGTH = 4096
+
+#Qt counts positions in UTF-16 code units, so anything outside the Basic Multilingual Plane (like most emoji) counts as two.
+def utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+def from_utf16(text, position):
+    """Converts a Qt position in text to a Python index."""
+    return len(text.encode('utf-16-le')[:2 * position].decode('utf-16-le', errors='ignore'))
+
+def replace_utf16(text, position, removed, added):
+    """Applies an edit from QTextDocument.contentsChange to a str, and returns the new str."""
+    start = from_utf16(text, position)
+    end = from_utf16(text, position + removed)
+    return text[:start] + added + text[end:]
+
+#Binary search on slices, so the comparing gets done in C instead of a character at a time.
+def common_prefix(a, b):
+    """How many characters at the start of a and b are the same."""
+    if b.startswith(a):
+        return len(a)
+    low = 0
+    high = min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def common_suffix(a, b, limit=None):
+    """How many characters at the end of a and b are the same, up to limit."""
+    low = 0
+    high = min(len(a), len(b), len(a) if limit is None else limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:len(a) - low] == b[len(b) - middle:len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+#A str that can be weakly referenced, so the save journal can share chunks between stories it loads without keeping them around after. See SaveJournal._read_chunk().
+class Chunk(str):
+    pass
+
+#Adds a piece for StoryBuffer.pieces(), joining it to the last one if they're next to each other.
+def _add_piece(pieces, piece):
+    if pieces and isinstance(piece, list) and isinstance(pieces[-1], list) and pieces[-1][0] + pieces[-1][1] == piece[0]:
+        pieces[-1][1] += piece[1]
+    elif pieces and isinstance(piece, str) and isinstance(pieces[-1], str):
+        pieces[-1] += piece
+    else:
+        pieces.append(list(piece) if isinstance(piece, list) else piece)
+
+class StoryBuffer:
+    """
+    The text of a story, stored as a list of chunks so appending to it doesn't copy the whole thing.
+
+    Appending only ever copies the last chunk, and the end of the story can be sliced off without joining the rest. It only turns into one big string when something needs all of it, and it keeps that string until it changes again.
+
+    Chunks are never changed, only replaced, so forks (see fork()) share all the chunks they have in common with the story they came from.
+
+    It acts enough like a str for the places stories are used: len(), slicing, += and str().
+    """
+    def __init__(self, text=''):
+        #Text that's set all at once stays one chunk until something edits the middle of it.
+        self._chunks = [text] if text != '' else []
+        self._units = [utf16_length(text)] if text != '' else []     #The UTF-16 length of each chunk, for converting Qt positions.
+        self._length = len(text)
+        self._utf16_length = sum(self._units)
+        self._text = text
+        self._shared_end = False    #Whether the last chunk is shared with a fork. See fork().
+        self._edits = None      #[position, removed, [pieces of text], their total length] for each edit since the last take_edits(), or None if nothing's asked for them.
+
+    #units is the UTF-16 length of each chunk, if it's already known.
+    def from_chunks(chunks, units=None):
+        story = StoryBuffer()
+        story._chunks = [chunk for chunk in chunks if chunk != '']
+        story._units = [utf16_length(chunk) for chunk in story._chunks] if units is None else list(units)
+        story._length = sum(map(len, story._chunks))
+        story._utf16_length = sum(story._units)
+        story._text = None
+        return story
+
+    def split_chunks(self):
+        """Splits any chunks longer than CHUNK_SIZE, like text that was set all at once, so forks and saves can share the parts that don't change."""
+        if all(len(chunk) <= CHUNK_SIZE for chunk in self._chunks):
+            return
+        chunks = []
+        for chunk in self._chunks:
+            if len(chunk) > CHUNK_SIZE:
+                chunks.extend(chunk[i:i + CHUNK_SIZE] for i in range(0, len(chunk), CHUNK_SIZE))
+            else:
+                chunks.append(chunk)
+        self._chunks = chunks
+        self._units = [utf16_length(chunk) for chunk in chunks]
+
+    def fork(self, end=None):
+        """A new StoryBuffer with the first end characters (or all of them), sharing this one's chunks instead of copying them. Only the part of the chunk end is in gets copied."""
+        self.split_chunks()
+        end = self._length if end is None else max(0, min(end, self._length))
+        chunks = self._chunks_between(0, end)
+        story = StoryBuffer.from_chunks(chunks, [units if chunk is original else utf16_length(chunk) for chunk, original, units in zip(chunks, self._chunks, self._units)])
+        #Appending to a shared last chunk copies it, so the next thing either of them appends usually starts a new one. See append().
+        story._shared_end = True
+        self._shared_end = True
+        return story
+
+    #The chunks from start to end, with the ones at the ends sliced if they go past them.
+    def _chunks_between(self, start, end):
+        chunks = []
+        offset = 0
+        for chunk in self._chunks:
+            if offset >= end:
+                break
+            if offset + len(chunk) > start:
+                chunks.append(chunk if start <= offset and offset + len(chunk) <= end else chunk[max(0, start - offset):end - offset])
+            offset += len(chunk)
+        return chunks
+
+    def pieces(self, base):
+        """
+        This story as a list of pieces of base (another StoryBuffer, like the one it was forked from) and text that isn't in it, so it can be saved without what they share. Each piece is either [start, length] in base or a str. See from_pieces().
+
+        Chunks they share are found without comparing them. The rest only get compared to base right after the last piece, since that's where they'd be if base was edited after the fork, so edits bigger than PIECE_SEARCH_LENGTH make the rest of the chunk text.
+        """
+        offsets = {}
+        offset = 0
+        for chunk in base._chunks:
+            offsets[id(chunk)] = offset
+            offset += len(chunk)
+        pieces = []
+        cursor = 0      #Where in base the last piece ended
+        for chunk in self._chunks:
+            #Both stories hold on to their chunks, so the same id means the same chunk. Python reuses the same str for single characters though, so short ones could be from anywhere.
+            start = offsets.get(id(chunk))
+            if start is not None and len(chunk) >= PIECE_ANCHOR_LENGTH:
+                _add_piece(pieces, [start, len(chunk)])
+                cursor = start + len(chunk)
+                continue
+            #Editing base after the fork replaces the chunk the edit's in, but most of this one is probably still in base, right after the last piece. Step through it, finding where it picks up again after each edit.
+            window = ''.join(base._chunks_between(cursor, cursor + len(chunk) + CHUNK_SIZE))
+            position = 0    #Where in the chunk it's got to
+            offset = 0      #And where in the window that is
+            while position < len(chunk):
+                matched = common_prefix(chunk[position:], window[offset:offset + len(chunk) - position])
+                if matched >= PIECE_ANCHOR_LENGTH or (matched > 0 and position + matched == len(chunk)):
+                    _add_piece(pieces, [cursor + offset, matched])
+                    position += matched
+                    offset += matched
+                    continue
+                found = -1
+                for skipped in range(0, PIECE_SEARCH_LENGTH, PIECE_ANCHOR_LENGTH // 4):
+                    anchor = chunk[position + skipped:position + skipped + PIECE_ANCHOR_LENGTH]
+                    if len(anchor) < PIECE_ANCHOR_LENGTH:
+                        break
+                    found = window.find(anchor, offset, offset + skipped + PIECE_SEARCH_LENGTH + PIECE_ANCHOR_LENGTH)
+                    if found != -1:
+                        break
+                if found == -1:
+                    _add_piece(pieces, chunk[position:])
+                    break
+                _add_piece(pieces, chunk[position:position + skipped])
+                position += skipped
+                offset = found
+            cursor += offset
+        return pieces
+
+    def from_pieces(pieces, base):
+        """Puts a story back together from pieces() of base, sharing base's chunks where it can."""
+        base.split_chunks()
+        chunks = []
+        for piece in pieces:
+            if isinstance(piece, str):
+                chunks.append(piece)
+            else:
+                start, length = piece
+                chunks.extend(base._chunks_between(start, start + length))
+        return StoryBuffer.from_chunks(chunks)
+
+    def take_edits(self):
+        """
+        Returns a list of (position, removed, text) for each edit since the last time this was called, in order, and starts recording again. Positions are Python indices. Appends right after each other come back as one edit.
+
+        Nothing gets recorded until the first call, so stories nobody's saving don't keep a second copy of what's added to them.
+        """
+        edits = [] if self._edits is None else [(position, removed, ''.join(pieces)) for position, removed, pieces, length in self._edits]
+        self._edits = []
+        return edits
+
+    def has_edits(self):
+        """Whether it's been edited since the last take_edits(). That's always True before the first call, since it can't tell."""
+        return self._edits is None or len(self._edits) > 0
+
+    def _record(self, position, removed, text):
+        if self._edits is None:
+            return
+        if self._edits and removed == 0:
+            last = self._edits[-1]
+            if last[0] + last[3] == position:
+                last[2].append(text)
+                last[3] += len(text)
+                return
+        self._edits.append([position, removed, [text], len(text)])
+
+    def append(self, text):
+        if text == '':
+            return
+        self._record(self._length, 0, text)
+        units = utf16_length(text)
+        #A last chunk that's shared with a fork only gets copied if it's short, so forking for every version in the history doesn't leave the story in lots of little chunks.
+        limit = CHUNK_SIZE // 4 if self._shared_end else CHUNK_SIZE
+        if self._chunks and len(self._chunks[-1]) < limit:
+            self._chunks[-1] += text
+            self._units[-1] += units
+        else:
+            self._chunks.append(text)
+            self._units.append(units)
+        self._shared_end = False
+        self._length += len(text)
+        self._utf16_length += units
+        self._text = None
+
+    def __iadd__(self, text):
+        self.append(text)
+        return self
+
+    def __len__(self):
+        return self._length
+
+    def replace(self, position, removed, text):
+        """Replaces removed characters starting at position with text. Only the chunks it touches get copied, so edits cost about the same however long the story is."""
+        position = min(position, self._length)
+        removed = min(removed, self._length - position)
+        if removed == 0 and position == self._length:
+            self.append(text)
+            return
+        self._record(position, removed, text)
+        #Find the chunks the edit touches.
+        first = 0
+        offset = 0
+        while first < len(self._chunks) - 1 and offset + len(self._chunks[first]) <= position:
+            offset += len(self._chunks[first])
+            first += 1
+        last = first
+        end = offset + len(self._chunks[first])
+        while end < position + removed:
+            last += 1
+            end += len(self._chunks[last])
+        joined = ''.join(self._chunks[first:last + 1])
+        joined = joined[:position - offset] + text + joined[position - offset + removed:]
+        #Split it back up so the next edit here doesn't have to copy more than a chunk or two. Text that was set all at once gets split the first time it's edited.
+        chunks = [joined[i:i + CHUNK_SIZE] for i in range(0, len(joined), CHUNK_SIZE)]
+        units = [utf16_length(chunk) for chunk in chunks]
+        self._utf16_length += sum(units) - sum(self._units[first:last + 1])
+        self._chunks[first:last + 1] = chunks
+        self._units[first:last + 1] = units
+        self._length += len(text) - removed
+        self._text = None
+
+    def utf16_length(self):
+        return self._utf16_length
+
+    def from_utf16(self, position):
+        """Converts a Qt position in the story to a Python index. It's free unless the story has characters that take two UTF-16 code units, and even then it only looks at one chunk."""
+        if self._utf16_length == self._length:
+            return min(position, self._length)
+        offset = 0
+        index = 0
+        for chunk, units in zip(self._chunks, self._units):
+            if offset + units >= position:
+                return index + from_utf16(chunk, position - offset)
+            offset += units
+            index += len(chunk)
+        return self._length
+
+    def __str__(self):
+        if self._text is None:
+            self._text = ''.join(self._chunks)
+        return self._text
+
+    def chunks(self):
+        """The story a piece at a time, for writing it out without joining it into one string."""
+        return iter(self._chunks)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def tail(self, length):
+        """The last length characters, joining only the chunks it needs."""
+        if length <= 0:
+            return ''
+        if self._text is not None or length >= self._length:
+            return str(self)[-length:]
+        pieces = []
+        needed = length
+        for chunk in reversed(self._chunks):
+            if len(chunk) >= needed:
+                pieces.append(chunk[-needed:])
+                break
+            pieces.append(chunk)
+            needed -= len(chunk)
+        return ''.join(reversed(pieces))
+
+    def __getitem__(self, key):
+        #Slices that run to the end are the ones prompts use, and they don't need the whole story.
+        if isinstance(key, slice) and key.stop is None and key.step is None:
+            start = key.start or 0
+            if start < 0:
+                return self.tail(-start)
+            return self.tail(self._length - start)
+        #Other slices only join the chunks they need, unless the whole story's already joined.
+        if isinstance(key, slice) and key.step is None and self._text is None:
+            start, stop, step = key.indices(self._length)
+            return ''.join(self._chunks_between(start, stop)) if start < stop else ''
+        return str(self)[key]
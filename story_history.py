@@ -0,0 +1,102 @@
+import time
+import zlib
+import bisect
+from story_buffer import StoryBuffer, common_prefix, common_suffix
+
+#A whole copy of the story gets kept every this many versions, so restoring one never takes more than this many edits.
+KEYFRAME_INTERVAL = 100
+#Keyframes get compressed at this zlib level. 1 is the fastest, and it still gets stories to about a third of their size.
+COMPRESSION_LEVEL = 1
+#How much of the end of a changed part diff() looks for to tell if there were separate edits, and how many times it splits it up.
+ANCHOR_LENGTH = 64
+MAX_SPLITS = 4
+
+def diff(old, new):
+    """A list of edits (position, removed, text) that turn old into new, applied in order."""
+    edits = []
+    _diff(old, new, 0, edits, MAX_SPLITS)
+    return edits
+
+#Replaces everything between what they have in common at the start and at the end. But editing something and then generating would make that most of the story, so if the end of what's left of one shows up in the other, it splits it into the part before that, which is changed, and the rest, which was just added or removed.
+def _diff(old, new, offset, edits, splits):
+    prefix = common_prefix(old, new)
+    suffix = common_suffix(old, new, min(len(old), len(new)) - prefix)
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+    if old_middle == new_middle:
+        return
+    position = offset + prefix
+    if splits > 0 and len(old_middle) > ANCHOR_LENGTH and len(new_middle) > ANCHOR_LENGTH:
+        split = new_middle.rfind(old_middle[-ANCHOR_LENGTH:]) + ANCHOR_LENGTH
+        if split > ANCHOR_LENGTH:
+            _diff(old_middle, new_middle[:split], position, edits, splits - 1)
+            edits.append((position + split, 0, new_middle[split:]))
+            return
+        split = old_middle.rfind(new_middle[-ANCHOR_LENGTH:]) + ANCHOR_LENGTH
+        if split > ANCHOR_LENGTH:
+            _diff(old_middle[:split], new_middle, position, edits, splits - 1)
+            edits.append((position + len(new_middle), len(old_middle) - split, ''))
+            return
+    edits.append((position, len(old_middle), new_middle))
+
+class StoryHistory:
+    """
+    Earlier versions of a project's story, to go back to after a bad generation.
+
+    Each version is stored as the edits that turn the version before it into it (see diff()), which for a generation is just what it added. Every KEYFRAME_INTERVAL versions, or sooner if the edits since the last one add up to more than the story, the whole story gets stored compressed instead. Restoring a version starts from the keyframe before it and applies the edits after that to a StoryBuffer, which only copies the chunks each edit touches.
+
+    It's only kept while the program's running.
+    """
+    def __init__(self):
+        self.versions = []      #(time, label, length) for each version
+        self.changes = []       #For each version, its compressed text if it's a keyframe, or the edits from diff() to get it from the version before.
+        self.keyframes = []     #The indices of the versions that are keyframes
+        self.since_keyframe = 0 #How much text the edits since the last keyframe have
+        self.latest = None      #The last version as a fork of the story (see StoryBuffer.fork()), to compare the next one to. It shares the story's chunks until the story changes.
+
+    def __len__(self):
+        return len(self.versions)
+
+    def snapshot(self, story, label):
+        """Adds the story (a StoryBuffer) as a new version, unless it's the same as the last one. Returns whether it did."""
+        #Joined here instead of with str(), which would keep the joined copy in the story.
+        text = ''.join(story.chunks())
+        latest = None if self.latest is None else ''.join(self.latest.chunks())
+        if text == latest:
+            return False
+        if latest is None or len(self.versions) - self.keyframes[-1] >= KEYFRAME_INTERVAL or self.since_keyframe > len(text):
+            self.keyframes.append(len(self.versions))
+            self.changes.append(zlib.compress(text.encode(), COMPRESSION_LEVEL))
+            self.since_keyframe = 0
+        else:
+            edits = diff(latest, text)
+            self.changes.append(edits)
+            self.since_keyframe += sum(len(added) for position, removed, added in edits)
+        self.versions.append((time.time(), label, len(text)))
+        self.latest = story.fork()
+        return True
+
+    def text(self, index):
+        """The story as of version index."""
+        if index == len(self.versions) - 1:
+            return ''.join(self.latest.chunks())
+        keyframe = self.keyframes[bisect.bisect_right(self.keyframes, index) - 1]
+        story = StoryBuffer(zlib.decompress(self.changes[keyframe]).decode())
+        for edits in self.changes[keyframe + 1:index + 1]:
+            for position, removed, text in edits:
+                story.replace(position, removed, text)
+        return str(story)
+
+    def fork(self):
+        """A history for a fork of the story, with the same versions so far. It shares them instead of copying them."""
+        history = StoryHistory()
+        history.versions = list(self.versions)
+        history.changes = list(self.changes)
+        history.keyframes = list(self.keyframes)
+        history.since_keyframe = self.since_keyframe
+        history.latest = self.latest
+        return history
+
+    def size(self):
+        """About how many bytes the versions take, not counting the latest one, which shares the story's chunks."""
+        return sum(len(change) if isinstance(change, bytes) else sum(len(edit[2]) for edit in change) for change in self.changes)
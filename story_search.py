@@ -0,0 +1,517 @@
+import os
+import re
+import sys
+import json
+import math
+import heapq
+import bisect
+import itertools
+from array import array
+from collections import Counter
+from narrative_data import Project
+
+#The search index goes in here, beside the save, as segment files. See write_segment().
+SEARCH_DIRECTORY = 'search'
+#Once there are more segments than this, the next snapshot merges them into one.
+MAX_SEGMENTS = 8
+#Indexing bodies that no segment has yet puts at most this many characters of them in each segment, so it never has all of their words in memory at once.
+SEGMENT_SIZE = 32 * 1024 * 1024
+#Only this many results get shown, and get snippets.
+RESULT_LIMIT = 50
+#About how many characters of text go on each side of the match in a snippet.
+SNIPPET_CONTEXT = 60
+#BM25's usual settings: how fast more of a word stops counting for more, and how much longer stories count less for having it.
+K1 = 1.2
+B = 0.75
+#A word of the search in a project's name counts this many times as much as the most it can count for in the story.
+NAME_WEIGHT = 2
+
+#Words are runs of letters, numbers and underscores, lowercased. Each word of a search matches the start of words, so "drag" finds "dragon".
+WORD = re.compile(r'\w+')
+
+def words(text):
+    return [word.lower() for word in WORD.findall(text)]
+
+def _is_word_character(character):
+    return WORD.match(character) is not None
+
+#The word that chunks[start] starts with, including any of it in the chunks after, if they're part of it too.
+def _leading_word(chunks, start):
+    pieces = []
+    for chunk in itertools.islice(chunks, start, None):
+        match = WORD.match(chunk)
+        if match is None:
+            break
+        pieces.append(match.group())
+        if match.end() < len(chunk):
+            break
+    return ''.join(pieces)
+
+#A word that runs from one chunk into the next counts in the one it starts in, whole. So each chunk's words depend on whether it starts partway through one, and on the rest of the one it ends partway through.
+def _chunk_keys(chunks):
+    keys = []
+    for i, chunk in enumerate(chunks):
+        starts_inside = i > 0 and _is_word_character(chunks[i - 1][-1]) and _is_word_character(chunk[0])
+        keys.append((starts_inside, _leading_word(chunks, i + 1) if _is_word_character(chunk[-1]) else ''))
+    return keys
+
+def _chunk_words(chunk, starts_inside, rest):
+    found = WORD.findall(chunk)
+    if starts_inside and found:
+        found.pop(0)
+    if rest and found:
+        found[-1] += rest
+    return _lowercase(Counter(found))
+
+#Most words come up more than once, so it's faster to count them first and lowercase each different one once.
+def _lowercase(counter):
+    lowered = Counter()
+    for word, count in counter.items():
+        lowered[word.lower()] += count
+    return lowered
+
+def document_words(memory, chunks):
+    """
+    {word: [how many times it's in it, the first part it's in]} for a body (see SaveJournal), for write_segment(). Part 0 is the memory, and part i is chunk i - 1 of the story.
+    """
+    parts = [_lowercase(Counter(WORD.findall(memory)))]
+    parts.extend(_chunk_words(chunk, *key) for chunk, key in zip(chunks, _chunk_keys(chunks)))
+    found = {}
+    for part, counter in enumerate(parts):
+        for word, count in counter.items():
+            entry = found.get(word)
+            if entry is None:
+                found[word] = [count, part]
+            else:
+                entry[0] += count
+    return found
+
+def write_segment(path, documents):
+    """Writes a segment with documents ({body file name: document_words()}) to path."""
+    postings = {}
+    lengths = []
+    for index, found in enumerate(documents.values()):
+        lengths.append(sum(count for count, part in found.values()))
+        for word, (count, part) in found.items():
+            word_postings = postings.get(word)
+            if word_postings is None:
+                word_postings = postings[word] = array('I')
+            word_postings.extend((index, count, part))
+    _write_segment(path, list(documents), lengths, ((word, postings[word]) for word in sorted(postings)))
+
+#The first line is the body file names and how many words each has, and the second is every word, sorted. After that come where each word's postings start, and then the postings: (which body, how many times the word's in it, the first part it's in) for each body with the word. It's written to a temporary file first, so a segment is never half written.
+def _write_segment(path, names, lengths, postings):
+    offsets = array('I', [0])
+    data = array('I')
+    sorted_words = []
+    for word, word_postings in postings:
+        sorted_words.append(word)
+        data.extend(word_postings)
+        offsets.append(len(data) // 3)
+    with open(path + '.tmp', 'wb') as outfile:
+        outfile.write((json.dumps({'documents': names, 'lengths': lengths, 'byteorder': sys.byteorder}) + '\n').encode())
+        outfile.write((json.dumps(sorted_words) + '\n').encode())
+        offsets.tofile(outfile)
+        data.tofile(outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(path + '.tmp', path)
+
+def segment_documents(path):
+    """Just the body file names in a segment, without reading the rest of it."""
+    with open(path, 'rb') as infile:
+        return json.loads(infile.readline())['documents']
+
+def segment_files(directory):
+    return sorted(file_name for file_name in os.listdir(directory) if file_name.endswith('.index')) if os.path.isdir(directory) else []
+
+class Segment:
+    """A segment file, read into memory. See _write_segment()."""
+    def __init__(self, path):
+        with open(path, 'rb') as infile:
+            header = json.loads(infile.readline())
+            self.documents = header['documents']
+            self.lengths = header['lengths']
+            self.words = json.loads(infile.readline())
+            self.offsets = array('I')
+            self.offsets.frombytes(infile.read(self.offsets.itemsize * (len(self.words) + 1)))
+            self.postings = array('I')
+            self.postings.frombytes(infile.read())
+        if header['byteorder'] != sys.byteorder:
+            self.offsets.byteswap()
+            self.postings.byteswap()
+
+    def matches(self, prefix):
+        """(word, its postings) for each word that starts with prefix. The postings are an array of (body, count, part), flattened."""
+        i = bisect.bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            yield self.words[i], self.postings[3 * self.offsets[i]:3 * self.offsets[i + 1]]
+            i += 1
+
+def index_bodies(directory, generation, bodies, read_body, live):
+    """
+    Keeps the search index up to date for a snapshot that's being written, on the thread writing it. See SaveJournal.compact().
+
+    bodies is {body file name: (memory, chunks)} for the bodies the snapshot wrote. Any other bodies in live (a set of body file names) that no segment has yet get read with read_body(file name) -> (memory, chunks) and indexed too, like for saves from before there was an index. Returns a function to call once the snapshot's in place, which deletes segments without any bodies in live and merges them into one if there are too many left.
+    """
+    os.makedirs(directory, exist_ok=True)
+    indexed = set()
+    for file_name in segment_files(directory):
+        indexed.update(segment_documents(os.path.join(directory, file_name)))
+    numbers = itertools.count()
+    documents = {}
+    size = 0
+    def add(file_name, memory, chunks):
+        nonlocal documents, size
+        documents[file_name] = document_words(memory, chunks)
+        size += len(memory) + sum(map(len, chunks))
+        if size > SEGMENT_SIZE:
+            write_segment(os.path.join(directory, f'{generation}.{next(numbers)}.index'), documents)
+            documents = {}
+            size = 0
+    for file_name, (memory, chunks) in bodies.items():
+        add(file_name, memory, chunks)
+    for file_name in sorted(live - indexed - bodies.keys()):
+        try:
+            memory, chunks = read_body(file_name)
+        except OSError:
+            continue
+        add(file_name, memory, chunks)
+    if documents:
+        write_segment(os.path.join(directory, f'{generation}.{next(numbers)}.index'), documents)
+    return lambda: _clean_segments(directory, generation, live, next(numbers))
+
+def _clean_segments(directory, generation, live, number):
+    kept = []
+    for file_name in segment_files(directory):
+        path = os.path.join(directory, file_name)
+        if live.isdisjoint(segment_documents(path)):
+            os.remove(path)
+        else:
+            kept.append(path)
+    if len(kept) > MAX_SEGMENTS:
+        _merge_segments(kept, live, os.path.join(directory, f'{generation}.{number}.index'))
+        for path in kept:
+            os.remove(path)
+
+#Goes through the words of all the segments in order at once, so the merged postings get written a word at a time without reading them all into dicts first.
+def _merge_segments(paths, live, path):
+    segments = [Segment(path) for path in paths]
+    names = []
+    seen = set()
+    lengths = []
+    renumbered = []     #For each segment, {its body: that body in the merged segment} for the ones it keeps
+    for segment in segments:
+        kept = {}
+        for index, name in enumerate(segment.documents):
+            if name in live and name not in seen:
+                kept[index] = len(names)
+                seen.add(name)
+                names.append(name)
+                lengths.append(segment.lengths[index])
+        renumbered.append(kept)
+    def postings():
+        merged = heapq.merge(*[zip(segment.words, itertools.repeat(number), itertools.count()) for number, segment in enumerate(segments)])
+        for word, group in itertools.groupby(merged, key=lambda item: item[0]):
+            word_postings = array('I')
+            for word, number, i in group:
+                segment = segments[number]
+                kept = renumbered[number]
+                flat = segment.postings[3 * segment.offsets[i]:3 * segment.offsets[i + 1]]
+                for body, count, part in zip(flat[::3], flat[1::3], flat[2::3]):
+                    if body in kept:
+                        word_postings.extend((kept[body], count, part))
+            if word_postings:
+                yield word, word_postings
+    _write_segment(path, names, lengths, postings())
+
+#A project whose body changed since it was last indexed, so it's indexed from memory instead, a chunk at a time.
+class _FreshDocument:
+    def __init__(self):
+        self.memory = None
+        self.memory_words = Counter()
+        self.parts = []         #(chunk, its key from _chunk_keys(), a Counter of its words) for each chunk of the story
+        self.length = 0         #How many words it has
+
+class StorySearch:
+    """
+    Finds the named projects with every word of a search in their name, memory or story, best matches first, with a snippet of where in the story.
+
+    Bodies (see SaveJournal) get indexed when a snapshot writes them, into a segment file in SEARCH_DIRECTORY beside the save. Segments never change once they're written, so starting up doesn't read or rebuild anything, and searching only reads them the first time. A segment lists each word in its bodies, sorted, with which bodies have it, how many times, and the first part of the body it's in (the memory or one of the story's chunks), so a snippet only needs that part read. Body files get a new name each time they're written, so a project's body is in the index if its body file is in a segment.
+
+    Projects that changed since their body was written get indexed from memory instead. That's kept a chunk at a time, so after a generation only the chunks that changed get indexed again.
+
+    Results are ranked with BM25 on the story and memory, plus NAME_WEIGHT for each word of the search in the project's name.
+    """
+    def __init__(self, journal):
+        self.journal = journal
+        self.directory = os.path.join(journal.directory, SEARCH_DIRECTORY)
+        self.segments = {}      #file name: Segment, for each segment file that's been read
+        self.indexed = {}       #body file name: (Segment, its index there), for the bodies in segments
+        self.documents = {}     #project id: (Segment, index) for projects whose body is in a segment, and hasn't changed since
+        self.fresh = {}         #project id: _FreshDocument for projects indexed from memory
+        self.words = {}         #word: {project id: how many times it's in that project} for the fresh documents
+        self.sorted_words = None    #The keys of words, sorted, to find the ones that start with something. None if it needs sorting again.
+        self.new_words = []     #Words added to words since sorted_words was last updated
+        self.names = {}         #project id: name, as of when name_words was made
+        self.name_words = []    #(word, project id) for each word in the name of each named project, sorted
+        self.waiting = 0        #How many projects' bodies aren't in a segment yet, and aren't loaded to index from memory. The next snapshot indexes them.
+        self.asked_to_index = False
+
+    def refresh(self):
+        """Reads any new segments, and indexes what changed in the projects that aren't in one."""
+        file_names = set(segment_files(self.directory))
+        if file_names != self.segments.keys():
+            for file_name in self.segments.keys() - file_names:
+                del self.segments[file_name]
+            for file_name in file_names - self.segments.keys():
+                try:
+                    self.segments[file_name] = Segment(os.path.join(self.directory, file_name))
+                except (OSError, ValueError) as error:
+                    print(f"Couldn't read the search index segment {file_name}: {error}")
+            self.indexed = {}
+            for segment in self.segments.values():
+                for index, name in enumerate(segment.documents):
+                    self.indexed.setdefault(name, (segment, index))
+        snapshot = self.journal.snapshot_bodies()
+        self.documents = {}
+        self.waiting = 0
+        fresh = set()
+        for project in Project.named_projects.values():
+            body = snapshot.get(project.id)
+            if body in self.indexed:
+                self.documents[project.id] = self.indexed[body]
+            elif body is None or project.is_loaded():
+                self._update_fresh(project)
+                fresh.add(project.id)
+            else:
+                self.waiting += 1
+        for id in self.fresh.keys() - fresh:
+            self._drop_fresh(id)
+        names = {project.id: project.name for project in Project.named_projects.values()}
+        if names != self.names:
+            self.names = names
+            self.name_words = sorted((word, id) for id, name in names.items() for word in set(words(name)))
+        if self.sorted_words is not None:
+            if len(self.new_words) > 100:
+                self.sorted_words = None
+            else:
+                for word in self.new_words:
+                    bisect.insort(self.sorted_words, word)
+        self.new_words = []
+        #Indexing them is part of writing a snapshot, so this starts one. It only asks once, in case something keeps them from getting indexed.
+        if self.waiting and not self.asked_to_index:
+            self.asked_to_index = True
+            self.journal.compact()
+
+    def _update_fresh(self, project):
+        document = self.fresh.get(project.id)
+        if document is None:
+            document = self.fresh[project.id] = _FreshDocument()
+        added = []
+        removed = []
+        if project.memory != document.memory:
+            removed.append(document.memory_words)
+            document.memory = project.memory
+            document.memory_words = _lowercase(Counter(WORD.findall(project.memory)))
+            added.append(document.memory_words)
+        #Chunks never change, so one that's the same object as last time with the same key has the same words.
+        chunks = list(project.story.chunks())
+        old = {}
+        for part in document.parts:
+            old.setdefault(id(part[0]), []).append(part)
+        parts = []
+        for chunk, key in zip(chunks, _chunk_keys(chunks)):
+            part = None
+            for i, candidate in enumerate(old.get(id(chunk), [])):
+                if candidate[1] == key:
+                    part = old[id(chunk)].pop(i)
+                    break
+            if part is None:
+                part = (chunk, key, _chunk_words(chunk, *key))
+                added.append(part[2])
+            parts.append(part)
+        removed.extend(part[2] for unused in old.values() for part in unused)
+        document.parts = parts
+        for counter in removed:
+            self._count(project.id, document, counter, -1)
+        for counter in added:
+            self._count(project.id, document, counter, 1)
+
+    def _drop_fresh(self, id):
+        document = self.fresh.pop(id, None)
+        if document is not None:
+            for counter in [document.memory_words] + [part[2] for part in document.parts]:
+                self._count(id, document, counter, -1)
+
+    def _count(self, id, document, counter, sign):
+        for word, count in counter.items():
+            postings = self.words.get(word)
+            if postings is None:
+                postings = self.words[word] = {}
+                self.new_words.append(word)
+            total = postings.get(id, 0) + sign * count
+            if total:
+                postings[id] = total
+            else:
+                del postings[id]
+                if not postings:
+                    del self.words[word]
+                    self.sorted_words = None
+            document.length += sign * count
+
+    #The fresh words that start with term.
+    def _fresh_matches(self, term):
+        if self.sorted_words is None:
+            self.sorted_words = sorted(self.words)
+        i = bisect.bisect_left(self.sorted_words, term)
+        found = []
+        while i < len(self.sorted_words) and self.sorted_words[i].startswith(term):
+            found.append(self.sorted_words[i])
+            i += 1
+        return found
+
+    #The ids of the named projects with a word that starts with term in their name.
+    def _name_matches(self, term):
+        i = bisect.bisect_left(self.name_words, (term,))
+        found = set()
+        while i < len(self.name_words) and self.name_words[i][0].startswith(term):
+            found.add(self.name_words[i][1])
+            i += 1
+        return found
+
+    def search(self, text):
+        """[(project, snippet, [(start, end) of each word of the search in the snippet])] for the best RESULT_LIMIT named projects with every word of text in their name, memory or story."""
+        self.refresh()
+        terms = list(dict.fromkeys(words(text)))
+        if not terms:
+            return []
+        projects = {project.id: project for project in Project.named_projects.values()}
+        lengths = {id: segment.lengths[index] for id, (segment, index) in self.documents.items()}
+        lengths.update((id, document.length) for id, document in self.fresh.items())
+        average = max(1, sum(lengths.values()) / len(lengths)) if lengths else 1
+        owners = {}     #Segment: {index: project id}
+        for id, (segment, index) in self.documents.items():
+            owners.setdefault(segment, {})[index] = id
+        candidates = None
+        scores = {}
+        found = []      #For each term, {project id: [how many times it's in the body, the first part it's in or None if it's fresh]}, and the fresh words it matched
+        for term in terms:
+            in_body = {}
+            for segment, segment_owners in owners.items():
+                for word, flat in segment.matches(term):
+                    for index, count, part in zip(flat[::3], flat[1::3], flat[2::3]):
+                        id = segment_owners.get(index)
+                        if id is None or (candidates is not None and id not in candidates):
+                            continue
+                        entry = in_body.get(id)
+                        if entry is None:
+                            in_body[id] = [count, part]
+                        else:
+                            entry[0] += count
+                            entry[1] = min(entry[1], part)
+            fresh_words = self._fresh_matches(term)
+            for word in fresh_words:
+                for id, count in self.words[word].items():
+                    if candidates is not None and id not in candidates:
+                        continue
+                    entry = in_body.get(id)
+                    if entry is None:
+                        in_body[id] = [count, None]
+                    else:
+                        entry[0] += count
+            in_name = self._name_matches(term)
+            if candidates is not None:
+                in_name &= candidates
+            matched = in_body.keys() | in_name
+            candidates = matched if candidates is None else candidates & matched
+            if not candidates:
+                return []
+            frequency = len(matched)
+            idf = math.log(1 + (len(projects) - frequency + 0.5) / (frequency + 0.5))
+            for id, (count, part) in in_body.items():
+                scores[id] = scores.get(id, 0) + idf * count * (K1 + 1) / (count + K1 * (1 - B + B * lengths.get(id, average) / average))
+            for id in in_name:
+                scores[id] = scores.get(id, 0) + idf * (K1 + 1) * NAME_WEIGHT
+            found.append((idf, term, in_body, fresh_words))
+        ranked = sorted(candidates, key=lambda id: (-scores[id], projects[id].name.lower()))[:RESULT_LIMIT]
+        results = []
+        for id in ranked:
+            snippet, highlights = self._snippet(id, terms, found)
+            results.append((projects[id], snippet, highlights))
+        return results
+
+    #The snippet's from where the rarest word of the search that's in the body first is. If they're only in the name, it's the start of the memory, or the story if there isn't one.
+    def _snippet(self, id, terms, found):
+        in_body = [(idf, term, in_body[id], fresh_words) for idf, term, in_body, fresh_words in found if id in in_body]
+        part = 0
+        term = None
+        if in_body:
+            idf, term, (count, part), fresh_words = max(in_body, key=lambda item: item[0])
+            if part is None:
+                document = self.fresh[id]
+                counters = [document.memory_words] + [part[2] for part in document.parts]
+                part = next((i for i, counter in enumerate(counters) if any(word in counter for word in fresh_words)), 0)
+        try:
+            text = self._part_text(id, part)
+            if term is None and text == '':
+                text = self._part_text(id, 1)
+        except OSError:
+            return '', []
+        return snippet(text, terms, term)
+
+    #A part of a project's body, and the start of the one after it, in case the word runs into it.
+    def _part_text(self, id, part):
+        document = self.fresh.get(id)
+        if document is not None:
+            if part == 0:
+                return document.memory
+            if part > len(document.parts):
+                return ''
+            return document.parts[part - 1][0] + document.parts[part - 1][1][1]
+        if id not in self.documents:
+            return ''
+        segment, index = self.documents[id]
+        text = self.journal.read_part(segment.documents[index], part)
+        if text is None:
+            return ''
+        if part > 0 and text and _is_word_character(text[-1]):
+            #It might run into the chunks after it, like the index has it. See _leading_word().
+            for after in itertools.count(part + 1):
+                after = self.journal.read_part(segment.documents[index], after)
+                match = None if after is None else WORD.match(after)
+                if match is None:
+                    break
+                text += match.group()
+                if match.end() < len(after):
+                    break
+        return text
+
+#Where the first word starting with term is in text, or 0 if it's not there. Searching the lowercased text is a lot faster than going through every word, but it only works if lowercasing didn't change how long anything is.
+def _find_word(text, term):
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        return next((match.start() for match in WORD.finditer(text) if match.group().lower().startswith(term)), 0)
+    position = lowered.find(term)
+    while position > 0 and _is_word_character(lowered[position - 1]):
+        position = lowered.find(term, position + 1)
+    return max(position, 0)
+
+def snippet(text, terms, term=None):
+    """(about SNIPPET_CONTEXT characters of text on each side of the first word starting with term (or the start, if it's None or not there), [(start, end) of each word starting with one of terms in it]). Line breaks become spaces."""
+    center = 0 if term is None else _find_word(text, term)
+    start = max(0, center - SNIPPET_CONTEXT)
+    end = min(len(text), center + SNIPPET_CONTEXT * 2)
+    piece = text[start:end]
+    #It starts and ends at a space, so there aren't any half words.
+    if start > 0 and ' ' in piece[:center - start]:
+        piece = piece[piece.index(' ', 0, center - start) + 1:]
+    if end < len(text) and ' ' in piece[SNIPPET_CONTEXT:]:
+        piece = piece[:piece.rindex(' ')]
+    piece = ' '.join(piece.split())
+    if start > 0:
+        piece = '…' + piece
+    if end < len(text):
+        piece += '…'
+    terms = tuple(terms)
+    return piece, [match.span() for match in WORD.finditer(piece) if match.group().lower().startswith(terms)]
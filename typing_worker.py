@@ -0,0 +1,252 @@
+import math
+import time
+import collections
+from PySide6.QtCore import QObject, QTimer, Signal, Qt
+
+BASE_TYPING_TIME = 0.2
+TYPING_TIME_MULTIPLIER = 0.9
+#No letter should show up more than this many seconds after it came in from the server.
+MAX_DISPLAY_LATENCY = 0.5
+#How many seconds back the estimate of how fast text is coming in looks, more or less. Longer is smoother, shorter catches up faster when it changes.
+RATE_TIME_CONSTANT = 1.0
+#How many seconds' worth of text the adaptive pacing tries to keep waiting, so it doesn't run out between tokens.
+TARGET_LATENCY = 0.1
+#How much of the typing speed comes from how much text is waiting instead of from how fast it's coming in. At 1, it's just the original pacing with a shorter BASE_TYPING_TIME.
+CATCH_UP = 0.5
+#Letters due closer together than this get typed together.
+MIN_TYPING_TIME = 0.001
+
+class BufferPacer:
+    """
+    The original pacing. It types faster the more text is waiting, so it takes about BASE_TYPING_TIME to get through whatever's there, but it never speeds up by more than TYPING_TIME_MULTIPLIER a letter except when a new token comes in.
+
+    A pacer gets told when text comes in and when it's typed, and says how long to wait after a letter before typing the next one.
+    """
+    animated = True
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.remaining = 0
+        self.typing_time = 0
+        self.just_received = False
+
+    def received(self, length, now):
+        self.remaining += length
+        self.just_received = True
+
+    def typed(self, count):
+        self.remaining -= count
+
+    def delay(self, last_time, completing):
+        """Seconds after last_time (when the last letter was typed) to type the next one."""
+        if self.remaining == 0:
+            return None
+        #It recieved another token in the middle of typing. Speed up based on how much is waiting now.
+        if self.just_received:
+            self.typing_time = BASE_TYPING_TIME / self.remaining
+        #If the stream is done, type a bit faster than the last letter, so it finishes quickly.
+        elif completing:
+            self.typing_time *= TYPING_TIME_MULTIPLIER
+        #Otherwise, set it to base time/remaining (so the more is in the buffer the faster it types) but cap it at a bit faster than the last one.
+        else:
+            self.typing_time = max(BASE_TYPING_TIME / self.remaining, self.typing_time * TYPING_TIME_MULTIPLIER)
+        self.just_received = False
+        return self.typing_time
+
+class AdaptivePacer:
+    """
+    Types at about the rate text is coming in from the server, a little behind it, so letters show up soon after they arrive and fast streams don't wait on the animation.
+
+    The rate is a moving average of characters per second, with older text counting for less the longer ago it came in (time_constant seconds later it counts for about a third as much). If typing at that rate would leave any letter waiting longer than max_latency seconds since it came in, it speeds up just enough not to.
+    """
+    animated = True
+
+    def __init__(self, target_latency=TARGET_LATENCY, max_latency=MAX_DISPLAY_LATENCY, time_constant=RATE_TIME_CONSTANT):
+        self.target_latency = target_latency
+        self.max_latency = max_latency
+        self.time_constant = time_constant
+        self.reset()
+
+    def reset(self):
+        self.received_count = 0
+        self.typed_count = 0
+        self.arrivals = collections.deque()     #(time, received_count after it) for each token that isn't all typed yet
+        self.first_arrival = None
+        self.last_arrival = None
+        self.weighted_count = 0     #Characters received since the first token, each counting for less the longer ago it came in.
+        self.rate = 0               #Characters per second
+
+    def received(self, length, now):
+        #The first token comes after the prompt's processed, so how long that took says nothing about how fast the rest will come.
+        if self.first_arrival is None:
+            self.first_arrival = now
+        else:
+            self.weighted_count = self.weighted_count * math.exp((self.last_arrival - now) / self.time_constant) + length
+            #Divide by how much time it's counting, with the same weights. Early on, that's less than time_constant, so the first few tokens don't make it start out slow.
+            weighted_time = self.time_constant * (1 - math.exp((self.first_arrival - now) / self.time_constant))
+            if weighted_time > 0:
+                self.rate = self.weighted_count / weighted_time
+        self.last_arrival = now
+        self.received_count += length
+        self.arrivals.append((now, self.received_count))
+
+    def typed(self, count):
+        self.typed_count += count
+        while self.arrivals and self.arrivals[0][1] <= self.typed_count:
+            self.arrivals.popleft()
+
+    def delay(self, last_time, completing):
+        """Seconds after last_time (when the last letter was typed) to type the next one."""
+        if self.received_count == self.typed_count:
+            return None
+        #Typing exactly as fast as text comes in would keep running out whenever a token is a bit late or a bit short, and stopping and starting looks choppier than a steady delay. So it keeps about target_latency seconds' worth waiting, speeding up when there's more than that and slowing down when there's less.
+        waiting = self.received_count - self.typed_count
+        typing_time = 1 / ((1 - CATCH_UP) * self.rate + CATCH_UP * waiting / self.target_latency)
+        #Every letter that's waiting needs to be typed before its deadline, so the letters up to the end of each token have to fit in the time that token has left.
+        for arrival, end in self.arrivals:
+            typing_time = min(typing_time, (arrival + self.max_latency - last_time) / (end - self.typed_count))
+        return max(0, typing_time)
+
+class NoAnimation:
+    """Writes each token as soon as it comes in."""
+    animated = False
+
+    def reset(self):
+        pass
+
+    def received(self, length, now):
+        pass
+
+    def typed(self, count):
+        pass
+
+    def delay(self, last_time, completing):
+        return None
+
+PACERS = {
+    'adaptive': AdaptivePacer,
+    'buffer': BufferPacer,
+    'none': NoAnimation,
+}
+
+class TypingWorker(QObject):
+    """
+    Types out generated text one letter at a time, so it looks like it's being written instead of showing up a token at a time. How fast it goes is up to its pacer. See PACERS.
+
+    It's meant to be moved to its own QThread. Everything goes in and out through signals, so the GUI thread never touches its state and never waits on it. Emit text_received with each token, abort_requested to write out everything it has right away, release_requested to write out everything and stop typing this generation, and connect typed to whatever writes the text. Connect it to a method of a QObject on the GUI thread so it gets queued there.
+    """
+    typed = Signal(str, bool)               #(text, completed) for each letter it types, or more at once if they're due together or it's aborting.
+    text_received = Signal(str, bool)       #(token, completed) from the stream.
+    abort_requested = Signal()
+    release_requested = Signal()
+    released = Signal()                     #Sent after release_requested, once everything it had has gone out through typed. It's ready for another generation.
+    pacer_requested = Signal(str)           #The name of a pacer in PACERS to use from the next generation on.
+
+    def __init__(self, pacer='adaptive'):
+        super().__init__()
+        self.text = ''
+        self.index = 0
+        self.completing = False     #The stream is finished and it's just typing the rest out.
+        self.aborting = False
+        self.pacer = PACERS[pacer]()
+        self.next_pacer = None
+        self.start_time = None      #When it typed the last letter, or None if it's waiting for more text.
+        #The timer is a child, so it moves to the worker's thread along with it.
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self._type_next)
+        self.text_received.connect(self._receive)
+        self.abort_requested.connect(self._abort)
+        self.release_requested.connect(self._release)
+        self.pacer_requested.connect(self._set_pacer)
+
+    #Switching in the middle of a generation would lose track of what's waiting, so it waits until the next one.
+    def _set_pacer(self, name):
+        if name not in PACERS:
+            print(f"Unknown pacing {name!r}. Using adaptive.")
+            name = 'adaptive'
+        self.next_pacer = PACERS[name]()
+        if self.index == len(self.text) and not self.completing:
+            self.pacer = self.next_pacer
+            self.next_pacer = None
+
+    def _receive(self, extra, completed):
+        if extra == '' and not completed:
+            return
+        if completed and extra == '' and self.index == len(self.text):
+            self._emit(extra, completed)
+            return
+        self.text += extra
+        self.completing = completed
+        self.pacer.received(len(extra), time.monotonic())
+        if self.aborting or not self.pacer.animated:
+            self._flush()
+        #It recieved another token in the middle of typing. Let the pacer decide again, but count the time it's already waited.
+        elif self.start_time is not None:
+            self._wait(self.start_time + self.pacer.delay(self.start_time, self.completing) - time.monotonic())
+        #It was waiting for text, so type the first letter right away.
+        else:
+            self._type_next()
+
+    def _abort(self):
+        self.aborting = True
+        self._flush()
+
+    #Like an abort, but the generation keeps going without it. Whatever comes in after this is for the next one.
+    def _release(self):
+        self.timer.stop()
+        text = self.text[self.index:]
+        completed = self.completing
+        self._reset()
+        if text != '' or completed:
+            self.typed.emit(text, completed)
+        self.released.emit()
+
+    #Writes out everything it has. If the stream is done, that's the end of the generation.
+    def _flush(self):
+        self.timer.stop()
+        self.start_time = None
+        if self.index < len(self.text) or self.completing:
+            text = self.text[self.index:]
+            self.index = len(self.text)
+            self.pacer.typed(len(text))
+            self._emit(text, self.completing)
+
+    #Types the next letter, along with any after it that are due within MIN_TYPING_TIME.
+    def _type_next(self):
+        self.start_time = time.monotonic()
+        start = self.index
+        while True:
+            self.index += 1
+            self.pacer.typed(1)
+            wait_time = self.pacer.delay(self.start_time, self.completing)
+            if wait_time is None or wait_time >= MIN_TYPING_TIME:
+                break
+        self._emit(self.text[start:self.index], self.completing and self.index == len(self.text))
+        if wait_time is None:
+            #Wait until the next token comes in.
+            self.start_time = None
+        else:
+            self._wait(wait_time)
+
+    def _wait(self, seconds):
+        self.timer.start(max(0, int(seconds * 1000)))
+
+    def _emit(self, text, completed):
+        if completed:
+            self._reset()
+        self.typed.emit(text, completed)
+
+    def _reset(self):
+        self.text = ''
+        self.index = 0
+        self.completing = False
+        self.aborting = False
+        self.start_time = None
+        self.pacer.reset()
+        if self.next_pacer is not None:
+            self.pacer = self.next_pacer
+            self.next_pacer = None